@@ -0,0 +1,187 @@
+# Messages awaiting an end-to-end acknowledgement.
+#
+# The originator tracks each reliable message it sends in a fixed table of
+# slots. A slot is due for retransmission when its timer runs out; every retry
+# doubles the timeout (capped at max_backoff_ms) and adds random jitter so that
+# nodes which lost messages to the same collision do not retry in step. The
+# first timeout scales with the hops the message was given: timeout_ms per hop
+# until ACKs have come back, then the smoothed round trip per hop plus four
+# times its mean deviation, measured on messages acknowledged at the first
+# attempt only (as in TCP, the ACK of a retried one is ambiguous). Each retry
+# also doubles the first timeout of later sends, until the next measurement,
+# so that a congested mesh is not loaded with yet more retries. A
+# retransmission goes out under a fresh message ID, since relays and the
+# destination have already recorded the old one in their ledgers. A slot keeps
+# the IDs of all its attempts, as the ACK for an earlier one may arrive after
+# the retry has gone out, and is freed by an ACK for any of them or after
+# max_tries attempts.
+
+import random
+import time
+from array import array
+from micropython import const
+
+_NO_SLOT = const(-1)
+
+
+class AckTracker:
+    def __init__(self, capacity=16, timeout_ms=600, max_backoff_ms=32000, max_tries=5):
+        if not 0 < capacity < 256:
+            raise ValueError("capacity must be between 1 and 255")
+        self.capacity = capacity
+        self.timeout_ms = timeout_ms
+        self.max_backoff_ms = max_backoff_ms
+        self.max_tries = max_tries
+        self._used = bytearray(capacity)
+        self._names = array('H', bytes(2 * capacity))
+        # max_tries IDs per slot, one for each attempt
+        self._ids = array('H', bytes(2 * capacity * max_tries))
+        self._tries = bytearray(capacity)
+        self._hops = bytearray(capacity)
+        self._sent = array('i', bytes(4 * capacity))
+        self._due = array('i', bytes(4 * capacity))
+        # Round trip per hop, smoothed, and its mean deviation; 0 until measured
+        self.rtt_ms = 0
+        self.rtt_dev_ms = 0
+        # Doublings of the first timeout since the last measurement
+        self._shift = 0
+        self._count = 0
+        self.sent = 0
+        self.retries = 0
+        self.acked = 0
+        self.failed = 0
+
+    def __len__(self):
+        return self._count
+
+    # Timeout of the first attempt for a message given hops hops
+    def timeout(self, hops=1):
+        per_hop = self.rtt_ms + 4 * self.rtt_dev_ms if self.rtt_ms else self.timeout_ms
+        return min((max(hops, 1) * per_hop) << self._shift, self.max_backoff_ms)
+
+    def _backoff(self, slot, tries):
+        base = self.timeout(self._hops[slot])
+        timeout = min(base << tries, self.max_backoff_ms)
+        return timeout + random.getrandbits(16) % (base // 2 + 1)
+
+    def _measure(self, rtt):
+        self._shift = 0
+        if not self.rtt_ms:
+            self.rtt_ms = rtt
+            self.rtt_dev_ms = rtt // 2
+            return
+        err = rtt - self.rtt_ms
+        self.rtt_ms = max(self.rtt_ms + err // 8, 1)
+        self.rtt_dev_ms += (abs(err) - self.rtt_dev_ms) // 4
+
+    # Start tracking a message sent to name with a budget of hops hops.
+    # Returns False if the table is full.
+    def track(self, name, message_id, hops=1, now=None):
+        for slot in range(self.capacity):
+            if not self._used[slot]:
+                break
+        else:
+            return False
+        if now is None:
+            now = time.ticks_ms()
+        self._used[slot] = 1
+        self._names[slot] = name
+        self._ids[slot * self.max_tries] = message_id
+        self._tries[slot] = 0
+        self._hops[slot] = min(max(hops, 1), 255)
+        self._sent[slot] = now
+        self._due[slot] = time.ticks_add(now, self._backoff(slot, 0))
+        self._count += 1
+        self.sent += 1
+        return True
+
+    def _free(self, slot):
+        self._used[slot] = 0
+        self._count -= 1
+
+    # An ACK from acker for message_id. Returns True if it matched a message.
+    def ack(self, message_id, acker, now=None):
+        ids = self._ids
+        for slot in range(self.capacity):
+            if self._used[slot] and self._names[slot] == acker:
+                base = slot * self.max_tries
+                for i in range(base, base + self._tries[slot] + 1):
+                    if ids[i] == message_id:
+                        if not self._tries[slot]:
+                            if now is None:
+                                now = time.ticks_ms()
+                            self._measure(max(time.ticks_diff(now, self._sent[slot]) // self._hops[slot], 1))
+                        self._free(slot)
+                        self.acked += 1
+                        return True
+        return False
+
+    # First slot whose timer has run out, or -1.
+    def due(self, now=None):
+        if now is None:
+            now = time.ticks_ms()
+        for slot in range(self.capacity):
+            if self._used[slot] and time.ticks_diff(now, self._due[slot]) >= 0:
+                return slot
+        return _NO_SLOT
+
+    # Milliseconds until the next slot is due (0 if one already is), or -1
+    # when nothing is tracked.
+    def next_due_ms(self, now=None):
+        if now is None:
+            now = time.ticks_ms()
+        wait = _NO_SLOT
+        for slot in range(self.capacity):
+            if self._used[slot]:
+                left = max(time.ticks_diff(self._due[slot], now), 0)
+                if wait < 0 or left < wait:
+                    wait = left
+        return wait
+
+    def name(self, slot):
+        return self._names[slot]
+
+    # Retransmissions so far
+    def tries(self, slot):
+        return self._tries[slot]
+
+    # ID of the latest attempt
+    def message_id(self, slot):
+        return self._ids[slot * self.max_tries + self._tries[slot]]
+
+    # Start another attempt for slot, due again after the next backoff.
+    # Returns False, and frees the slot, once max_tries attempts have gone
+    # unacknowledged; otherwise the caller sends the retry and records its ID
+    # with add_id(). With resend=False the caller sends nothing this time and
+    # the attempt only waits longer for an ACK of the ones before.
+    def retry(self, slot, now=None, resend=True):
+        tries = self._tries[slot] + 1
+        if tries >= self.max_tries:
+            self._free(slot)
+            self.failed += 1
+            return False
+        if now is None:
+            now = time.ticks_ms()
+        self._tries[slot] = tries
+        self._ids[slot * self.max_tries + tries] = self._ids[slot * self.max_tries + tries - 1]
+        self._due[slot] = time.ticks_add(now, self._backoff(slot, tries))
+        if resend:
+            self.retries += 1
+            # Until a clean measurement says otherwise, the network is slower
+            # than the estimate: wait longer on the sends that follow
+            if self.timeout() < self.max_backoff_ms:
+                self._shift += 1
+        return True
+
+    def add_id(self, slot, message_id):
+        self._ids[slot * self.max_tries + self._tries[slot]] = message_id
+
+    def stats(self):
+        return {
+            'pending': self._count,
+            'capacity': self.capacity,
+            'sent': self.sent,
+            'retries': self.retries,
+            'acked': self.acked,
+            'failed': self.failed,
+        }
@@ -3,11 +3,7 @@
 from micropython import const
 import struct
 import bluetooth
-from machine import unique_id
-import ubinascii
-import network
-import time
-import random
+from array import array
 
 
 # Advertising payloads are repeated packets of the following form:
@@ -27,6 +23,61 @@ _ADV_TYPE_ID = const(0x18)  # Changed from 0x04 to a custom type
 _ADV_TYPE_MANUFACTURER = const(0xFF)
 _ADV_TYPE_DEVICE_TYPE = const(0x19)
 
+# Compact mesh header (version 1), carried in a single manufacturer-specific
+# AD record so every field sits at a fixed offset from the record start:
+#   0     record length
+#   1     0xFF (manufacturer specific data)
+#   2-3   company / manufacturer id, little-endian
+#   4     header version
+#   5     hop count remaining (high nibble) | initial TTL (low nibble, 0 = unknown)
+#   6-7   sender, big-endian
+#   8-9   message ID, big-endian
+#   10-11 name, big-endian
+#   12-13 distance in centimetres, big-endian (0xFFFF = unknown)
+#   14-   application data
+# Legacy payloads only carry the 2-byte company id in their manufacturer
+# record, so the record length tells the two layouts apart.
+#
+# Bytes 5-13 form a 9-byte message record. An aggregate (version 2) packs
+# several of them into one advertisement instead:
+#   4     MESH_AGGREGATE_VERSION
+#   5     record count
+#   6-    count x 9-byte message records
+# An acknowledgement (version 3) has the version 1 layout with the sender set
+# to the acknowledging node, a message ID of its own and the name set to the
+# acknowledged message's sender, so it is routed back like any other addressed
+# message, followed by
+#   14-15 ID of the acknowledged message, big-endian
+# The ACK's own ID keeps it apart from the acknowledging node's messages in
+# every ledger.
+#
+# A fragment (version 4) of an application payload too large for one
+# advertisement has the version 1 layout, with a fragment header in front of
+# the application data:
+#   14    fragment index
+#   15    fragment count
+#   16-17 payload length, big-endian
+#   18-   fragment data
+# Fragment i carries payload bytes i*s up to (i+1)*s, where the stride s is the
+# payload length over the count, rounded up. The fragments of a payload have
+# consecutive message IDs (first ID + index), so relays dedupe and forward
+# each like any other message without reassembling.
+MESH_VERSION = const(1)
+MESH_AGGREGATE_VERSION = const(2)
+MESH_ACK_VERSION = const(3)
+MESH_FRAGMENT_VERSION = const(4)
+MESH_HEADER_LEN = const(14)
+ACK_DATA_LEN = const(2)
+MESH_RECORD_LEN = const(9)
+FRAGMENT_HEADER_LEN = const(4)
+MESH_MAX_HOPS = const(15)
+_AGGREGATE_HEADER_LEN = const(6)
+_MESH_DIST_UNKNOWN = const(0xFFFF)
+LEGACY_ADV_MAX = const(31)
+# Largest advertising data carried in a single AUX_ADV_IND with BLE 5
+# extended advertising
+EXT_ADV_MAX = const(240)
+
 
 # Generate a payload to be passed to gap_advertise(adv_data=...).
 def advertising_payload(name=None, services=None, manufacturer_data=None, hopCount= 0, distance=None, sender=None, messageID=0, device_type=None):
@@ -87,6 +138,447 @@ def advertising_payload(name=None, services=None, manufacturer_data=None, hopCou
     return payload
 
 
+# Fixed-layout payload for mesh messages. The AD records are laid out once into
+# a preallocated buffer; relays then rewrite the per-message fields in place at
+# known offsets instead of building a new payload for every forward. The record
+# order matches advertising_payload so existing decoders read it unchanged.
+class PayloadTemplate:
+    def __init__(self, manufacturer_data=None, services=None, name=0, hopCount=0, distance=0.0, sender=0, messageID=0):
+        head = advertising_payload(manufacturer_data=manufacturer_data, services=services)
+        offset = len(head)
+        self._buf = bytearray(offset + 21)
+        self._buf[:offset] = head
+        self._name = offset + 2
+        offset = self._header(offset, 2, _ADV_TYPE_NAME)
+        self._hop = offset + 2
+        offset = self._header(offset, 1, _ADV_TYPE_INT)
+        self._distance = offset + 2
+        offset = self._header(offset, 4, _ADV_TYPE_DIST)
+        self._sender = offset + 2
+        offset = self._header(offset, 2, _ADV_TYPE_SENDER)
+        self._id = offset + 2
+        self._header(offset, 2, _ADV_TYPE_ID)
+        self.payload = self._buf
+        self.patch(hopCount, sender, messageID, name, distance)
+
+    def _header(self, offset, size, adv_type):
+        self._buf[offset] = size + 1
+        self._buf[offset + 1] = adv_type
+        return offset + size + 2
+
+    # Rewrite the per-message fields. name, sender and messageID are 16-bit
+    # big-endian like advertising_payload writes them; None leaves a field as
+    # is, except distance: the legacy layout has no value for an unknown one
+    # and carries 0. It has no TTL or acknowledgements either, so ttl and ack
+    # are ignored.
+    def patch(self, hopCount, sender, messageID, name=None, distance=None, ttl=0, ack=None):
+        buf = self._buf
+        buf[self._hop] = hopCount & 0xFF
+        i = self._sender
+        buf[i] = (sender >> 8) & 0xFF
+        buf[i + 1] = sender & 0xFF
+        i = self._id
+        buf[i] = (messageID >> 8) & 0xFF
+        buf[i + 1] = messageID & 0xFF
+        if name is not None:
+            i = self._name
+            buf[i] = (name >> 8) & 0xFF
+            buf[i + 1] = name & 0xFF
+        struct.pack_into("f", buf, self._distance, distance if distance is not None else 0.0)
+        return buf
+
+
+# Write one 9-byte message record at offset; None leaves name/distance as is.
+def _write_record(buf, offset, hopCount, sender, messageID, name, distance, ttl):
+    if hopCount > MESH_MAX_HOPS:
+        hopCount = MESH_MAX_HOPS
+    if ttl > MESH_MAX_HOPS:
+        ttl = MESH_MAX_HOPS
+    buf[offset] = (hopCount << 4) | ttl
+    buf[offset + 1] = (sender >> 8) & 0xFF
+    buf[offset + 2] = sender & 0xFF
+    buf[offset + 3] = (messageID >> 8) & 0xFF
+    buf[offset + 4] = messageID & 0xFF
+    if name is not None:
+        buf[offset + 5] = (name >> 8) & 0xFF
+        buf[offset + 6] = name & 0xFF
+    if distance is not None:
+        cm = int(distance * 100 + 0.5)
+        if cm < 0 or cm >= _MESH_DIST_UNKNOWN:
+            cm = _MESH_DIST_UNKNOWN - 1
+        buf[offset + 7] = cm >> 8
+        buf[offset + 8] = cm & 0xFF
+
+
+# Same fields as PayloadTemplate in the compact mesh header layout. patch()
+# takes the same arguments, so callers can switch layouts freely; data_len
+# reserves room for application data after the header. A distance of None is
+# sent as unknown. ack, the ID of the message acknowledged, makes an
+# acknowledgement; it needs ACK_DATA_LEN bytes of data.
+class CompactTemplate:
+    def __init__(self, manufacturer_data=None, name=0, hopCount=0, distance=None, sender=0, messageID=0, ttl=0, data_len=0):
+        if MESH_HEADER_LEN + data_len > LEGACY_ADV_MAX:
+            raise ValueError("payload too large")
+        self._buf = bytearray(MESH_HEADER_LEN + data_len)
+        buf = self._buf
+        buf[0] = len(buf) - 1
+        buf[1] = _ADV_TYPE_MANUFACTURER
+        if manufacturer_data is not None:
+            buf[2:4] = bytes(manufacturer_data)[:2]
+        buf[4] = MESH_VERSION
+        buf[12] = buf[13] = 0xFF
+        self.payload = buf
+        self.patch(hopCount, sender, messageID, name, distance, ttl)
+
+    def patch(self, hopCount, sender, messageID, name=None, distance=None, ttl=0, ack=None):
+        buf = self._buf
+        if ack is None:
+            buf[4] = MESH_VERSION
+        else:
+            buf[4] = MESH_ACK_VERSION
+            buf[MESH_HEADER_LEN] = (ack >> 8) & 0xFF
+            buf[MESH_HEADER_LEN + 1] = ack & 0xFF
+        if distance is None:
+            buf[12] = buf[13] = 0xFF
+        _write_record(buf, 5, hopCount, sender, messageID, name, distance, ttl)
+        return buf
+
+    def set_data(self, data):
+        self._buf[MESH_HEADER_LEN:MESH_HEADER_LEN + len(data)] = data
+
+
+# Several message records in one advertisement. max_len is LEGACY_ADV_MAX (two
+# records) or up to EXT_ADV_MAX when the stack supports extended advertising.
+class AggregateTemplate:
+    def __init__(self, manufacturer_data=None, max_len=LEGACY_ADV_MAX):
+        self.capacity = (max_len - _AGGREGATE_HEADER_LEN) // MESH_RECORD_LEN
+        if self.capacity < 1:
+            raise ValueError("max_len too small")
+        self._buf = bytearray(_AGGREGATE_HEADER_LEN + self.capacity * MESH_RECORD_LEN)
+        self._view = memoryview(self._buf)
+        self._buf[1] = _ADV_TYPE_MANUFACTURER
+        if manufacturer_data is not None:
+            self._buf[2:4] = bytes(manufacturer_data)[:2]
+        self._buf[4] = MESH_AGGREGATE_VERSION
+        self.clear()
+
+    def clear(self):
+        self.count = 0
+        self._buf[0] = _AGGREGATE_HEADER_LEN - 1
+        self._buf[5] = 0
+
+    # Append a record; returns False when the template is full.
+    def add(self, hopCount, sender, messageID, name=0, distance=None, ttl=0):
+        if self.count == self.capacity:
+            return False
+        offset = _AGGREGATE_HEADER_LEN + self.count * MESH_RECORD_LEN
+        if distance is None:
+            self._buf[offset + 7] = self._buf[offset + 8] = 0xFF
+        _write_record(self._buf, offset, hopCount, sender or 0, messageID or 0, name or 0, distance, ttl or 0)
+        self.count += 1
+        self._buf[0] = offset + MESH_RECORD_LEN - 1
+        self._buf[5] = self.count
+        return True
+
+    def payload(self):
+        return self._view[:_AGGREGATE_HEADER_LEN + self.count * MESH_RECORD_LEN]
+
+
+# Number of fragments for a payload of length bytes, each in an advertisement
+# of at most max_len bytes.
+def fragment_count(length, max_len=LEGACY_ADV_MAX):
+    room = max_len - MESH_HEADER_LEN - FRAGMENT_HEADER_LEN
+    if room < 1:
+        raise ValueError("max_len too small")
+    return max((length + room - 1) // room, 1)
+
+
+def fragment_stride(count, length):
+    return (length + count - 1) // count
+
+
+# Length of the fragment (header and data) whose header starts at offset in
+# buf, as its header gives it.
+def fragment_len(buf, offset=0):
+    count = buf[offset + 1]
+    total = (buf[offset + 2] << 8) | buf[offset + 3]
+    stride = fragment_stride(count, total)
+    return FRAGMENT_HEADER_LEN + min(stride, total - buf[offset] * stride)
+
+
+# Fragment index of count for payload: the fragment header and its data, as
+# carried after the mesh header.
+def make_fragment(payload, index, count):
+    total = len(payload)
+    stride = fragment_stride(count, total)
+    start = min(index * stride, total)
+    data = payload[start:start + stride]
+    fragment = bytearray(FRAGMENT_HEADER_LEN + len(data))
+    fragment[0] = index
+    fragment[1] = count
+    fragment[2] = total >> 8
+    fragment[3] = total & 0xFF
+    fragment[FRAGMENT_HEADER_LEN:] = data
+    return fragment
+
+
+# Compact header followed by a fragment, for relaying fragments as received.
+# One buffer of max_len bytes; patch() returns a view of the filled part. The
+# fragment's own header sets how much of it is copied, so it may be handed in
+# a larger buffer.
+class FragmentTemplate:
+    def __init__(self, manufacturer_data=None, max_len=LEGACY_ADV_MAX):
+        if max_len < MESH_HEADER_LEN + FRAGMENT_HEADER_LEN + 1:
+            raise ValueError("max_len too small")
+        self._buf = bytearray(max_len)
+        self._view = memoryview(self._buf)
+        self._buf[1] = _ADV_TYPE_MANUFACTURER
+        if manufacturer_data is not None:
+            self._buf[2:4] = bytes(manufacturer_data)[:2]
+        self._buf[4] = MESH_FRAGMENT_VERSION
+
+    def patch(self, hopCount, sender, messageID, name=None, distance=None, ttl=0, fragment=b''):
+        buf = self._buf
+        if len(fragment) < FRAGMENT_HEADER_LEN or fragment_len(fragment) > len(fragment):
+            raise ValueError("fragment too short")
+        n = MESH_HEADER_LEN + fragment_len(fragment)
+        if n > len(buf):
+            raise ValueError("fragment too large")
+        buf[0] = n - 1
+        if distance is None:
+            buf[12] = buf[13] = 0xFF
+        _write_record(buf, 5, hopCount, sender, messageID, name, distance, ttl)
+        for j in range(n - MESH_HEADER_LEN):
+            buf[MESH_HEADER_LEN + j] = fragment[j]
+        return self._view[:n]
+
+
+# Generate a compact-header payload to be passed to gap_advertise(adv_data=...).
+def mesh_payload(manufacturer_data=None, name=0, hopCount=0, distance=None, sender=0, messageID=0, ttl=0, data=None):
+    template = CompactTemplate(manufacturer_data, name, hopCount, distance, sender, messageID, ttl, len(data) if data else 0)
+    if data:
+        template.set_data(data)
+    return template.payload
+
+
+# Slots of the result list filled by decode_adv, in BLENode tuple order. TTL
+# and DATA are only set for compact headers: DATA is the offset of the
+# application data, or of the record block for an aggregate. RECORDS is the
+# number of message records in the packet (1 except for aggregates). ACK is
+# the acknowledged message ID for an acknowledgement, None otherwise.
+# FRAGMENT is the offset of the fragment header for a fragment (DATA is then
+# its data), None otherwise.
+FIELD_MFG = const(0)
+FIELD_HOP = const(1)
+FIELD_DIST = const(2)
+FIELD_SENDER = const(3)
+FIELD_NAME = const(4)
+FIELD_ID = const(5)
+FIELD_TTL = const(6)
+FIELD_DATA = const(7)
+FIELD_RECORDS = const(8)
+FIELD_ACK = const(9)
+FIELD_FRAGMENT = const(10)
+FIELD_COUNT = const(11)
+
+
+def _read_be(mv, i):
+    # Big-endian integer value of the AD record starting at i.
+    value = 0
+    for j in range(i + 2, i + mv[i] + 1):
+        value = (value << 8) | mv[j]
+    return value
+
+
+# Decode the 9-byte message record at offset into result.
+def decode_record(mv, offset, result):
+    b = mv[offset]
+    result[FIELD_HOP] = b >> 4
+    result[FIELD_TTL] = b & 0x0F
+    result[FIELD_SENDER] = (mv[offset + 1] << 8) | mv[offset + 2]
+    result[FIELD_ID] = (mv[offset + 3] << 8) | mv[offset + 4]
+    result[FIELD_NAME] = (mv[offset + 5] << 8) | mv[offset + 6]
+    cm = (mv[offset + 7] << 8) | mv[offset + 8]
+    result[FIELD_DIST] = cm / 100 if cm != _MESH_DIST_UNKNOWN else None
+
+
+def _decode_compact(mv, i, mfg, result):
+    length = mv[i]
+    version = mv[i + 4]
+    if version == MESH_VERSION and length >= MESH_HEADER_LEN - 1:
+        result[FIELD_ACK] = None
+        result[FIELD_FRAGMENT] = None
+        result[FIELD_RECORDS] = 1
+        result[FIELD_DATA] = i + MESH_HEADER_LEN if length >= MESH_HEADER_LEN else None
+        decode_record(mv, i + 5, result)
+    elif version == MESH_ACK_VERSION and length >= MESH_HEADER_LEN + ACK_DATA_LEN - 1:
+        result[FIELD_ACK] = (mv[i + MESH_HEADER_LEN] << 8) | mv[i + MESH_HEADER_LEN + 1]
+        result[FIELD_FRAGMENT] = None
+        result[FIELD_RECORDS] = 1
+        result[FIELD_DATA] = i + MESH_HEADER_LEN + ACK_DATA_LEN if length >= MESH_HEADER_LEN + ACK_DATA_LEN else None
+        decode_record(mv, i + 5, result)
+    elif version == MESH_FRAGMENT_VERSION and length >= MESH_HEADER_LEN + FRAGMENT_HEADER_LEN - 1:
+        f = i + MESH_HEADER_LEN
+        index = mv[f]
+        count = mv[f + 1]
+        total = (mv[f + 2] << 8) | mv[f + 3]
+        if index >= count:
+            return False
+        stride = fragment_stride(count, total)
+        n = min(stride, total - index * stride)
+        if n < 0 or length < MESH_HEADER_LEN + FRAGMENT_HEADER_LEN - 1 + n:
+            return False
+        result[FIELD_ACK] = None
+        result[FIELD_FRAGMENT] = f
+        result[FIELD_RECORDS] = 1
+        result[FIELD_DATA] = f + FRAGMENT_HEADER_LEN
+        decode_record(mv, i + 5, result)
+    elif version == MESH_AGGREGATE_VERSION and length >= _AGGREGATE_HEADER_LEN - 1:
+        count = mv[i + 5]
+        if count == 0 or length < _AGGREGATE_HEADER_LEN - 1 + count * MESH_RECORD_LEN:
+            return False
+        result[FIELD_ACK] = None
+        result[FIELD_FRAGMENT] = None
+        result[FIELD_RECORDS] = count
+        result[FIELD_DATA] = i + _AGGREGATE_HEADER_LEN
+        decode_record(mv, i + _AGGREGATE_HEADER_LEN, result)
+    else:
+        return False
+    result[FIELD_MFG] = mfg
+    return True
+
+
+# The AD record walk of decode_adv, in plain Python; viperWalk.walk_ad
+# compiles the same walk with the viper emitter and documents it. The
+# constants here must match the ones there.
+_ABSENT = const(-1)
+_EMPTY = const(-2)
+_WIDE = const(-3)
+_W_MFG = const(0)
+_W_HOP = const(1)
+_W_SENDER = const(2)
+_W_ID = const(3)
+_W_NAME = const(4)
+_W_DIST = const(5)
+_W_AT = const(6)
+# Length of the walked array decode_adv takes
+WALK_LEN = const(7)
+_WALK_REJECT = const(0)
+_WALK_END = const(1)
+_WALK_MFG = const(2)
+
+
+def walk_ad_py(buf, start, n, target, out):
+    if start == 0:
+        for k in range(WALK_LEN):
+            out[k] = _ABSENT
+    i = start
+    while i + 1 < n:
+        length = buf[i]
+        if length == 0 or i + length >= n:
+            break
+        adv_type = buf[i + 1]
+        if adv_type == _ADV_TYPE_MANUFACTURER:
+            if length < 3:
+                return _WALK_REJECT
+            mfg = buf[i + 2] | (buf[i + 3] << 8)
+            out[_W_MFG] = mfg
+            if target >= 0 and mfg != target:
+                return _WALK_REJECT
+            if length > 3:
+                out[_W_AT] = i
+                return _WALK_MFG
+        elif adv_type == _ADV_TYPE_DIST:
+            out[_W_DIST] = i
+        else:
+            slot = -1
+            if adv_type == _ADV_TYPE_INT:
+                slot = _W_HOP
+            elif adv_type == _ADV_TYPE_SENDER:
+                slot = _W_SENDER
+            elif adv_type == _ADV_TYPE_ID:
+                slot = _W_ID
+            elif adv_type == _ADV_TYPE_NAME:
+                slot = _W_NAME
+            if slot >= 0:
+                if length > 4:
+                    out[slot] = _WIDE - i
+                elif length == 1 and slot != _W_NAME:
+                    out[slot] = _EMPTY
+                else:
+                    value = 0
+                    for j in range(i + 2, i + length + 1):
+                        value = (value << 8) | buf[j]
+                    out[slot] = value
+        i += length + 1
+    return _WALK_END
+
+
+try:
+    from viperWalk import walk_ad
+    NATIVE_WALK = True
+except (ImportError, SyntaxError):
+    # No native emitter on this port (or no viperWalk module)
+    walk_ad = walk_ad_py
+    NATIVE_WALK = False
+
+_walked = array('i', bytes(4 * WALK_LEN))
+
+
+def _walked_value(mv, value):
+    if value >= 0:
+        return value
+    if value <= _WIDE:
+        return _read_be(mv, _WIDE - value)
+    return None
+
+
+# Decode a mesh advertisement in one pass over a memoryview into result, a
+# preallocated list of FIELD_COUNT slots; fields that are absent are set to
+# None. When target_mfg (16-bit company/UUID value) is given, packets whose
+# manufacturer record differs, or that have none, are rejected before any
+# other field is parsed. A compact mesh header is read at fixed offsets as
+# soon as its record is reached. walked, an array('i') of 7, is scratch space
+# for the record walk; callers that may interrupt one another (the scan IRQ
+# and the main loop) pass their own. Returns True if result was filled.
+def decode_adv(adv_data, result, target_mfg=None, walked=None):
+    mv = adv_data if isinstance(adv_data, memoryview) else memoryview(adv_data)
+    n = len(mv)
+    w = walked if walked is not None else _walked
+    target = target_mfg if target_mfg is not None else -1
+    start = 0
+    while True:
+        status = walk_ad(mv, start, n, target, w)
+        if status == _WALK_REJECT:
+            return False
+        if status != _WALK_MFG:
+            break
+        at = w[_W_AT]
+        if _decode_compact(mv, at, w[_W_MFG], result):
+            return True
+        start = at + mv[at] + 1
+    mfg = w[_W_MFG]
+    dist = w[_W_DIST]
+    if mfg < 0:
+        if target_mfg is not None:
+            return False
+        if (w[_W_HOP] == _ABSENT and dist < 0 and w[_W_SENDER] == _ABSENT and w[_W_NAME] == _ABSENT
+                and w[_W_ID] == _ABSENT):
+            return False
+    result[FIELD_MFG] = mfg if mfg >= 0 else None
+    result[FIELD_HOP] = _walked_value(mv, w[_W_HOP])
+    result[FIELD_DIST] = struct.unpack_from("f", mv, dist + 2)[0] if dist >= 0 and mv[dist] == 5 else None
+    result[FIELD_SENDER] = _walked_value(mv, w[_W_SENDER])
+    result[FIELD_NAME] = _walked_value(mv, w[_W_NAME])
+    result[FIELD_ID] = _walked_value(mv, w[_W_ID])
+    result[FIELD_TTL] = None
+    result[FIELD_DATA] = None
+    result[FIELD_RECORDS] = 1
+    result[FIELD_ACK] = None
+    result[FIELD_FRAGMENT] = None
+    return True
+
+
 def decode_field(payload, adv_type):
     i = 0
     result = []
@@ -97,29 +589,29 @@ def decode_field(payload, adv_type):
     return result
 
 
+_decoded = [None] * FIELD_COUNT
+
+def _decode_one(payload, field):
+    return _decoded[field] if decode_adv(payload, _decoded) else None
+
+
 def decode_name(payload):
-    n = decode_field(payload, _ADV_TYPE_NAME)
-    return str(n[0], "utf-8") if n else ""
+    return _decode_one(payload, FIELD_NAME)
 
 def decode_mfg(payload):
-    n = decode_field(payload, _ADV_TYPE_MANUFACTURER)
-    return str(n[0], "utf-8") if n else ""
+    return _decode_one(payload, FIELD_MFG)
 
 def decode_hop(payload):
-    n = decode_field(payload, _ADV_TYPE_INT)
-    return str(n[0], "utf-8") if n else ""
+    return _decode_one(payload, FIELD_HOP)
 
 def decode_distance(payload):
-    n = decode_field(payload, _ADV_TYPE_DIST)
-    return str(n[0], "utf-16") if n else ""
+    return _decode_one(payload, FIELD_DIST)
 
 def decode_sender(payload):
-    n = decode_field(payload, _ADV_TYPE_SENDER)
-    return str(n[0], "utf-8") if n else ""
+    return _decode_one(payload, FIELD_SENDER)
 
 def decode_id(payload):
-    n = decode_field(payload, _ADV_TYPE_ID)
-    return str(n[0], "utf-16") if n else ""
+    return _decode_one(payload, FIELD_ID)
 
 
 def decode_services(payload):
@@ -134,6 +626,8 @@ def decode_services(payload):
 
 
 def demo():
+    import random
+    import time
     while True:
         hopCount = 1
         messageIdentifier = random.randint(0000,1111)
@@ -0,0 +1,345 @@
+# Micro-benchmarks for the hot paths: payload encoding, decoding, the message
+# ledger and a synthetic scan IRQ flood. Runs on the device or, with the
+# meshSim stand-ins, under CPython, and reports ops/s, per-call latency
+# percentiles and memory per call: bytes allocated (gc.mem_alloc deltas) on
+# MicroPython; on CPython, which keeps no allocation count, the tracemalloc
+# peak above what was in use before the call, labelled as such. The peak
+# misses memory a call frees and reuses. The decode benchmarks also run with the
+# pure-Python AD walk ('py'), for comparison with the viper one, and before
+# anything else decode_adv is checked to give the same results with both.
+#
+#   python benchmark.py [--json] [--quick] [--compare baseline.json]
+#   mpremote run benchmark.py
+#
+# With --compare the results are checked against an earlier --json run and
+# the exit status is 1 if any benchmark lost more than 20% of its ops/s. It is
+# also 1 if the two AD walks disagree.
+
+try:
+    import bluetooth
+except ImportError:
+    import meshSim
+    meshSim.install_host_modules()
+    import bluetooth
+
+import gc
+import io
+import random
+import sys
+import time
+try:
+    import json
+except ImportError:
+    import ujson as json
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+import readScan
+import irqBench
+import advertisementPacket
+from advertisementPacket import (advertising_payload, PayloadTemplate, CompactTemplate, AggregateTemplate,
+                                 FragmentTemplate, decode_adv, decode_name, decode_mfg, decode_hop,
+                                 decode_distance, decode_sender, decode_id, fragment_count, make_fragment, FIELD_COUNT,
+                                 ACK_DATA_LEN)
+from messageLedger import MessageLedger
+
+_TELESCOPE_UUID = bluetooth.UUID(0x0102)
+_TOLERANCE = 0.2
+
+if hasattr(time, 'perf_counter_ns'):
+    _now = time.perf_counter_ns
+    _NS_PER_TICK = 1
+
+    def _diff(a, b):
+        return a - b
+else:
+    _now = time.ticks_us
+    _NS_PER_TICK = 1000
+    _diff = time.ticks_diff
+
+
+def _alloc_per_call(fn, args, calls, after):
+    total = 0
+    if tracemalloc is None:
+        gc.collect()
+        gc.disable()
+        try:
+            for i in range(calls):
+                a = args(i)
+                before = gc.mem_alloc()
+                fn(*a)
+                total += gc.mem_alloc() - before
+                if after is not None:
+                    after()
+        finally:
+            gc.enable()
+        return total / calls
+    tracemalloc.start()
+    try:
+        for i in range(calls):
+            a = args(i)
+            base = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+            fn(*a)
+            total += tracemalloc.get_traced_memory()[1] - base
+            if after is not None:
+                after()
+    finally:
+        tracemalloc.stop()
+    return total / calls
+
+
+# Time fn(*args(i)) for i in range(calls): once as a whole for throughput,
+# once call by call for the latency distribution, and on a short run for
+# allocations. after(), if given, runs untimed after every call and the
+# throughput comes from the per-call times instead.
+def bench(name, fn, args, calls, after=None):
+    gc.collect()
+    if after is None:
+        start = _now()
+        for i in range(calls):
+            fn(*args(i))
+        total = _diff(_now(), start) * _NS_PER_TICK
+
+    samples = []
+    for i in range(calls):
+        a = args(i)
+        t = _now()
+        fn(*a)
+        samples.append(_diff(_now(), t) * _NS_PER_TICK)
+        if after is not None:
+            after()
+    if after is not None:
+        total = sum(samples)
+    samples.sort()
+    n = len(samples)
+    return {
+        'name': name,
+        'calls': calls,
+        'ops_per_s': int(calls * 1000000000 // total) if total > 0 else 0,
+        'p50_ns': samples[n // 2],
+        'p90_ns': samples[n * 9 // 10],
+        'p99_ns': samples[min(n - 1, n * 99 // 100)],
+        'max_ns': samples[-1],
+        'alloc_bytes': round(_alloc_per_call(fn, args, min(calls, 100), after), 1),
+    }
+
+
+def run(calls=2000):
+    legacy = bytes(advertising_payload(name=0x1234, manufacturer_data=_TELESCOPE_UUID,
+                                       services=[bluetooth.UUID(0x0001)], hopCount=3,
+                                       distance=7.94, sender=0x5678, messageID=42))
+    template = PayloadTemplate(_TELESCOPE_UUID, name=0x1234, distance=7.94)
+    compact_template = CompactTemplate(_TELESCOPE_UUID, name=0x1234, distance=7.94)
+    compact = bytes(compact_template.patch(3, 0x5678, 42, ttl=5))
+    result = [None] * FIELD_COUNT
+    node = readScan.BLENode(bluetooth.BLE(), _TELESCOPE_UUID)
+    none = lambda i: ()
+
+    results = [
+        bench('advertising_payload', lambda: advertising_payload(
+            name=0x1234, manufacturer_data=_TELESCOPE_UUID, hopCount=3, distance=7.94,
+            sender=0x5678, messageID=42), none, calls),
+        bench('PayloadTemplate.patch', template.patch, lambda i: (3, 0x5678, i & 0xFFFF), calls),
+        bench('CompactTemplate.patch', compact_template.patch, lambda i: (3, 0x5678, i & 0xFFFF), calls),
+        bench('BLENode._decode_adv_data', node._decode_adv_data, lambda i: (legacy,), calls),
+        bench('decode_adv legacy', decode_adv, lambda i: (legacy, result, 0x0102), calls),
+        bench('decode_adv compact', decode_adv, lambda i: (compact, result, 0x0102), calls),
+    ]
+    with _python_walk():
+        results.append(bench('decode_adv legacy py', decode_adv, lambda i: (legacy, result, 0x0102), calls))
+        results.append(bench('decode_adv compact py', decode_adv, lambda i: (compact, result, 0x0102), calls))
+    for fn in (decode_name, decode_mfg, decode_hop, decode_distance, decode_sender, decode_id):
+        results.append(bench(fn.__name__, fn, lambda i: (legacy,), calls))
+
+    # Fresh keys for inserts, then lookups of keys that are all present
+    ledger = MessageLedger(capacity=1024)
+    results.append(bench('ledger check_and_add', ledger.check_and_add, lambda i: (i >> 10, i & 0x3FF), calls))
+    ledger = MessageLedger(capacity=1024)
+    for i in range(1024):
+        ledger.add(0x5678, i)
+    results.append(bench('ledger seen', ledger.seen, lambda i: (0x5678, i & 0x3FF), calls))
+
+    # Boot-time restore of a full default-size ledger image
+    ledger = MessageLedger()
+    for i in range(ledger.capacity):
+        ledger.add(0x5678, i)
+    image = io.BytesIO()
+    ledger.save(image)
+    restored = MessageLedger()
+
+    def restore():
+        image.seek(0)
+        restored.restore(image)
+
+    results.append(bench('ledger restore', restore, none, max(calls // 10, 10)))
+
+    results.extend(_irq_flood(calls))
+    return results
+
+
+# Runs decode_adv with the pure-Python AD walk inside a with block.
+class _python_walk:
+    def __enter__(self):
+        self._walk = advertisementPacket.walk_ad
+        advertisementPacket.walk_ad = advertisementPacket.walk_ad_py
+
+    def __exit__(self, *exc):
+        advertisementPacket.walk_ad = self._walk
+        return False
+
+
+# Mesh payloads of every layout, foreign and malformed ones, every truncation
+# of those, and random bytes.
+def decoder_corpus():
+    uuid = _TELESCOPE_UUID
+    other = bluetooth.UUID(0x0304)
+    whole = [
+        bytes(advertising_payload(name=0x1234, manufacturer_data=uuid, services=[bluetooth.UUID(0x0001)],
+                                  hopCount=3, distance=7.94, sender=0x5678, messageID=42)),
+        bytes(advertising_payload(name=0x1234, manufacturer_data=other, hopCount=1, sender=0x5678, messageID=7)),
+        bytes(advertising_payload(name=0xFFFF, hopCount=2, messageID=0x1FF)),
+        bytes(CompactTemplate(uuid, name=0x1234).patch(3, 0x5678, 42, distance=7.94, ttl=5)),
+        bytes(CompactTemplate(uuid, name=0x1234, data_len=ACK_DATA_LEN).patch(3, 0x5678, 43, ack=42)),
+        bytes(FragmentTemplate(uuid).patch(4, 0x5678, 44, name=0x1234, fragment=make_fragment(bytes(range(40)), 1, fragment_count(40)))),
+        # Hop record with no data, name too wide for the walk, empty record
+        bytes((2, 0x0A, 3, 1, 0x0A, 6, 0x09, 1, 2, 3, 4, 5, 3, 0x18, 0, 9, 0)),
+        bytes((3, 0xFF, 0x02, 0x01, 2, 0xFF, 0x02, 3, 0x17, 0x56, 0x78)),
+    ]
+    aggregate = AggregateTemplate(uuid)
+    for k in range(aggregate.capacity):
+        aggregate.add(2, 0x5678, 100 + k, 0x1234, 1.5, 4)
+    whole.append(bytes(aggregate.payload()))
+    corpus = []
+    for payload in whole:
+        for n in range(len(payload) + 1):
+            corpus.append(payload[:n])
+    rng = random.Random(1) if hasattr(random, 'Random') else random
+    for _ in range(200):
+        corpus.append(bytes(rng.getrandbits(8) for _ in range(rng.getrandbits(5))))
+    return corpus
+
+
+# Payloads for which decode_adv gives different results with the selected AD
+# walk and the pure-Python one, with and without a manufacturer filter.
+def check_decoder(corpus):
+    mismatches = []
+    for payload in corpus:
+        for target in (None, 0x0102):
+            fast = [0] * FIELD_COUNT
+            ok = decode_adv(payload, fast, target)
+            with _python_walk():
+                slow = [0] * FIELD_COUNT
+                if decode_adv(payload, slow, target) != ok or (ok and fast != slow):
+                    mismatches.append((payload, target))
+    return mismatches
+
+
+# A burst of scan results straight into BLENode._irq, inline and deferred.
+def _irq_flood(calls):
+    ble = bluetooth.BLE()
+    packets = irqBench.make_packets(calls)
+    out = []
+    inline = readScan.BLENode(ble, _TELESCOPE_UUID)
+    inline.scan_continuous(deferred=False)
+    out.append(bench('irq flood inline', inline._irq, lambda i: (readScan._IRQ_SCAN_RESULT, packets[i % calls]), calls))
+    inline.stop_scan()
+
+    deferred = readScan.BLENode(ble, _TELESCOPE_UUID)
+    queue = deferred.scan_continuous(deferred=True)
+
+    def drain():
+        # Sleeping lets the scheduled _drain run, as it would between IRQs
+        time.sleep_ms(0)
+        while queue.get() is not None:
+            pass
+
+    out.append(bench('irq flood deferred', deferred._irq, lambda i: (readScan._IRQ_SCAN_RESULT, packets[i % calls]), calls, drain))
+    deferred.stop_scan()
+    return out
+
+
+def runtime():
+    impl = sys.implementation
+    return {
+        'implementation': impl.name,
+        'version': '.'.join(str(v) for v in impl.version[:3]),
+        'platform': sys.platform,
+    }
+
+
+# Benchmarks in results that are slower than in baseline by more than
+# tolerance, as (name, ops/s, baseline ops/s).
+def compare(results, baseline, tolerance=_TOLERANCE):
+    before = {r['name']: r['ops_per_s'] for r in baseline['results']}
+    slower = []
+    for r in results:
+        old = before.get(r['name'])
+        if old and r['ops_per_s'] < old * (1 - tolerance):
+            slower.append((r['name'], r['ops_per_s'], old))
+    return slower
+
+
+# What alloc_bytes measures on this runtime
+ALLOC_METRIC = 'allocated' if tracemalloc is None else 'tracemalloc peak'
+
+
+class _Defaults:
+    quick = False
+    json = False
+    compare = None
+
+
+def parse_args(argv):
+    try:
+        import argparse
+    except ImportError:
+        # MicroPython without argparse; mpremote run passes no arguments
+        if argv:
+            raise SystemExit('benchmark.py: options need argparse')
+        return _Defaults()
+    parser = argparse.ArgumentParser(description='Micro-benchmark the hot paths.')
+    parser.add_argument('--quick', action='store_true', help='200 calls per benchmark instead of 2000')
+    parser.add_argument('--json', action='store_true')
+    parser.add_argument('--compare', metavar='BASELINE', default=None,
+                        help='fail on a regression against an earlier --json run')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+    calls = 200 if args.quick else 2000
+    mismatches = check_decoder(decoder_corpus())
+    results = run(calls)
+    report = {'runtime': runtime(), 'native_walk': advertisementPacket.NATIVE_WALK,
+              'decoder_mismatches': len(mismatches), 'alloc_metric': ALLOC_METRIC, 'results': results}
+    if args.json:
+        print(json.dumps(report))
+    else:
+        print('%s %s on %s' % (report['runtime']['implementation'], report['runtime']['version'],
+                               report['runtime']['platform']))
+        walk = 'Python'
+        if report['native_walk']:
+            # The stand-in decorators leave viper code uncompiled on the host
+            walk = 'viper' if report['runtime']['implementation'] == 'micropython' else 'viper, uncompiled'
+        print('AD walk: %s, %d mismatches with the pure-Python walk' % (walk, len(mismatches)))
+        for payload, target in mismatches[:5]:
+            print('MISMATCH %s target %s' % (payload.hex(), target))
+        unit = 'B/call' if tracemalloc is None else 'B peak/call'
+        for r in results:
+            print('%-26s %9d ops/s  p50 %7d ns  p99 %7d ns  %7.1f %s' % (
+                r['name'], r['ops_per_s'], r['p50_ns'], r['p99_ns'], r['alloc_bytes'], unit))
+    if args.compare is not None:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        slower = compare(results, baseline)
+        for name, ops, old in slower:
+            print('REGRESSION %s: %d ops/s, was %d' % (name, ops, old))
+        return 1 if slower or mismatches else 0
+    return 1 if mismatches else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
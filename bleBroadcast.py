@@ -1,14 +1,29 @@
 import bluetooth
 import time
-from advertisementPacket import advertising_payload
+import asyncio
+import random
+from advertisementPacket import advertising_payload, PayloadTemplate, CompactTemplate, FragmentTemplate, EXT_ADV_MAX, ACK_DATA_LEN
 from micropython import const
+from array import array
 from machine import Pin
+from bleSession import attach, get_session
+from metrics import metrics, FORWARDED, ADVERTISED, ADV_MS, ADV_DWELL_MS
 
 
 _IRQ_CENTRAL_CONNECT = const(1)
 _IRQ_CENTRAL_DISCONNECT = const(2)
 _IRQ_GATTS_INDICATE_DONE = const(20)
 
+_GATTS_EVENTS = (_IRQ_CENTRAL_CONNECT, _IRQ_CENTRAL_DISCONNECT, _IRQ_GATTS_INDICATE_DONE)
+
+# Scheduler slots are shortened by up to this much at random, so neighbours
+# relaying the same message do not stay in step and collide on every event.
+# Slots stay under the interval so each carries a single advertising event.
+_SLOT_JITTER_MS = const(10)
+
+_ADV_INTERVAL_US = const(100000)
+_DWELL_MS = const(1000)
+
 _FLAG_READ = const(0x0002)
 _FLAG_NOTIFY = const(0x0010)
 _FLAG_INDICATE = const(0x0020)
@@ -36,21 +51,43 @@ _SENSOR_SERVICE = (
 )
 
 
+# Register the GATT services (the distance characteristic) on the session of
+# ble, once; later calls return the same handles. Relays call it once their
+# first scan is under way, so that booting does not wait on the GATT table but
+# a central that connects finds the services in every relay mode.
+def register_services(ble):
+    return get_session(ble).register((_AUTORANGING_SERVICE,))
+
+
 class BLEPing:
-    def __init__(self, ble, mfg=None, name=None, hopCount=0, distance=None, sender=None, messageID=0):
+    def __init__(self, ble, mfg=None, name=None, hopCount=0, distance=None, sender=None, messageID=0, compact=False):
         self._ble = ble
-        self._ble.active(True)
-        self._ble.irq(self._irq)
-        ((self._handle,),) = self._ble.gatts_register_services((_AUTORANGING_SERVICE,))
+        # Services are registered once per session, not per instance, by
+        # register_services()
+        self._session = attach(ble, _GATTS_EVENTS, self._irq)
+        self._handle = None
         self._connections = set()
-        self._payload = advertising_payload(
-            services=[_AUTORANGING_UUID],
-            name=name,
-            manufacturer_data=mfg,
-            hopCount=int(hopCount),
-            distance=float(distance) if distance is not None else None,
-            sender=sender,
-            messageID=int(messageID)
+        self._buffer_len = 0
+        self._mfg = mfg
+        self._fragments = None
+        self._acks = None
+        # Advertising interval and how long each message is advertised for
+        self.interval_us = _ADV_INTERVAL_US
+        self.dwell_ms = _DWELL_MS
+        if compact:
+            # Single manufacturer record with the versioned mesh header
+            self._template = CompactTemplate(manufacturer_data=mfg, name=name or 0)
+        else:
+            self._template = PayloadTemplate(
+                manufacturer_data=mfg,
+                services=[_AUTORANGING_UUID],
+                name=name or 0,
+            )
+        self._payload = self._template.patch(
+            int(hopCount),
+            sender or 0,
+            int(messageID),
+            distance=distance
         )
 
     def _irq(self, event, data):
@@ -66,23 +103,193 @@ class BLEPing:
         elif event == _IRQ_GATTS_INDICATE_DONE:
             conn_handle, value_handle, status = data
 
-    def _advertise(self, interval_us=100000):
-        self._ble.gap_advertise(interval_us, adv_data=self._payload)
-        print(self._payload)
-        time.sleep(1)
+    def _advertise(self, interval_us=None):
+        self._ble.gap_advertise(self.interval_us if interval_us is None else interval_us, adv_data=self._payload)
+        start = time.ticks_ms()
+        time.sleep_ms(self.dwell_ms)
         self._ble.gap_advertise(None)
-        print('broadcast stopped')
+        self._advertised(start)
+
+    def _advertised(self, start):
+        dwell = time.ticks_diff(time.ticks_ms(), start)
+        metrics.counts[ADVERTISED] += 1
+        metrics.counts[ADV_MS] += dwell
+        metrics.observe(ADV_DWELL_MS, dwell)
     
     def blePing(self):
         self._advertise()
 
+    # Load another message into the same payload buffer and return it. A
+    # fragment (header and data) goes out in a separate fragment buffer, and
+    # an acknowledgement of message ack in a separate ACK buffer.
+    def set_message(self, name, hopCount, distance, sender, messageID, ttl=0, ack=None, fragment=None):
+        if fragment is not None:
+            if self._fragments is None:
+                self._fragments = FragmentTemplate(self._mfg, EXT_ADV_MAX)
+            return self._fragments.patch(int(hopCount), sender or 0, int(messageID), name=name or 0,
+                                         distance=distance, ttl=ttl or 0, fragment=fragment)
+        if ack is not None:
+            if self._acks is None:
+                self._acks = CompactTemplate(self._mfg, data_len=ACK_DATA_LEN)
+            return self._acks.patch(int(hopCount), sender or 0, int(messageID), name=name or 0,
+                                    distance=distance, ttl=ttl or 0, ack=ack)
+        return self._template.patch(
+            int(hopCount),
+            sender or 0,
+            int(messageID),
+            name=name or 0,
+            distance=distance,
+            ttl=ttl or 0
+        )
+
+    # Relay another message through the same payload buffer.
+    def forward(self, name, hopCount, distance, sender, messageID):
+        self.set_message(name, hopCount, distance, sender, messageID)
+        metrics.counts[FORWARDED] += 1
+        self._advertise()
+
+    # Non-blocking advertise for asyncio callers: the dwell is awaited.
+    # payload overrides the template, e.g. for aggregated messages.
+    async def advertise(self, dwell_ms=None, interval_us=None, payload=None):
+        self._ble.gap_advertise(self.interval_us if interval_us is None else interval_us,
+                                adv_data=self._payload if payload is None else payload)
+        start = time.ticks_ms()
+        try:
+            await asyncio.sleep_ms(self.dwell_ms if dwell_ms is None else dwell_ms)
+        finally:
+            self._ble.gap_advertise(None)
+            self._advertised(start)
+
+    # Handle of the distance characteristic, registering the services if the
+    # relay has not yet.
+    def _value_handle(self):
+        if self._handle is None:
+            ((self._handle,),) = register_services(self._ble)
+        return self._handle
+
+    # Put data (e.g. a metrics snapshot) in the distance characteristic and
+    # notify connected centrals. Notifications carry what fits in the MTU;
+    # a read returns the whole value.
+    def publish(self, data):
+        handle = self._value_handle()
+        if len(data) > self._buffer_len:
+            self._ble.gatts_set_buffer(handle, len(data))
+            self._buffer_len = len(data)
+        self._ble.gatts_write(handle, data)
+        for conn_handle in self._connections:
+            self._ble.gatts_notify(conn_handle, handle)
+
+
+# Rotates several payloads through the advertiser: each advertising event
+# carries the next active payload, so N pending messages share one advertising
+# window instead of taking a dwell each. Payloads are copied into a fixed pool
+# of slots and retired after `repeats` events or at their deadline.
+class AdvertisingScheduler:
+    def __init__(self, ble, interval_us=100000, slots=8, max_len=31):
+        self._ble = ble
+        self.interval_us = interval_us
+        self._bufs = [bytearray(max_len) for _ in range(slots)]
+        self._views = [memoryview(b) for b in self._bufs]
+        self._lens = array('B', bytes(slots))
+        self._repeats = array('H', bytes(2 * slots))
+        self._deadlines = array('i', bytes(4 * slots))
+        self._has_deadline = bytearray(slots)
+        self._next = 0
+        self._active = 0
+        self._ready = asyncio.ThreadSafeFlag()
+        self._space = asyncio.ThreadSafeFlag()
+        self.events = 0
+        self.expired = 0
+
+    def __len__(self):
+        return self._active
+
+    def full(self):
+        return self._active == len(self._bufs)
+
+    # Queue payload for `repeats` advertising events, or until deadline_ms
+    # from now if that comes first. Returns False when every slot is busy.
+    def add(self, payload, repeats=3, deadline_ms=None):
+        lens = self._lens
+        for slot in range(len(self._bufs)):
+            if not lens[slot]:
+                break
+        else:
+            return False
+        n = len(payload)
+        self._bufs[slot][:n] = payload
+        lens[slot] = n
+        self._repeats[slot] = max(repeats, 1)
+        self._has_deadline[slot] = deadline_ms is not None
+        if deadline_ms is not None:
+            self._deadlines[slot] = time.ticks_add(time.ticks_ms(), deadline_ms)
+        self._active += 1
+        self._ready.set()
+        return True
+
+    async def wait_space(self):
+        while self.full():
+            await self._space.wait()
+
+    def _retire(self, slot):
+        self._lens[slot] = 0
+        self._active -= 1
+        self._space.set()
+
+    # Next active slot after the last one served, dropping any past their
+    # deadline; -1 if there is none.
+    def _pick(self):
+        lens = self._lens
+        size = len(lens)
+        now = time.ticks_ms()
+        for i in range(size):
+            slot = (self._next + i) % size
+            if not lens[slot]:
+                continue
+            if self._has_deadline[slot] and time.ticks_diff(now, self._deadlines[slot]) >= 0:
+                self._retire(slot)
+                self.expired += 1
+                continue
+            self._next = (slot + 1) % size
+            return slot
+        return -1
+
+    # interval_us is read afresh for every slot, so changes to it (from a
+    # duty-cycle controller) apply from the next one.
+    async def run(self):
+        advertising = False
+        try:
+            while True:
+                slot = self._pick()
+                if slot < 0:
+                    if advertising:
+                        self._ble.gap_advertise(None)
+                        advertising = False
+                    await self._ready.wait()
+                    continue
+                # Restarting with new data makes the next event carry it
+                interval_us = self.interval_us
+                interval_ms = max(interval_us // 1000, 1)
+                self._ble.gap_advertise(interval_us, adv_data=self._views[slot][:self._lens[slot]])
+                advertising = True
+                self.events += 1
+                slot_ms = max(interval_ms - 1 - random.getrandbits(8) % (_SLOT_JITTER_MS + 1), 1)
+                await asyncio.sleep_ms(slot_ms)
+                metrics.counts[ADVERTISED] += 1
+                metrics.counts[ADV_MS] += slot_ms
+                self._repeats[slot] -= 1
+                if not self._repeats[slot]:
+                    self._retire(slot)
+        finally:
+            self._ble.gap_advertise(None)
+
 
 class BLEDeviceInit:
     def __init__(self, ble, device_type=None, manufacturer=None):
         self._ble = ble
-        self._ble.active(True)
-        self._ble.irq(self._irq)
-        ((self._handle,),) = self._ble.gatts_register_services((_AUTORANGING_SERVICE,))
+        # Services are registered once per session, not per instance
+        self._session = attach(ble, _GATTS_EVENTS, self._irq, (_AUTORANGING_SERVICE,))
+        ((self._handle,),) = self._session.handles
         self._connections = set()
         self._payload = advertising_payload(
             device_type=device_type,
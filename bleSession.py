@@ -0,0 +1,56 @@
+# Long-lived radio session.
+#
+# One BLESession owns the BLE object for the life of the node: it activates the
+# radio, binds the IRQ once and registers the GATT services once. Scanner and
+# advertiser roles attach handlers for the events they care about and the
+# session routes each IRQ to its handler, so creating a role no longer
+# re-registers services or steals the IRQ from another role.
+
+import bluetooth
+
+_session = None
+
+
+class BLESession:
+    def __init__(self, ble=None):
+        self.ble = ble if ble is not None else bluetooth.BLE()
+        self.ble.active(True)
+        self.handles = None
+        self._handlers = {}
+        self.ble.irq(self._irq)
+
+    # Register the GATT table on first use; later calls reuse its handles.
+    def register(self, services):
+        if self.handles is None:
+            self.handles = self.ble.gatts_register_services(services)
+        return self.handles
+
+    def on(self, events, handler):
+        for event in events:
+            self._handlers[event] = handler
+
+    def off(self, handler):
+        for event in [e for e, h in self._handlers.items() if h == handler]:
+            del self._handlers[event]
+
+    def _irq(self, event, data):
+        handler = self._handlers.get(event)
+        if handler is not None:
+            handler(event, data)
+
+
+# Session for ble, created on first use. ble defaults to the radio of the
+# current session (or bluetooth.BLE() if there is none yet).
+def get_session(ble=None):
+    global _session
+    if _session is None or (ble is not None and _session.ble is not ble):
+        _session = BLESession(ble)
+    return _session
+
+
+def attach(ble, events, handler, services=None):
+    session = get_session(ble)
+    session.on(events, handler)
+    if services is not None:
+        session.register(services)
+    return session
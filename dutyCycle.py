@@ -0,0 +1,109 @@
+# Adaptive scan and advertising parameters.
+#
+# The controller is sampled once a period (MeshNode does it from its
+# housekeeping task) with the number of relays waiting, and reads the scan
+# counters from metrics. From the packet arrival rate and the pending relays
+# it derives a load level between 0 (idle) and 1 (busy): it rises as soon as
+# traffic does and falls back slowly, so a burst is not followed by a scan
+# gap. With the level:
+#   - the scan interval shortens from idle_scan_interval_us towards
+#     busy_scan_interval_us and the share of it spent listening grows from
+#     min_duty towards max_duty (max_duty bounds the radio's power draw,
+#     idle_scan_interval_us the longest gap in listening, i.e. latency)
+#   - the advertising interval shortens from max_adv_interval_us towards
+#     min_adv_interval_us, so a backlog of relays drains faster
+# The dwell covers a number of advertising events that falls from max_events
+# to min_events as the duplicate ratio rises: when most packets are repeats
+# the neighbourhood already carries each message many times over. Scan
+# parameters only change when they move by more than a tenth, as applying
+# them restarts the scan.
+
+from metrics import metrics, SCANNED, DUPLICATES, ACCEPTED
+
+_RISE = 0.5
+_FALL = 0.125
+_SCAN_HYSTERESIS = 0.1
+
+
+def _lerp(idle, busy, level):
+    return idle + (busy - idle) * level
+
+
+class DutyCycleController:
+    def __init__(self, busy_rate=20, busy_pending=4, min_duty=0.25, max_duty=0.9,
+                 idle_scan_interval_us=100000, busy_scan_interval_us=10000,
+                 max_adv_interval_us=100000, min_adv_interval_us=20000,
+                 min_events=2, max_events=5, min_dwell_ms=50, max_dwell_ms=1000):
+        if not 0 < min_duty <= max_duty <= 1:
+            raise ValueError("duty bounds must satisfy 0 < min_duty <= max_duty <= 1")
+        self.busy_rate = busy_rate
+        self.busy_pending = busy_pending
+        self.min_duty = min_duty
+        self.max_duty = max_duty
+        self.idle_scan_interval_us = idle_scan_interval_us
+        self.busy_scan_interval_us = busy_scan_interval_us
+        self.max_adv_interval_us = max_adv_interval_us
+        self.min_adv_interval_us = min_adv_interval_us
+        self.min_events = min_events
+        self.max_events = max_events
+        self.min_dwell_ms = min_dwell_ms
+        self.max_dwell_ms = max_dwell_ms
+        self.rate = 0.0
+        self.duplicate_ratio = 0.0
+        self.level = 0.0
+        self.scan_interval_us = 0
+        self.scan_window_us = 0
+        self.adv_interval_us = 0
+        self.dwell_ms = 0
+        self.scan_changes = 0
+        counts = metrics.counts
+        self._scanned = counts[SCANNED]
+        self._duplicates = counts[DUPLICATES]
+        self._accepted = counts[ACCEPTED]
+        self._apply(0.0, 0.0)
+
+    # Take a sample elapsed_ms after the previous one, with pending relays
+    # waiting. Returns True if the scan parameters changed.
+    def update(self, pending, elapsed_ms):
+        counts = metrics.counts
+        scanned = counts[SCANNED] - self._scanned
+        duplicates = counts[DUPLICATES] - self._duplicates
+        accepted = counts[ACCEPTED] - self._accepted
+        self._scanned = counts[SCANNED]
+        self._duplicates = counts[DUPLICATES]
+        self._accepted = counts[ACCEPTED]
+        rate = scanned * 1000 / max(elapsed_ms, 1)
+        self.rate += (rate - self.rate) * (_RISE if rate > self.rate else _FALL)
+        if duplicates + accepted:
+            ratio = duplicates / (duplicates + accepted)
+            self.duplicate_ratio += (ratio - self.duplicate_ratio) * _RISE
+        level = max(min(self.rate / self.busy_rate, 1.0), min(pending / self.busy_pending, 1.0))
+        return self._apply(level, self.duplicate_ratio)
+
+    def _apply(self, level, duplicate_ratio):
+        self.level = level
+        self.adv_interval_us = int(_lerp(self.max_adv_interval_us, self.min_adv_interval_us, level))
+        events = _lerp(self.max_events, self.min_events, duplicate_ratio)
+        dwell = int(events * self.adv_interval_us / 1000)
+        self.dwell_ms = min(max(dwell, self.min_dwell_ms), self.max_dwell_ms)
+        interval = int(_lerp(self.idle_scan_interval_us, self.busy_scan_interval_us, level))
+        window = int(interval * _lerp(self.min_duty, self.max_duty, level))
+        if (abs(interval - self.scan_interval_us) <= self.scan_interval_us * _SCAN_HYSTERESIS
+                and abs(window - self.scan_window_us) <= self.scan_window_us * _SCAN_HYSTERESIS):
+            return False
+        self.scan_interval_us = interval
+        self.scan_window_us = window
+        self.scan_changes += 1
+        return True
+
+    def stats(self):
+        return {
+            'level': round(self.level, 2),
+            'rate': round(self.rate, 1),
+            'duplicate_ratio': round(self.duplicate_ratio, 2),
+            'scan_interval_us': self.scan_interval_us,
+            'scan_window_us': self.scan_window_us,
+            'adv_interval_us': self.adv_interval_us,
+            'dwell_ms': self.dwell_ms,
+            'scan_changes': self.scan_changes,
+        }
@@ -0,0 +1,534 @@
+# Host-side gateway ingest: decodes captured mesh advertisements in bulk with
+# NumPy. CPython only; the node code never imports this.
+#
+# A capture is a scan trace as scanTrace.TraceWriter records it on a node
+# (main._TRACE_FILE), read from a file, a pipe or a serial port: an 8-byte
+# header, b'SCTR', the format version and 3 reserved bytes, then one
+# little-endian record per scan result:
+#   0-3   microseconds since the previous record (u32)
+#   4     addr_type
+#   5     adv_type
+#   6     rssi (i8)
+#   7     length N of adv_data
+#   8-13  advertiser address
+#   14-   adv_data (N bytes)
+#
+# decode_batch() walks the AD records of a whole batch at once (one vectorised
+# step per record position rather than one Python loop per packet), accepting
+# and rejecting packets exactly as advertisementPacket.decode_adv does, and
+# returns one row per message record: legacy and compact packets give one,
+# aggregates one per record they carry.
+#
+#   python gateway.py trace.bin [--mfg 0x0102] [--dedup] [--json]
+#   python gateway.py --synth 1000000 trace.bin
+
+import json
+import os
+import select
+import struct
+import sys
+import time
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+TRACE_VERSION = 1
+_TRACE_MAGIC = b'SCTR'
+_TRACE_HEADER_LEN = 8
+_RECORD_HEADER = 14
+_RECORD_DTYPE = np.dtype([
+    ('delta', '<u4'),
+    ('addr_type', 'u1'),
+    ('adv_type', 'u1'),
+    ('rssi', 'i1'),
+    ('len', 'u1'),
+    ('mac', 'u1', 6),
+])
+
+# One per scan result; ts_us counts from the start of the trace, and the
+# advertisement is data[offset:offset + len] of the batch read_trace() yields
+# it in.
+FRAME_DTYPE = np.dtype([
+    ('ts_us', '<u8'),
+    ('addr_type', 'u1'),
+    ('adv_type', 'u1'),
+    ('mac', '<u8'),
+    ('rssi', 'i1'),
+    ('len', 'u1'),
+    ('offset', '<i8'),
+])
+
+# Absent fields are -1 (NaN for distance), values too wide for 63 bits -2;
+# ttl is -1 for legacy packets and ack, the acknowledged message ID, -1 for
+# anything but an acknowledgement. Legacy records carry values of any width,
+# so hop, sender, name and message_id are 64-bit.
+RECORD_DTYPE = np.dtype([
+    ('ts_us', '<u8'),
+    ('mac', '<u8'),
+    ('rssi', 'i1'),
+    ('mfg', '<i4'),
+    ('hop', '<i8'),
+    ('ttl', 'i1'),
+    ('distance', '<f8'),
+    ('sender', '<i8'),
+    ('name', '<i8'),
+    ('message_id', '<i8'),
+    ('ack', '<i4'),
+])
+
+_ADV_TYPE_NAME = 0x09
+_ADV_TYPE_INT = 0x0A
+_ADV_TYPE_DIST = 0x16
+_ADV_TYPE_SENDER = 0x17
+_ADV_TYPE_ID = 0x18
+_ADV_TYPE_MANUFACTURER = 0xFF
+
+_MESH_VERSION = 1
+_MESH_AGGREGATE_VERSION = 2
+_MESH_ACK_VERSION = 3
+_MESH_FRAGMENT_VERSION = 4
+_MESH_HEADER_LEN = 14
+_ACK_DATA_LEN = 2
+_FRAGMENT_HEADER_LEN = 4
+_MESH_RECORD_LEN = 9
+_AGGREGATE_HEADER_LEN = 6
+_MESH_DIST_UNKNOWN = 0xFFFF
+
+_ABSENT = -1
+_TOO_WIDE = -2
+# Bytes kept after the last advertisement of a batch, so the fixed-offset
+# reads of a header that turns out too short stay in bounds (what they read
+# there is never used)
+_SPARE = _MESH_HEADER_LEN + _FRAGMENT_HEADER_LEN
+
+# Slots of the record walk: where the last record of each legacy type sits.
+# _SLOTS maps an AD type to its slot, any other type to the spare one.
+_LEGACY_FIELDS = (('hop', 0), ('sender', 1), ('name', 2), ('message_id', 3))
+_SLOT_DIST = 4
+_SLOT_COUNT = 5
+_SLOTS = np.full(256, _SLOT_COUNT, np.intp)
+for _slot, _adv_type in enumerate((_ADV_TYPE_INT, _ADV_TYPE_SENDER, _ADV_TYPE_NAME, _ADV_TYPE_ID, _ADV_TYPE_DIST)):
+    _SLOTS[_adv_type] = _slot
+
+# How long to wait for a non-blocking source that select() cannot poll
+_POLL_S = 0.01
+
+
+def trace_header():
+    return _TRACE_MAGIC + bytes((TRACE_VERSION, 0, 0, 0))
+
+
+def pack_record(delta_us, mac, rssi, adv_data, addr_type=0, adv_type=0):
+    if len(adv_data) > 255:
+        raise ValueError("advertisement longer than 255 bytes")
+    return struct.pack('<IBBbB6s', delta_us & 0xFFFFFFFF, addr_type, adv_type, rssi, len(adv_data),
+                       bytes(mac)) + bytes(adv_data)
+
+
+def _wait_readable(source):
+    try:
+        select.select([source], [], [])
+    except (TypeError, ValueError, OSError):
+        # No file descriptor to wait on
+        time.sleep(_POLL_S)
+
+
+def _read_into(source, view):
+    while True:
+        n = source.readinto(view)
+        if n is not None:
+            return n
+        # Non-blocking source with nothing to read yet
+        _wait_readable(source)
+
+
+# Offsets of the whole records in buf[:end], and where the first incomplete
+# one starts. Each record's length is in its own header, so this is the one
+# step that cannot be vectorised.
+def _record_starts(buf, end):
+    starts = []
+    append = starts.append
+    o = 0
+    last = end - _RECORD_HEADER
+    while o <= last:
+        append(o)
+        o += _RECORD_HEADER + buf[o + 7]
+    if o > end:
+        # The last record is cut short
+        o = starts.pop()
+    return np.array(starts, np.int64), o
+
+
+def _mac(raw):
+    value = np.zeros((len(raw), 8), np.uint8)
+    value[:, 2:] = raw
+    return value.view('>u8').ravel()
+
+
+# Yield (frames, data) batches of the scan results in a trace at a path or on
+# any binary stream with readinto() (open file, sys.stdin.buffer, serial
+# port), about batch at a time: frames is an array of FRAME_DTYPE and data
+# the bytes its advertisements are in. A record cut short at the end of the
+# stream is ignored, as scanTrace.read_trace does.
+def read_trace(source, batch=1 << 16):
+    if isinstance(source, (str, bytes, os.PathLike)):
+        with open(source, 'rb') as stream:
+            yield from read_trace(stream, batch)
+        return
+    header = bytearray(_TRACE_HEADER_LEN)
+    got = 0
+    while got < _TRACE_HEADER_LEN:
+        n = _read_into(source, memoryview(header)[got:])
+        if n == 0:
+            break
+        got += n
+    if got < _TRACE_HEADER_LEN or header[0:4] != _TRACE_MAGIC or header[4] != TRACE_VERSION:
+        raise ValueError("not a scan trace")
+    size = max(batch * (_RECORD_HEADER + 32), _RECORD_HEADER + 255)
+    buf = bytearray(size + _SPARE)
+    view = memoryview(buf)[:size]
+    filled = 0
+    ts = 0
+    while True:
+        n = _read_into(source, view[filled:])
+        if n == 0:
+            break
+        filled += n
+        starts, used = _record_starts(buf, filled)
+        if not len(starts):
+            continue
+        # A copy, so the batch outlives the next read
+        data = np.frombuffer(buf, np.uint8, used + _SPARE).copy()
+        frames = _frames(data, starts, ts)
+        ts = int(frames['ts_us'][-1])
+        view[:filled - used] = view[used:filled]
+        filled -= used
+        yield frames, data
+
+
+def _frames(data, starts, ts):
+    raw = sliding_window_view(data, _RECORD_HEADER)[starts].view(_RECORD_DTYPE).ravel()
+    frames = np.empty(len(raw), FRAME_DTYPE)
+    frames['ts_us'] = np.cumsum(raw['delta'], dtype=np.uint64)
+    frames['ts_us'] += np.uint64(ts)
+    frames['addr_type'] = raw['addr_type']
+    frames['adv_type'] = raw['adv_type']
+    frames['mac'] = _mac(raw['mac'])
+    frames['rssi'] = raw['rssi']
+    frames['len'] = raw['len']
+    frames['offset'] = starts + _RECORD_HEADER
+    return frames
+
+
+def _be16(data, at):
+    return (data[at].astype(np.int64) << 8) | data[at + 1]
+
+
+# Which of the manufacturer records at offsets at into data, of record
+# lengths length, hold a mesh header decode_adv accepts (_decode_compact).
+def _compact_ok(data, at, length):
+    version = data[at + 4]
+    length = length.astype(np.int64)
+    ok = (version == _MESH_VERSION) & (length >= _MESH_HEADER_LEN - 1)
+    ok |= (version == _MESH_ACK_VERSION) & (length >= _MESH_HEADER_LEN + _ACK_DATA_LEN - 1)
+    i = np.flatnonzero((version == _MESH_AGGREGATE_VERSION) & (length >= _AGGREGATE_HEADER_LEN - 1))
+    if len(i):
+        records = data[at[i] + 5].astype(np.int64)
+        ok[i] = (records > 0) & (length[i] >= _AGGREGATE_HEADER_LEN - 1 + records * _MESH_RECORD_LEN)
+    i = np.flatnonzero((version == _MESH_FRAGMENT_VERSION)
+                       & (length >= _MESH_HEADER_LEN + _FRAGMENT_HEADER_LEN - 1))
+    if len(i):
+        f = at[i] + _MESH_HEADER_LEN
+        index = data[f].astype(np.int64)
+        count = data[f + 1].astype(np.int64)
+        total = _be16(data, f + 2)
+        stride = (total + count - 1) // np.maximum(count, 1)
+        n = np.minimum(stride, total - index * stride)
+        ok[i] = (index < count) & (n >= 0) & (length[i] >= _MESH_HEADER_LEN + _FRAGMENT_HEADER_LEN - 1 + n)
+    return ok
+
+
+# Big-endian values of the legacy records at offsets at into data, as decode_adv
+# reads them: any width, -2 when that is over 63 bits.
+def _legacy_values(data, at):
+    size = data[at].astype(np.int64) - 1
+    value = np.zeros(len(at), np.uint64)
+    wide = np.zeros(len(at), bool)
+    for j in range(int(size.max(initial=0))):
+        # Only the records this long, so reads stay inside them
+        i = np.flatnonzero(j < size)
+        if j >= 7:
+            # Only an eighth byte can push a value past 63 bits
+            wide[i] |= (value[i] >> np.uint64(55)) != 0
+        value[i] = (value[i] << np.uint64(8)) | data[at[i] + 2 + j]
+    return np.where(wide, _TOO_WIDE, value.astype(np.int64))
+
+
+# Decode a batch from read_trace() into an array of RECORD_DTYPE. target_mfg
+# keeps only packets with that 16-bit manufacturer value, like decode_adv.
+def decode_batch(frames, data, target_mfg=None):
+    n = len(frames)
+    start = frames['offset']
+    end = start + frames['len']
+
+    # Walk the AD records of every packet in lockstep, as decode_adv does,
+    # noting the offset of the last record of each legacy type: a malformed
+    # or foreign manufacturer record rejects the packet, one holding a mesh
+    # header ends the walk, any other leaves the walk going. Offsets are into
+    # data.
+    mfg = np.full(n, _ABSENT, np.int64)
+    mesh_at = np.full(n, _ABSENT, np.int64)
+    rejected = np.zeros(n, bool)
+    at = np.full((_SLOT_COUNT + 1, n), _ABSENT, np.int64)
+    slots = at.reshape(-1)
+    rows = np.arange(n)
+    q = start
+    # Boolean masks are turned into indices first: indexing with them is
+    # several times slower when they are mixed
+    while len(rows):
+        length = data[q]
+        # A record holds at least its type, so this also needs q + 1 < end
+        live = (length != 0) & (q + length < end)
+        if not live.all():
+            i = np.flatnonzero(live)
+            rows, q, end, length = rows[i], q[i], end[i], length[i]
+        adv_type = data[q + 1]
+        slots[_SLOTS[adv_type] * n + rows] = q
+        step = q + length + 1
+        i = np.flatnonzero(adv_type == _ADV_TYPE_MANUFACTURER)
+        if len(i):
+            r, h, size = rows[i], q[i], length[i]
+            value = data[h + 2] | (data[h + 3].astype(np.int64) << 8)
+            bad = size < 3
+            mfg[r[~bad]] = value[~bad]
+            if target_mfg is not None:
+                bad |= value != target_mfg
+            header = np.flatnonzero(~bad & (size > 3))
+            header = header[_compact_ok(data, h[header], size[header])]
+            rejected[r[bad]] = True
+            mesh_at[r[header]] = h[header]
+            keep = np.ones(len(rows), bool)
+            keep[i[bad]] = False
+            keep[i[header]] = False
+            if not keep.all():
+                i = np.flatnonzero(keep)
+                rows, step, end = rows[i], step[i], end[i]
+        q = step
+
+    mesh = mesh_at >= 0
+    legacy = ~rejected & ~mesh
+    if target_mfg is not None:
+        legacy &= mfg >= 0
+    else:
+        legacy &= (mfg >= 0) | (at[:_SLOT_COUNT] >= 0).any(axis=0)
+    m = np.maximum(mesh_at, 0)
+    version = data[m + 4]
+    aggregate = mesh & (version == _MESH_AGGREGATE_VERSION)
+
+    # One output row per mesh or legacy packet, `count` per aggregate
+    per_row = np.where(aggregate, data[m + 5], mesh | legacy).astype(np.int64)
+    src = np.repeat(np.arange(n), per_row)
+    out = np.empty(len(src), RECORD_DTYPE)
+    out['ts_us'] = frames['ts_us'][src]
+    out['mac'] = frames['mac'][src]
+    out['rssi'] = frames['rssi'][src]
+    out['mfg'] = mfg[src]
+
+    # Fields are written through out[field][i]: out[mask][field] would be
+    # a copy
+    i = np.flatnonzero(mesh[src])
+    if len(i):
+        r = src[i]
+        first = np.cumsum(per_row) - per_row
+        k = i - first[r]
+        record = m[r] + np.where(aggregate[r], _AGGREGATE_HEADER_LEN + k * _MESH_RECORD_LEN, 5)
+        b = data[record]
+        out['hop'][i] = b >> 4
+        out['ttl'][i] = b & 0x0F
+        # sender, message ID, name and distance: big-endian 16-bit pairs
+        fields = sliding_window_view(data, _MESH_RECORD_LEN - 1)[record + 1].view('>u2')
+        out['sender'][i] = fields[:, 0]
+        out['message_id'][i] = fields[:, 1]
+        out['name'][i] = fields[:, 2]
+        cm = fields[:, 3]
+        out['distance'][i] = np.where(cm == _MESH_DIST_UNKNOWN, np.nan, cm / 100)
+        out['ack'][i] = _ABSENT
+        ack = version[r] == _MESH_ACK_VERSION
+        if ack.any():
+            out['ack'][i[ack]] = _be16(data, m[r[ack]] + _MESH_HEADER_LEN)
+
+    i = np.flatnonzero(legacy[src])
+    if len(i):
+        r = src[i]
+        out['ttl'][i] = _ABSENT
+        out['ack'][i] = _ABSENT
+        for field, slot in _LEGACY_FIELDS:
+            where = at[slot, r]
+            present = where >= 0
+            if field != 'name':
+                # Records with no data read as absent, except the name
+                present[present] = data[where[present]] > 1
+            values = np.full(len(r), _ABSENT, np.int64)
+            values[present] = _legacy_values(data, where[present])
+            out[field][i] = values
+        where = at[_SLOT_DIST, r]
+        present = where >= 0
+        where = np.where(present, where, 0)
+        present &= data[where] == 5
+        raw = data[where[:, None] + 2 + np.arange(4)].view('<f4').ravel()
+        out['distance'][i] = np.where(present, raw, np.nan)
+    return out
+
+
+def _keys(records):
+    sender = records['sender'].astype(np.uint64) & np.uint64(0xFFFFFFFF)
+    return (sender << np.uint64(32)) | (records['message_id'].astype(np.uint64) & np.uint64(0xFFFFFFFF))
+
+
+# Drops repeated copies of a message across batches: a record is a duplicate
+# when the previous copy of its (sender, messageID) was seen less than
+# window_ms earlier, so IDs reused after the window count as new messages.
+class Deduper:
+    def __init__(self, window_ms=60000):
+        self.window_ms = window_ms
+        self._keys = np.empty(0, np.uint64)
+        self._last = np.empty(0, np.int64)
+        self.duplicates = 0
+
+    def __call__(self, records):
+        if not len(records):
+            return records
+        window = self.window_ms * 1000
+        keys = _keys(records)
+        ts = records['ts_us'].astype(np.int64)
+        order = np.lexsort((ts, keys))
+        k = keys[order]
+        t = ts[order]
+        new_key = np.empty(len(k), bool)
+        new_key[0] = True
+        new_key[1:] = k[1:] != k[:-1]
+        prev = np.empty(len(t), np.int64)
+        prev[1:] = t[:-1]
+        # First copy in this batch: compare with the last one seen before
+        i = np.searchsorted(self._keys, k[new_key])
+        i = np.minimum(i, max(len(self._keys) - 1, 0))
+        known = (self._keys[i] == k[new_key]) if len(self._keys) else np.zeros(len(i), bool)
+        carried = np.where(known, self._last[i] if len(self._last) else 0, np.iinfo(np.int64).min // 2)
+        prev[new_key] = carried
+        keep = np.zeros(len(records), bool)
+        keep[order] = t - prev >= window
+        self.duplicates += len(records) - int(keep.sum())
+
+        # Carry the latest time per key, forgetting keys past the window
+        last = np.empty(len(k), bool)
+        last[-1] = True
+        last[:-1] = k[1:] != k[:-1]
+        keys_all = np.concatenate((self._keys, k[last]))
+        last_all = np.concatenate((self._last, t[last]))
+        o = np.lexsort((last_all, keys_all))
+        keys_all = keys_all[o]
+        last_all = last_all[o]
+        final = np.empty(len(keys_all), bool)
+        final[-1] = True
+        final[:-1] = keys_all[1:] != keys_all[:-1]
+        fresh = final & (last_all > t.max() - window)
+        self._keys = keys_all[fresh]
+        self._last = last_all[fresh]
+        return records[keep]
+
+
+# Decoded (and optionally deduplicated) record batches from a trace source.
+def ingest(source, target_mfg=None, dedup=False, window_ms=60000, batch=1 << 16):
+    deduper = Deduper(window_ms) if dedup else None
+    for frames, data in read_trace(source, batch):
+        records = decode_batch(frames, data, target_mfg)
+        yield deduper(records) if deduper is not None else records
+
+
+# Synthetic trace of count scan results mixing compact, aggregate and legacy
+# packets, for throughput tests. Built from the node's own encoders.
+def synthesize(path, count, seed=1):
+    try:
+        import bluetooth
+    except ImportError:
+        import meshSim
+        meshSim.install_host_modules()
+        import bluetooth
+    from advertisementPacket import PayloadTemplate, CompactTemplate, AggregateTemplate
+
+    mfg = bluetooth.UUID(0x0102)
+    legacy = PayloadTemplate(mfg, name=0x1234, distance=7.94)
+    compact = CompactTemplate(mfg, name=0x1234, distance=7.94)
+    aggregate = AggregateTemplate(mfg)
+    samples = []
+    for i in range(64):
+        sender = 0x5000 + i % 8
+        if i % 3 == 0:
+            adv = bytes(legacy.patch(5 - i % 5, sender, i))
+        elif i % 3 == 1:
+            adv = bytes(compact.patch(5 - i % 5, sender, i, distance=7.94, ttl=5))
+        else:
+            aggregate.clear()
+            aggregate.add(4, sender, i, 0x1234, 3.5, 5)
+            aggregate.add(3, sender, i + 1000, 0x1234, None, 5)
+            adv = bytes(aggregate.payload())
+        samples.append(pack_record(100, b'\x28\xcd\xc1\x00\x00' + bytes((i,)), -60 - i % 30, adv))
+    rng = np.random.default_rng(seed)
+    with open(path, 'wb') as f:
+        f.write(trace_header())
+        for start in range(0, count, 1 << 16):
+            picks = rng.integers(0, len(samples), min(1 << 16, count - start))
+            f.write(b''.join([samples[i] for i in picks]))
+
+
+def summarize(records):
+    senders, counts = np.unique(records['sender'], return_counts=True)
+    return {
+        'records': int(len(records)),
+        'messages': int(len(np.unique(_keys(records)))),
+        'senders': {int(s): int(c) for s, c in zip(senders, counts)},
+        'rssi_mean': float(records['rssi'].mean()) if len(records) else None,
+        'hop_max': int(records['hop'].max()) if len(records) else None,
+    }
+
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description='Decode scan traces of mesh advertisements in bulk.')
+    parser.add_argument('source', help="scan trace file, or '-' for stdin")
+    parser.add_argument('--mfg', type=lambda s: int(s, 0), default=None, help='16-bit manufacturer value to keep')
+    parser.add_argument('--dedup', action='store_true')
+    parser.add_argument('--window', type=int, default=60000, help='dedup window in ms')
+    parser.add_argument('--synth', type=int, default=None, metavar='N', help='write N synthetic scan results to source instead')
+    parser.add_argument('--json', action='store_true')
+    args = parser.parse_args(argv)
+
+    if args.synth is not None:
+        synthesize(args.source, args.synth)
+        return None
+
+    source = sys.stdin.buffer if args.source == '-' else args.source
+    deduper = Deduper(args.window) if args.dedup else None
+    start = time.perf_counter()
+    frames = 0
+    batches = []
+    for batch, data in read_trace(source):
+        frames += len(batch)
+        records = decode_batch(batch, data, args.mfg)
+        batches.append(deduper(records) if deduper is not None else records)
+    elapsed = time.perf_counter() - start
+    records = np.concatenate(batches) if batches else np.empty(0, RECORD_DTYPE)
+    report = summarize(records)
+    report['frames'] = frames
+    report['seconds'] = round(elapsed, 3)
+    report['frames_per_s'] = int(frames / elapsed) if elapsed else None
+    if args.json:
+        print(json.dumps(report))
+    else:
+        print('%d frames -> %d records, %d messages in %.3f s (%d frames/s)' % (
+            frames, report['records'], report['messages'], elapsed, report['frames_per_s'] or 0))
+    return report
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,135 @@
+# Measures how long BLENode._irq takes per scan result, comparing the inline
+# decode path with the deferred ScanRing path, and how many results a busy
+# main loop loses with the scheduled drain versus the second-core drain of
+# threaded mode. Runs on the device or, with the meshSim stand-ins, under
+# CPython (threads standing in for the second core).
+#
+#   python irqBench.py
+
+try:
+    import bluetooth
+except ImportError:
+    import meshSim
+    meshSim.install_host_modules()
+    import bluetooth
+
+import sys
+import time
+import readScan
+from advertisementPacket import advertising_payload
+
+_IRQ_SCAN_RESULT = 5
+
+_TELESCOPE_UUID = bluetooth.UUID(0x0102)
+_OTHER_UUID = bluetooth.UUID(0x0304)
+
+
+# A mix of new messages, duplicates and foreign packets, as seen in a dense mesh.
+def make_packets(count):
+    packets = []
+    addr = memoryview(b'\x28\xcd\xc1\x00\x00\x01')
+    for i in range(count):
+        if i % 4 == 3:
+            mfg = _OTHER_UUID
+        else:
+            mfg = _TELESCOPE_UUID
+        payload = advertising_payload(
+            name=0x1234,
+            manufacturer_data=mfg,
+            services=[bluetooth.UUID(0x0001)],
+            hopCount=3,
+            distance=7.94,
+            sender=0x5678,
+            messageID=1 + (i // 2),
+        )
+        packets.append((0, addr, 0, -60, memoryview(bytes(payload))))
+    return packets
+
+
+def measure(node, packets, drain=None):
+    durations = []
+    for data in packets:
+        start = time.ticks_us()
+        node._irq(_IRQ_SCAN_RESULT, data)
+        durations.append(time.ticks_diff(time.ticks_us(), start))
+        if drain is not None:
+            drain()
+    durations.sort()
+    n = len(durations)
+    return {
+        'mean_us': sum(durations) / n,
+        'p50_us': durations[n // 2],
+        'p99_us': durations[min(n - 1, n * 99 // 100)],
+        'max_us': durations[-1],
+    }
+
+
+def run(count=400):
+    ble = bluetooth.BLE()
+    packets = make_packets(count)
+
+    inline = readScan.BLENode(ble, _TELESCOPE_UUID)
+    inline.scan_continuous(deferred=False)
+    before = measure(inline, packets)
+    inline.stop_scan()
+
+    deferred = readScan.BLENode(ble, _TELESCOPE_UUID)
+    queue = deferred.scan_continuous(deferred=True)
+
+    def drain():
+        # Sleeping lets the scheduled _drain run before the next result
+        time.sleep_ms(0)
+        while queue.get() is not None:
+            pass
+
+    after = measure(deferred, packets, drain)
+    deferred.stop_scan()
+    return {'inline': before, 'deferred': after}
+
+
+# Results arriving while the main loop works for work_us between them and
+# only yields (letting scheduled callbacks run) every busy_ms. Returns the
+# fraction of results dropped by the full ring, for the scheduled drain and
+# for threaded mode.
+def busy_loss(count=2000, work_us=100, busy_ms=20):
+    ble = bluetooth.BLE()
+    packets = make_packets(count)
+    if hasattr(sys, 'setswitchinterval'):
+        # CPython hands the GIL over every 5 ms by default, far too seldom to
+        # stand in for a core running in parallel
+        switch = sys.getswitchinterval()
+        sys.setswitchinterval(0.00005)
+    result = {}
+    try:
+        for mode in ('deferred', 'threaded'):
+            node = readScan.BLENode(ble, _TELESCOPE_UUID)
+            queue = node.scan_continuous(threaded=mode == 'threaded')
+            ring = node._ring
+            yielded = time.ticks_ms()
+            for data in packets:
+                node._irq(_IRQ_SCAN_RESULT, data)
+                start = time.ticks_us()
+                while time.ticks_diff(time.ticks_us(), start) < work_us:
+                    pass
+                if time.ticks_diff(time.ticks_ms(), yielded) >= busy_ms:
+                    time.sleep_ms(0)
+                    yielded = time.ticks_ms()
+                while queue.get() is not None:
+                    pass
+            result[mode] = ring.dropped / count
+            node.stop_scan()
+    finally:
+        if hasattr(sys, 'setswitchinterval'):
+            sys.setswitchinterval(switch)
+    return result
+
+
+if __name__ == "__main__":
+    result = run()
+    for mode in ('inline', 'deferred'):
+        r = result[mode]
+        print('%-8s mean %.1f us  p50 %d us  p99 %d us  max %d us' % (
+            mode, r['mean_us'], r['p50_us'], r['p99_us'], r['max_us']))
+    loss = busy_loss()
+    print('busy main loop: %.1f%% of results lost with the scheduled drain, %.1f%% threaded' % (
+        100 * loss['deferred'], 100 * loss['threaded']))
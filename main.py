@@ -1,17 +1,39 @@
 import bluetooth
 import time
 from machine import Pin
-from bleBroadcast import BLEPing, BLEDeviceInit
+from bleBroadcast import BLEPing, BLEDeviceInit, register_services
 import readScan
+from messageLedger import MessageLedger, LedgerStore
+from metrics import metrics, BOOT_RELAY_MS
 import asyncio
+# meshNode, scanTrace and dutyCycle are imported by main() when the settings
+# below call for them, so the scan starts sooner when they do not
 
 # Initialize BLE device
 _TELESCOPE_UUID = bluetooth.UUID(0x0102)
 deviceName = 0x1234
 device_type = 1  # Example device type
-
-# Set up LED for visual feedback
-led = Pin('LED', Pin.OUT)
+# 'runtime': asyncio MeshNode tasks; 'continuous': scan while relaying from
+# one loop; 'cycle': one scan per relay round
+_RELAY_MODE = 'runtime'
+# Decode scan results on the second core (runtime mode)
+_DUAL_CORE = False
+# Adapt scan and advertising parameters to the traffic (runtime mode)
+_ADAPTIVE = False
+# File to record every scan result to for replay on the host, or None
+_TRACE_FILE = None
+# File the message ledger is kept in across resets (runtime mode), or None
+_LEDGER_FILE = 'ledger.bin'
+
+# LED for visual feedback, set up on first use by status_led()
+led = None
+
+
+def status_led():
+    global led
+    if led is None:
+        led = Pin('LED', Pin.OUT)
+    return led
     
 
 class Advertiser:
@@ -40,7 +62,7 @@ class Advertiser:
         return self.messageID
 
 async def read(ble, deviceType):
-    scanData, ledger = readScan.runScan(ble, deviceType)
+    scanData, ledger = await readScan.scan_async(deviceType)
     print("Scan Data:", scanData)
     output = []
     for data in scanData:
@@ -54,12 +76,22 @@ async def read(ble, deviceType):
         })
     return output, ledger
 
+# Reused across forwards so relaying only patches the payload template
+_forwarder = None
+
 def respond(name, hopCount, distance, sender, messageID, ble):
+    global _forwarder
+    led = status_led()
     led.value(True)
 
     hopCount -= 1
-    message_forward = BLEPing(ble, name=name, hopCount=hopCount, mfg=_TELESCOPE_UUID, distance=distance, sender=sender, messageID=messageID)
-    message_forward.blePing()
+    if _forwarder is None or _forwarder._ble is not ble:
+        _forwarder = BLEPing(ble, name=name, hopCount=hopCount, mfg=_TELESCOPE_UUID, distance=distance, sender=sender, messageID=messageID)
+        _forwarder.blePing()
+    else:
+        _forwarder.forward(name, hopCount, distance, sender, messageID)
+    if metrics.mark(BOOT_RELAY_MS):
+        metrics.boot_report()
     time.sleep(0.001)
         
     led.value(False)
@@ -68,6 +100,7 @@ async def init_device(device_type, manufacturer):
 
     #update later once mobil app is working
 
+    led = status_led()
     led.on()  # Turn on LED for visual feedback
 
     # Initialize BLE
@@ -78,18 +111,19 @@ async def init_device(device_type, manufacturer):
     device.broadcast()
 
     
-    time.sleep_ms(10)
+    await asyncio.sleep_ms(10)
     
     led.off()  # Turn off LED
     
     # Add a small delay to prevent multiple broadcasts on a single press
-    time.sleep_ms(200)
+    await asyncio.sleep_ms(200)
     return True
 
 async def read_and_respond(ledger):
     ble = bluetooth.BLE()
     node = readScan.BLENode(ble, _TELESCOPE_UUID, ledger)
     result, ledger = await read(ble, node)
+    register_services(ble)
     if result:
         for device in result:
             # Process the message
@@ -98,8 +132,42 @@ async def read_and_respond(ledger):
     await asyncio.sleep(0.05)
     return ledger
 
+async def relay_continuous(ledger):
+    global _forwarder
+    ble = bluetooth.BLE()
+    _forwarder = BLEPing(ble, mfg=_TELESCOPE_UUID)
+    node = readScan.BLENode(ble, _TELESCOPE_UUID, ledger)
+    queue = node.scan_continuous()
+    register_services(ble)
+    while True:
+        data = queue.get()
+        if data is None:
+            await asyncio.sleep_ms(10)
+            continue
+        device = Advertiser(data)
+        respond(name=device.getName(), hopCount=device.getHops(), distance=device.getDistance(), sender=device.getSender(), messageID=device.getMessageID(), ble=ble)
+
 async def main():
-    ledger = []
+    ledger = MessageLedger()
+    if _RELAY_MODE == 'runtime':
+        from meshNode import MeshNode
+        trace = None
+        if _TRACE_FILE:
+            from scanTrace import TraceWriter
+            trace = TraceWriter(open(_TRACE_FILE, 'wb'))
+        store = None
+        if _LEDGER_FILE:
+            # Messages relayed before a reset are not relayed again
+            store = LedgerStore(ledger, _LEDGER_FILE)
+            store.load()
+        duty_cycle = None
+        if _ADAPTIVE:
+            from dutyCycle import DutyCycleController
+            duty_cycle = DutyCycleController()
+        await MeshNode(bluetooth.BLE(), _TELESCOPE_UUID, ledger, dual_core=_DUAL_CORE, trace=trace, store=store,
+                       duty_cycle=duty_cycle).run()
+    elif _RELAY_MODE == 'continuous':
+        await relay_continuous(ledger)
     while True:
         ledger = await read_and_respond(ledger)
 
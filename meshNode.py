@@ -0,0 +1,499 @@
+# asyncio node runtime.
+#
+# Scanning, relaying, the status LED and housekeeping run as cooperating tasks
+# on one BLE object, and none of them block: the radio scans continuously and
+# the scan path wakes the relay task through a ThreadSafeFlag, while the
+# advertising dwell and LED pulse are awaited rather than slept.
+
+import asyncio
+import bluetooth
+import time
+try:
+    import _thread
+except ImportError:
+    _thread = None
+from machine import Pin
+from micropython import const
+import readScan
+from bleBroadcast import BLEPing, AdvertisingScheduler, register_services
+from advertisementPacket import AggregateTemplate, LEGACY_ADV_MAX, EXT_ADV_MAX, MESH_HEADER_LEN, MESH_MAX_HOPS, fragment_count, make_fragment
+from messageLedger import MessageLedger
+from relayPolicy import FloodPolicy
+from neighborTable import NeighborTable
+from metrics import metrics, FORWARDED, FORWARD_LATENCY_MS, BOOT_RELAY_MS
+# routeTable, ackTracker and reassemblyPool are only imported by the nodes
+# that use them, which keeps them off the boot path of the rest
+
+_TELESCOPE_UUID = bluetooth.UUID(0x0102)
+
+_ADV_INTERVAL_US = const(100000)
+_RELAY_DWELL_MS = const(300)
+_LED_PULSE_MS = const(50)
+_HOUSEKEEPING_MS = const(1000)
+_PENDING_MAX = const(32)
+_QUEUE_SIZE = const(32)
+_NEIGHBOR_MAX_AGE_MS = const(300000)
+_SEND_HOPS = const(5)
+_ACK_HOP_DWELLS = const(3)
+_METRICS_MS = const(10000)
+
+
+class MeshNode:
+    # With aggregate=True pending messages are packed into one advertisement:
+    # two per legacy payload, or many more with BLE 5 extended advertising
+    # (extended=True, only for ports built with it: the stack rejects payloads
+    # over the legacy limit otherwise). policy decides whether and when each
+    # new message is relayed (see relayPolicy); the default floods.
+    # Relays replace the distance field with the filtered estimate of how far
+    # away the neighbour they heard the message from is.
+    #
+    # routing=True relays a message addressed to a known name only if this
+    # node is closer to it, in hops, than the hops the message has left; a
+    # message sent with send() gets the learned distance plus `slack` hops.
+    # Names with no known route, and all other traffic, are flooded.
+    #
+    # With scheduler=True relays go through an AdvertisingScheduler, which
+    # rotates every pending message through the advertiser at interval_us,
+    # each for dwell_ms worth of events, instead of one dwell per message.
+    #
+    # Every metrics_ms the metrics snapshot is published on the distance
+    # characteristic, and also printed on the console with metrics_serial.
+    #
+    # reliable=True acknowledges every message addressed to this node and
+    # retransmits its own sends, with exponential backoff, until they are
+    # acknowledged (see ackTracker). ACKs need the compact header, and go
+    # back as many hops as the message came. A send first waits its hop
+    # budget times ack_timeout_ms, by default three dwells (there, back and
+    # one in a queue), until round trips have been measured. Retries
+    # only go out to names with a known route: a flood reaches everyone it
+    # can anyway, and its retries and their ACKs would only crowd out the
+    # flood and its ACK. A retry goes out under a new message ID from
+    # id_source(old_id), by default the next free one of this node's counter.
+    #
+    # dual_core=True moves scan ingestion (decode, ledger, neighbour and
+    # route updates) to the second core, so results are no longer lost while
+    # this loop is busy. The BLE IRQ and every radio call stay on this core,
+    # where the stack runs. The cores share a LockedQueue and one lock over
+    # the ledger, the tables and the pending relays.
+    #
+    # send_payload() sends data too large for one advertisement as fragments
+    # (compact header only). Relays forward fragments as they are; with
+    # reassemble=True this node also puts together the payloads addressed to
+    # it, passes each to on_payload(sender, messageID, name, payload) and
+    # stops relaying their fragments.
+    #
+    # trace, a scanTrace.TraceWriter, records every raw scan result for
+    # replay on the host; it is flushed when run() ends.
+    #
+    # store, a messageLedger.LedgerStore for this node's ledger, is given the
+    # chance to save it on every housekeeping round (see LedgerStore).
+    #
+    # duty_cycle, a dutyCycle.DutyCycleController, is sampled on every
+    # housekeeping round and sets the scan window and interval and the
+    # advertising interval and dwell to suit the traffic, in place of
+    # interval_us and dwell_ms.
+    def __init__(self, ble, manufacturer=_TELESCOPE_UUID, ledger=None, interval_us=_ADV_INTERVAL_US, dwell_ms=_RELAY_DWELL_MS, compact=True, aggregate=False, extended=False, policy=None, routing=False, address=None, slack=0, metrics_ms=_METRICS_MS, metrics_serial=False, scheduler=False, reliable=False, ack_timeout_ms=None, id_source=None, dual_core=False, reassemble=False, on_payload=None, trace=None, store=None, duty_cycle=None):
+        self._ble = ble
+        self.interval_us = interval_us
+        self.dwell_ms = dwell_ms
+        self._wake = asyncio.ThreadSafeFlag()
+        self._blink = asyncio.ThreadSafeFlag()
+        # Relays emit the compact mesh header; both layouts are accepted on scan
+        self._forwarder = BLEPing(ble, mfg=manufacturer, compact=compact)
+        # Own mesh address: the low 16 bits of the MAC unless given. The radio
+        # only reports its MAC once active, which the session above made it.
+        self.address = address if address is not None else int.from_bytes(ble.config('mac')[1][-2:], 'big')
+        self.scanner = readScan.BLENode(ble, manufacturer, ledger if ledger is not None else MessageLedger())
+        self.scanner.trace = trace
+        self.store = store
+        self.duty_cycle = duty_cycle
+        self.dual_core = dual_core
+        self._lock = readScan.NULL_LOCK
+        if dual_core:
+            if _thread is None:
+                raise OSError("dual_core needs _thread")
+            self._lock = _thread.allocate_lock()
+            self.scanner.lock = self._lock
+            self.queue = readScan.LockedQueue(_QUEUE_SIZE, self._wake)
+        else:
+            self.queue = readScan.IngressQueue(_QUEUE_SIZE, self._wake)
+        # Scanned fragments are kept for relaying in a ring with a slot for
+        # every entry that can hold one: the queue, the pending table and the
+        # relay in hand (and the one being added to a full queue)
+        self.scanner.fragments = readScan.FragmentRing(_QUEUE_SIZE + _PENDING_MAX + 2, (EXT_ADV_MAX if extended else LEGACY_ADV_MAX) - MESH_HEADER_LEN)
+        self.neighbors = NeighborTable()
+        self.scanner.neighbors = self.neighbors
+        self.forwarded = 0
+        self.suppressed = 0
+        self.dropped = 0
+        self.pruned = 0
+        self.received = 0
+        self.slack = slack
+        self.metrics_ms = metrics_ms
+        self.metrics_serial = metrics_serial
+        if reliable and not compact:
+            raise ValueError("acknowledgements need the compact header")
+        self.compact = compact
+        self.acks = None
+        if reliable:
+            from ackTracker import AckTracker
+            self.acks = AckTracker(timeout_ms=ack_timeout_ms if ack_timeout_ms is not None else _ACK_HOP_DWELLS * dwell_ms)
+        self._ack_timeout_ms = ack_timeout_ms
+        self._ack_wake = asyncio.ThreadSafeFlag()
+        self._id_source = id_source
+        self._next_id = 0
+        self.on_payload = on_payload
+        self.payloads = 0
+        if reassemble:
+            from reassemblyPool import ReassemblyPool
+            self.scanner.reassembly = ReassemblyPool()
+            self.scanner.payload_name = self.address
+            self.scanner.on_payload = self._on_payload
+        self.routes = None
+        if routing:
+            from routeTable import RouteTable
+            self.routes = RouteTable()
+            self.scanner.routes = self.routes
+        # Messages waiting out their relay delay: (sender, id) -> [due, duplicates, entry]
+        self.policy = policy if policy is not None else FloodPolicy()
+        self._pending = {}
+        self._wait_ms = -1
+        if self.policy.threshold:
+            self.scanner.on_duplicate = self._on_duplicate
+        self.max_adv_len = LEGACY_ADV_MAX
+        self.scheduler = AdvertisingScheduler(ble, interval_us) if scheduler else None
+        self._aggregate = None
+        if aggregate:
+            if extended:
+                self.max_adv_len = EXT_ADV_MAX
+            self._aggregate = AggregateTemplate(manufacturer, self.max_adv_len)
+        if duty_cycle is not None:
+            self._adapt()
+
+    # Awaitable primitives ----------------------------------------------------
+
+    async def scan(self, timeout_ms=100000):
+        return await readScan.scan_async(self.scanner, timeout_ms)
+
+    async def advertise(self, name, hopCount, distance, sender, messageID, ttl=0, dwell_ms=None, ack=None, fragment=None):
+        payload = self._forwarder.set_message(name, hopCount, distance, sender, messageID, ttl, ack, fragment)
+        await self._forwarder.advertise(self.dwell_ms if dwell_ms is None else dwell_ms, self.interval_us, payload)
+
+    # Distance for a relayed entry: the estimate to the neighbour it came
+    # from, or the received value if that neighbour has no estimate (or its
+    # record has since gone to another).
+    def _distance(self, data):
+        if data[12] is None:
+            return data[3]
+        with self._lock:
+            distance = self.neighbors.key_distance(data[12])
+        return data[3] if distance is None else distance
+
+    # Relay policy --------------------------------------------------------
+
+    # Called from the scan path for every repeat of a message already heard.
+    def _on_duplicate(self, sender, message_id, rssi):
+        item = self._pending.get((sender, message_id))
+        if item is not None:
+            item[1] += 1
+
+    # Whether a message to a known name is on this node's path: it goes on
+    # only downhill.
+    def _on_route(self, data):
+        hops = self.routes.hops(data[5])
+        return hops < 0 or hops < data[2]
+
+    # A message addressed to this node stops here. In reliable mode an ACK
+    # settles the matching send and anything else but a fragment is
+    # acknowledged, by an ACK under a new ID of this node's. Fragments were
+    # already taken by the reassembly pool.
+    def _deliver(self, data):
+        if data[11] is not None:
+            return
+        if data[10] is not None:
+            if self.acks is not None:
+                self.acks.ack(data[10], data[4])
+            return
+        self.received += 1
+        if self.acks is not None:
+            # Back as far as the message came, if it says
+            hops = max(data[7] - data[2] + 1, 1) + self.slack if data[7] else None
+            self._originate(data[4], self._new_id(data[6]), None, hops, data[6])
+
+    # Move newly accepted messages from the ingress queue into the pending
+    # table, stamped with the time the policy wants them relayed.
+    def _admit(self):
+        queue = self.queue
+        pending = self._pending
+        policy = self.policy
+        now = time.ticks_ms()
+        while True:
+            data = queue.get()
+            if data is None:
+                return
+            if data[5] == self.address and (self.routes is not None or self.acks is not None or (data[11] is not None and self.scanner.reassembly is not None)):
+                self._deliver(data)
+                continue
+            if self.routes is not None and not self._on_route(data):
+                self.pruned += 1
+                continue
+            delay = policy.delay_ms(data[8])
+            if delay < 0 or len(pending) >= _PENDING_MAX:
+                self.dropped += 1
+                continue
+            pending[(data[4] or 0, data[6] or 0)] = [time.ticks_add(now, delay), 0, data]
+
+    # Return the next message whose delay has run out, or None and leave the
+    # time to the next one in _wait_ms. Messages that enough neighbours have
+    # already relayed are dropped here.
+    def _pop_due(self):
+        with self._lock:
+            return self._take_due()
+
+    def _take_due(self):
+        self._admit()
+        pending = self._pending
+        threshold = self.policy.threshold
+        now = time.ticks_ms()
+        wait = -1
+        for key in list(pending):
+            item = pending[key]
+            if threshold and item[1] >= threshold:
+                del pending[key]
+                self.suppressed += 1
+                continue
+            left = time.ticks_diff(item[0], now)
+            if left <= 0:
+                return pending.pop(key)[2]
+            if wait < 0 or left < wait:
+                wait = left
+        self._wait_ms = wait
+        return None
+
+    # Originate a message to name, relayed by the relay task like any other.
+    # Returns False if the pending table (or, in reliable mode, the table of
+    # unacknowledged sends) is full.
+    def send(self, name, messageID, distance=None, hopCount=None):
+        acks = self.acks
+        if acks is not None and len(acks) >= acks.capacity:
+            self.dropped += 1
+            return False
+        with self._lock:
+            if not self._originate(name, messageID, distance, hopCount, None):
+                return False
+        if acks is not None:
+            acks.track(name, messageID, self._hop_budget(name) if hopCount is None else hopCount)
+            self._ack_wake.set()
+        return True
+
+    # Send payload to name as fragments with message IDs messageID onwards.
+    # Returns the number of IDs used, or 0 if the pending table has no room
+    # for all of them.
+    def send_payload(self, name, messageID, payload, hopCount=None):
+        if not self.compact:
+            raise ValueError("fragments need the compact header")
+        count = fragment_count(len(payload), self.max_adv_len)
+        if count > 255 or count > _PENDING_MAX:
+            raise ValueError("payload too large")
+        with self._lock:
+            if len(self._pending) + count > _PENDING_MAX:
+                self.dropped += 1
+                return 0
+            for index in range(count):
+                self._originate(name, (messageID + index) & 0xFFFF, None, hopCount, None, make_fragment(payload, index, count))
+        return count
+
+    def _on_payload(self, sender, messageID, name, payload):
+        self.payloads += 1
+        if self.on_payload is not None:
+            self.on_payload(sender, messageID, name, payload)
+
+    # Hops to give a message to name: the learned distance plus slack, or the
+    # default without a route, and extra more for retries so that they spread
+    # wider than the attempt that failed, up to the most the header carries.
+    def _hop_budget(self, name, extra=0):
+        hops = self.routes.hops(name) if self.routes is not None else -1
+        return min((hops + self.slack if hops > 0 else _SEND_HOPS) + extra, MESH_MAX_HOPS)
+
+    def _originate(self, name, messageID, distance, hopCount, ack, fragment=None):
+        if hopCount is None:
+            hopCount = self._hop_budget(name)
+        if len(self._pending) >= _PENDING_MAX:
+            self.dropped += 1
+            return False
+        self.scanner.message_ledger.add(self.address, messageID)
+        # Entries hold the hop count as heard, which relaying decrements
+        now = time.ticks_ms()
+        self._pending[(self.address, messageID)] = [now, 0, (None, None, hopCount + 1, distance, self.address, name, messageID, hopCount, None, now, ack, fragment, None)]
+        self._wake.set()
+        return True
+
+    def _new_id(self, old_id):
+        if self._id_source is not None:
+            return self._id_source(old_id)
+        ledger = self.scanner.message_ledger
+        while True:
+            self._next_id = (self._next_id + 1) & 0xFFFF
+            if not ledger.seen(self.address, self._next_id):
+                return self._next_id
+
+    def _forwarding(self, data):
+        metrics.counts[FORWARDED] += 1
+        metrics.observe(FORWARD_LATENCY_MS, time.ticks_diff(time.ticks_ms(), data[9]))
+        if metrics.mark(BOOT_RELAY_MS):
+            metrics.boot_report()
+
+    async def _wait_pending(self):
+        if self._wait_ms < 0:
+            await self._wake.wait()
+            return
+        try:
+            await asyncio.wait_for_ms(self._wake.wait(), self._wait_ms)
+        except asyncio.TimeoutError:
+            pass
+
+    # Tasks ---------------------------------------------------------------
+
+    async def _relay_task(self):
+        while True:
+            data = self._pop_due()
+            if data is None:
+                await self._wait_pending()
+                continue
+            self._blink.set()
+            self._forwarding(data)
+            await self.advertise(data[5], data[2] - 1, self._distance(data), data[4], data[6], data[7], ack=data[10], fragment=data[11])
+            self.forwarded += 1
+
+    async def _relay_scheduled_task(self):
+        scheduler = self.scheduler
+        while True:
+            await scheduler.wait_space()
+            data = self._pop_due()
+            if data is None:
+                await self._wait_pending()
+                continue
+            self._forwarding(data)
+            self._blink.set()
+            payload = self._forwarder.set_message(data[5], data[2] - 1, self._distance(data), data[4], data[6], data[7], data[10], data[11])
+            # Dwell and interval follow the duty-cycle controller, if any
+            scheduler.add(payload, max(self.dwell_ms * 1000 // self.interval_us, 1))
+            self.forwarded += 1
+
+    # Aggregate records carry neither the ACK flag nor fragments, so those
+    # messages go out on their own.
+    async def _relay_aggregate_task(self):
+        template = self._aggregate
+        while True:
+            template.clear()
+            single = None
+            while template.count < template.capacity:
+                data = self._pop_due()
+                if data is None:
+                    break
+                if data[10] is not None or data[11] is not None:
+                    single = data
+                    break
+                template.add(data[2] - 1, data[4], data[6], data[5], self._distance(data), data[7])
+                self._forwarding(data)
+            if single is not None:
+                self._blink.set()
+                self._forwarding(single)
+                await self.advertise(single[5], single[2] - 1, self._distance(single), single[4], single[6], single[7],
+                                     ack=single[10], fragment=single[11])
+                self.forwarded += 1
+            if not template.count:
+                if single is None:
+                    await self._wait_pending()
+                continue
+            self._blink.set()
+            await self._forwarder.advertise(self.dwell_ms, self.interval_us, template.payload())
+            self.forwarded += template.count
+
+    async def _retransmit_task(self):
+        acks = self.acks
+        while True:
+            wait = acks.next_due_ms()
+            if wait != 0:
+                if wait < 0:
+                    await self._ack_wake.wait()
+                    continue
+                try:
+                    await asyncio.wait_for_ms(self._ack_wake.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            slot = acks.due()
+            name = acks.name(slot)
+            routed = self.routes is not None and self.routes.hops(name) > 0
+            if not acks.retry(slot, resend=routed) or not routed:
+                continue
+            with self._lock:
+                new_id = self._new_id(acks.message_id(slot))
+                acks.add_id(slot, new_id)
+                self._originate(name, new_id, None, self._hop_budget(name, acks.tries(slot)), None)
+
+    async def _led_task(self):
+        await self._blink.wait()
+        # The pin is set up on the first relay, not at boot
+        led = Pin('LED', Pin.OUT)
+        while True:
+            led.on()
+            await asyncio.sleep_ms(_LED_PULSE_MS)
+            led.off()
+            await self._blink.wait()
+
+    async def _housekeeping_task(self):
+        ledger = self.scanner.message_ledger
+        published = time.ticks_ms()
+        sampled = published
+        while True:
+            await asyncio.sleep_ms(_HOUSEKEEPING_MS)
+            if self.duty_cycle is not None:
+                now = time.ticks_ms()
+                self.duty_cycle.update(len(self._pending), time.ticks_diff(now, sampled))
+                sampled = now
+                self._adapt()
+            with self._lock:
+                ledger.expire()
+                self.neighbors.expire(_NEIGHBOR_MAX_AGE_MS)
+                if self.store is not None:
+                    self.store.maybe_save()
+            if self.metrics_ms and time.ticks_diff(time.ticks_ms(), published) >= self.metrics_ms:
+                published = time.ticks_ms()
+                self.publish_metrics()
+
+    def _adapt(self):
+        duty = self.duty_cycle
+        self.interval_us = duty.adv_interval_us
+        self.dwell_ms = duty.dwell_ms
+        if self.scheduler is not None:
+            self.scheduler.interval_us = duty.adv_interval_us
+        if self.acks is not None and self._ack_timeout_ms is None:
+            self.acks.timeout_ms = _ACK_HOP_DWELLS * duty.dwell_ms
+        self.scanner.set_scan_params(duty.scan_interval_us, duty.scan_window_us)
+
+    def publish_metrics(self):
+        self._forwarder.publish(metrics.snapshot())
+        if self.metrics_serial:
+            metrics.dump()
+
+    async def run(self):
+        self.scanner.scan_continuous(self.queue, max_len=self.max_adv_len, threaded=self.dual_core)
+        register_services(self._ble)
+        tasks = [self._led_task(), self._housekeeping_task()]
+        if self.acks is not None:
+            tasks.append(self._retransmit_task())
+        if self._aggregate is not None:
+            tasks.append(self._relay_aggregate_task())
+        elif self.scheduler is not None:
+            tasks.append(self._relay_scheduled_task())
+            tasks.append(self.scheduler.run())
+        else:
+            tasks.append(self._relay_task())
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            self.scanner.stop_scan()
+            if self.scanner.trace is not None:
+                self.scanner.trace.flush()
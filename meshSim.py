@@ -0,0 +1,1478 @@
+# Host-side mesh simulator.
+#
+# Runs the unmodified node code (readScan.BLENode, bleBroadcast.BLEPing and the
+# main.read_and_respond loop) as N virtual nodes under CPython. Every node gets
+# its own copy of those modules, bound to stand-in bluetooth / machine /
+# micropython / time / asyncio modules. All nodes share one virtual clock and
+# one radio medium with a configurable topology, radio range and packet loss.
+#
+# Nodes run in their own threads but only one of them executes at a time: a
+# node hands control back to the scheduler whenever it sleeps, so runs are
+# deterministic for a given seed.
+#
+#   python meshSim.py --nodes 50 --topology grid --range 15 --loss 0.1
+
+import binascii
+import heapq
+import importlib
+import json
+import math
+import os
+import random
+import sys
+import threading
+import time as _host_time
+import types
+
+_IRQ_SCAN_RESULT = 5
+_IRQ_SCAN_DONE = 6
+
+_ADV_TYPE_SENDER = 0x17
+_ADV_TYPE_ID = 0x18
+_ADV_TYPE_MANUFACTURER = 0xFF
+_MESH_VERSION = 1
+_MESH_AGGREGATE_VERSION = 2
+_MESH_ACK_VERSION = 3
+_MESH_FRAGMENT_VERSION = 4
+
+_ADV_IND = 0x00
+
+# 1M PHY legacy advertising PDU: preamble(1) + access address(4) + header(2) +
+# AdvA(6) + CRC(3) around the advertising data, 8 us per byte.
+_PDU_OVERHEAD = 16
+_US_PER_BYTE = 8
+_ADV_CHANNELS = 3
+_ADV_MIN_INTERVAL_US = 20000
+_ADV_DELAY_MAX_US = 10000
+_LEGACY_ADV_MAX = 31
+_EXT_ADV_MAX = 240
+# Extended advertising: a short ADV_EXT_IND on each primary channel pointing
+# at one AUX_ADV_IND that carries the data.
+_EXT_IND_LEN = 7
+
+_NODE_MODULES = ('viperWalk', 'advertisementPacket', 'messageLedger', 'bleSession', 'bleBroadcast', 'readScan', 'relayPolicy', 'neighborTable', 'routeTable', 'ackTracker', 'reassemblyPool', 'metrics', 'scanTrace', 'dutyCycle', 'meshNode', 'main', 'temp')
+# The node modules that are not programs
+_LIBRARY_MODULES = _NODE_MODULES[:-2]
+
+_HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+class _Stop(BaseException):
+    # Raised inside node threads to unwind them when a run ends. Derives from
+    # BaseException so the node code's `except Exception` handlers let it pass.
+    pass
+
+
+def const(value):
+    return value
+
+
+class UUID:
+    def __init__(self, value):
+        if isinstance(value, UUID):
+            self._bytes = value._bytes
+        elif isinstance(value, int):
+            self._bytes = value.to_bytes(2 if value <= 0xFFFF else 4, 'little')
+        elif isinstance(value, str):
+            self._bytes = bytes(reversed(binascii.unhexlify(value.replace('-', ''))))
+        else:
+            self._bytes = bytes(value)
+        if len(self._bytes) not in (2, 4, 16):
+            raise ValueError('invalid UUID')
+
+    def __bytes__(self):
+        return self._bytes
+
+    def __eq__(self, other):
+        return isinstance(other, UUID) and other._bytes == self._bytes
+
+    def __hash__(self):
+        return hash(self._bytes)
+
+    def __repr__(self):
+        if len(self._bytes) == 16:
+            return "UUID('%s')" % binascii.hexlify(bytes(reversed(self._bytes))).decode()
+        return 'UUID(0x%04x)' % int.from_bytes(self._bytes, 'little')
+
+
+class Pin:
+    IN = 0
+    OUT = 1
+    PULL_UP = 1
+    PULL_DOWN = 2
+
+    def __init__(self, pin_id, mode=-1, pull=-1, value=None):
+        self.id = pin_id
+        self._value = 0 if value is None else int(bool(value))
+
+    def value(self, x=None):
+        if x is None:
+            return self._value
+        self._value = int(bool(x))
+
+    def on(self):
+        self._value = 1
+
+    def off(self):
+        self._value = 0
+
+    def toggle(self):
+        self._value ^= 1
+
+    def __call__(self, x=None):
+        return self.value(x)
+
+
+class Radio:
+    # Stand-in for bluetooth.BLE. One instance per node; bluetooth.BLE()
+    # returns it every time, like the singleton on the real port.
+
+    def __init__(self, node):
+        self._node = node
+        self._sim = node.sim
+        self._active = False
+        self._handler = None
+        self._scan = None
+        self._adv = None
+        self._adv_data = b''
+        self._adv_interval = 0
+        self._handles = 0
+        self._values = {}
+        # Time spent listening, by the scan window/interval ratio
+        self.listen_us = 0
+        self._listen_since = 0
+
+    def active(self, change=None):
+        if change is not None:
+            self._active = bool(change)
+        return self._active
+
+    def irq(self, handler):
+        self._handler = handler
+
+    def config(self, *args, **kwargs):
+        if not self._active:
+            raise OSError(1)
+        if args == ('mac',):
+            return (0, self._node.mac)
+        if args == ('gap_name',):
+            return b'MPY BTSTACK'
+        if args:
+            raise ValueError('unknown config param')
+
+    def gatts_register_services(self, services):
+        self._node.stats['registrations'] += 1
+        handles = []
+        for service in services:
+            chars = service[1] if len(service) > 1 else ()
+            service_handles = []
+            for _ in chars:
+                self._handles += 1
+                self._values[self._handles] = b''
+                service_handles.append(self._handles)
+            handles.append(tuple(service_handles))
+        return tuple(handles)
+
+    def gatts_read(self, value_handle):
+        return self._values[value_handle]
+
+    def gatts_write(self, value_handle, data, send_update=False):
+        self._values[value_handle] = bytes(data)
+
+    def gatts_set_buffer(self, value_handle, length, append=False):
+        pass
+
+    def gatts_notify(self, conn_handle, value_handle, data=None):
+        pass
+
+    def gatts_indicate(self, conn_handle, value_handle, data=None):
+        pass
+
+    def gap_scan(self, duration_ms, interval_us=1280000, window_us=11250, active=False):
+        if not self._active:
+            raise OSError(1)
+        self.account_listening()
+        if duration_ms is None:
+            if self._scan is not None:
+                self._scan = None
+                self._sim.at(0, self._dispatch, _IRQ_SCAN_DONE, ())
+            return
+        token = object()
+        self._scan = (token, interval_us, window_us)
+        if duration_ms:
+            self._sim.at(duration_ms * 1000, self._scan_timeout, token)
+
+    def account_listening(self):
+        now = self._sim.now
+        if self._scan is not None:
+            _, interval_us, window_us = self._scan
+            self.listen_us += (now - self._listen_since) * min(window_us, interval_us) // interval_us
+        self._listen_since = now
+
+    def _scan_timeout(self, token):
+        if self._scan is not None and self._scan[0] is token:
+            self.account_listening()
+            self._scan = None
+            self._dispatch(_IRQ_SCAN_DONE, ())
+
+    def gap_advertise(self, interval_us, adv_data=None, resp_data=None, connectable=True):
+        if not self._active:
+            raise OSError(1)
+        if interval_us is None:
+            self._adv = None
+            return
+        if adv_data is not None:
+            if len(adv_data) > (_EXT_ADV_MAX if self._sim.extended else _LEGACY_ADV_MAX):
+                raise OSError(22)
+            self._adv_data = bytes(adv_data)
+        token = object()
+        self._adv = token
+        self._adv_interval = max(interval_us, _ADV_MIN_INTERVAL_US)
+        self._sim.at(0, self._adv_event, token)
+
+    def _adv_event(self, token):
+        if self._adv is not token:
+            return
+        self._sim.transmit(self._node, self._adv_data)
+        delay = self._adv_interval + self._sim.rng.randint(0, _ADV_DELAY_MAX_US)
+        self._sim.at(delay, self._adv_event, token)
+
+    def receive(self, addr, adv_data, rssi):
+        # Called by the medium when a packet reaches this node intact. The scan
+        # window/interval ratio decides whether the radio was listening.
+        if self._scan is None:
+            return False
+        _, interval_us, window_us = self._scan
+        if window_us < interval_us and self._sim.rng.random() * interval_us >= window_us:
+            return False
+        self._dispatch(_IRQ_SCAN_RESULT, (0, memoryview(addr), _ADV_IND, rssi, memoryview(adv_data)))
+        return True
+
+    def _dispatch(self, event, data):
+        if self._handler is None:
+            return
+        try:
+            self._handler(event, data)
+        except _Stop:
+            raise
+        except Exception as e:
+            self._node.stats['irq_errors'] += 1
+            self._node.last_error = repr(e)
+
+
+class Node:
+    def __init__(self, sim, index, position, role):
+        self.sim = sim
+        self.index = index
+        self.position = position
+        self.role = role
+        self.mac = bytes((0x28, 0xCD, 0xC1, 0x00, index >> 8, index & 0xFF))
+        self.radio = Radio(self)
+        self.modules = {}
+        self.neighbors = ()
+        self.stats = {'registrations': 0, 'irq_errors': 0, 'node_errors': 0}
+        self.last_error = None
+        self._loading = False
+        self._stopped = False
+        self._idle = False
+        self._token = 0
+        self._wake = threading.Semaphore(0)
+        self.loop = _Loop(self)
+        self._thread = None
+        # Extra threads started through _thread, by Python thread
+        self._cores = {}
+        self._imports = {}
+        self._entered = False
+        # Virtual time the node was started (its reset), in ms
+        self.started_ms = None
+        self.mesh = None
+        # scanTrace.TraceWriter recording this node's scan results
+        self.trace = None
+
+    # Stand-in modules -------------------------------------------------------
+
+    def _stub_modules(self):
+        sim = self.sim
+        node = self
+
+        bluetooth = types.ModuleType('bluetooth')
+        bluetooth.UUID = UUID
+        bluetooth.BLE = lambda: node.radio
+        bluetooth.FLAG_READ = 0x0002
+        bluetooth.FLAG_WRITE = 0x0008
+        bluetooth.FLAG_NOTIFY = 0x0010
+        bluetooth.FLAG_INDICATE = 0x0020
+
+        machine = types.ModuleType('machine')
+        machine.Pin = Pin
+        machine.unique_id = lambda: bytes(2) + node.mac
+
+        micropython = types.ModuleType('micropython')
+        micropython.const = const
+        micropython.schedule = lambda fn, arg: sim.at(0, fn, arg)
+        micropython.alloc_emergency_exception_buf = lambda size: None
+        # Code emitters: the functions run as plain Python
+        micropython.native = micropython.viper = lambda fn: fn
+
+        time = types.ModuleType('time')
+        time.ticks_ms = lambda: sim.now // 1000
+        time.ticks_us = lambda: sim.now
+        time.ticks_add = lambda ticks, delta: ticks + delta
+        time.ticks_diff = lambda ticks1, ticks2: ticks1 - ticks2
+        time.sleep = lambda seconds: node.sleep_us(int(seconds * 1000000))
+        time.sleep_ms = lambda ms: node.sleep_us(int(ms) * 1000)
+        time.sleep_us = lambda us: node.sleep_us(int(us))
+        time.time = lambda: sim.now / 1000000
+        time.time_ns = lambda: sim.now * 1000
+
+        asyncio = types.ModuleType('asyncio')
+        loop = self.loop
+
+        def run(coro):
+            # Module-level asyncio.run(main()) calls are swallowed while the
+            # node code is being imported; the simulator drives the loops.
+            if node._loading:
+                coro.close()
+                return None
+            return loop.run(coro)
+
+        async def wait_for(aw, timeout):
+            if timeout is None:
+                return await aw
+            return await wait_for_ms(aw, timeout * 1000)
+
+        async def wait_for_ms(aw, timeout_ms):
+            task = aw if isinstance(aw, Task) else loop.spawn(aw)
+            return await _Request(_OP_JOIN, task, int(timeout_ms * 1000))
+
+        async def gather(*aws, return_exceptions=False):
+            tasks = [aw if isinstance(aw, Task) else loop.spawn(aw) for aw in aws]
+            results = []
+            for task in tasks:
+                try:
+                    results.append(await task)
+                except Exception as e:
+                    if not return_exceptions:
+                        raise
+                    results.append(e)
+            return results
+
+        asyncio.sleep = lambda seconds: _Request(_OP_SLEEP, None, int(seconds * 1000000))
+        asyncio.sleep_ms = lambda ms: _Request(_OP_SLEEP, None, int(ms) * 1000)
+        asyncio.run = run
+        asyncio.create_task = loop.spawn
+        asyncio.gather = gather
+        asyncio.wait_for = wait_for
+        asyncio.wait_for_ms = wait_for_ms
+        asyncio.Event = lambda: Event(loop)
+        asyncio.ThreadSafeFlag = lambda: ThreadSafeFlag(loop)
+        asyncio.Task = Task
+        asyncio.CancelledError = CancelledError
+        asyncio.TimeoutError = TimeoutError
+
+        # Threads become virtual cores, run in turn with the node on the
+        # virtual clock; locks park a core instead of blocking the host
+        thread = types.ModuleType('_thread')
+        thread.start_new_thread = lambda fn, args: _Core(node, fn, args).start()
+        thread.allocate_lock = lambda: _SimLock(node)
+        thread.get_ident = threading.get_ident
+
+        network = types.ModuleType('network')
+
+        # Seeded per node so policy decisions replay with the simulation seed
+        rng = random.Random(sim.rng.getrandbits(32))
+        urandom = types.ModuleType('random')
+        for name in ('getrandbits', 'randint', 'randrange', 'random', 'uniform', 'choice', 'seed'):
+            setattr(urandom, name, getattr(rng, name))
+
+        return {
+            'bluetooth': bluetooth,
+            'ubluetooth': bluetooth,
+            'machine': machine,
+            'micropython': micropython,
+            'time': time,
+            'utime': time,
+            'asyncio': asyncio,
+            'uasyncio': asyncio,
+            'ubinascii': binascii,
+            'network': network,
+            '_thread': thread,
+            'random': urandom,
+            'urandom': urandom,
+        }
+
+    def load(self, names, quiet=True):
+        stubs = self._stub_modules()
+        touched = tuple(stubs) + _NODE_MODULES
+        saved = {name: sys.modules.get(name) for name in touched}
+        if _HERE not in sys.path:
+            sys.path.insert(0, _HERE)
+        try:
+            sys.modules.update(stubs)
+            for name in _NODE_MODULES:
+                sys.modules.pop(name, None)
+            self._loading = True
+            # Every library module too, so that the node's lazy imports
+            # find its own copies
+            for name in tuple(names) + _LIBRARY_MODULES:
+                importlib.import_module(name)
+            for name in _NODE_MODULES:
+                if name in sys.modules:
+                    self.modules[name] = sys.modules[name]
+        finally:
+            self._loading = False
+            for name, module in saved.items():
+                if module is None:
+                    sys.modules.pop(name, None)
+                else:
+                    sys.modules[name] = module
+        self._imports = dict(stubs)
+        self._imports.update(self.modules)
+        if quiet:
+            for module in self.modules.values():
+                module.print = _silent
+
+    # Cooperative execution ------------------------------------------------
+
+    def sleep_us(self, us):
+        core = self._cores.get(threading.current_thread())
+        if core is not None:
+            core.park(max(us, 0))
+            return
+        if threading.current_thread() is not self._thread:
+            # Sleeping from IRQ context; nothing else can run meanwhile.
+            return
+        self._park(max(us, 0), False)
+
+    def idle_us(self, us):
+        # Like sleep_us, but interrupt() may end it early. Used by the asyncio
+        # stand-in when every task is waiting; us=None waits for an interrupt.
+        self._park(us, True)
+
+    def interrupt(self):
+        if self._idle:
+            self._idle = False
+            self._token += 1
+            self.sim.at(0, self._resume, self._token)
+
+    def _park(self, us, idle):
+        self._token += 1
+        if us is not None:
+            self.sim.at(us, self._resume, self._token)
+        self._idle = idle
+        self.sim._handoff.release()
+        self._wake.acquire()
+        self._idle = False
+        if self._stopped:
+            raise _Stop()
+        self.enter()
+
+    def _resume(self, token):
+        if token != self._token:
+            return
+        self._wake.release()
+        self.sim._handoff.acquire()
+
+    def start(self, loop, delay_us):
+        self.started_ms = (self.sim.now + delay_us) // 1000
+        self._thread = threading.Thread(target=self._run, args=(loop,), daemon=True)
+        self._thread.start()
+        self.sim.at(delay_us, self._resume, self._token)
+
+    # Point sys.modules at this node's modules, so that imports in its code
+    # (lazy ones at run time) resolve to them. Threads of one node run at a
+    # time; Simulator.restore_modules() undoes it.
+    def enter(self):
+        if not self._entered:
+            self._entered = True
+            saved = self.sim._host_modules
+            for name in self._imports:
+                if name not in saved:
+                    saved[name] = sys.modules.get(name)
+        sys.modules.update(self._imports)
+
+    def _run(self, loop):
+        self._wake.acquire()
+        try:
+            if not self._stopped:
+                self.enter()
+                loop(self)
+        except _Stop:
+            pass
+        except Exception as e:
+            self.stats['node_errors'] += 1
+            self.last_error = repr(e)
+        finally:
+            self.sim._handoff.release()
+
+    def stop(self):
+        if self._thread is None or not self._thread.is_alive():
+            return
+        self._stopped = True
+        self._wake.release()
+        self.sim._handoff.acquire()
+        self._thread.join()
+        for core in list(self._cores.values()):
+            core.stop()
+
+
+# A thread the node started with _thread.start_new_thread, e.g. work on the
+# second core. It takes turns with the node thread like the node threads do
+# with each other: at most one runs at a time, and a core that sleeps or
+# waits on a lock parks until the virtual clock or a release wakes it.
+class _Core:
+    def __init__(self, node, fn, args):
+        self.node = node
+        self._fn = fn
+        self._args = args
+        self._token = 0
+        self._idle = False
+        self._wake = threading.Semaphore(0)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self.node._cores[self._thread] = self
+        self._thread.start()
+        self.node.sim.at(0, self._resume, self._token)
+
+    # us=None parks until interrupt()
+    def park(self, us):
+        sim = self.node.sim
+        self._token += 1
+        if us is not None:
+            sim.at(us, self._resume, self._token)
+        self._idle = us is None
+        sim._handoff.release()
+        self._wake.acquire()
+        self._idle = False
+        if self.node._stopped:
+            raise _Stop()
+        self.node.enter()
+
+    def interrupt(self):
+        if self._idle:
+            self._idle = False
+            self._token += 1
+            self.node.sim.at(0, self._resume, self._token)
+
+    def _resume(self, token):
+        if token != self._token:
+            return
+        self._wake.release()
+        self.node.sim._handoff.acquire()
+
+    def _run(self):
+        node = self.node
+        self._wake.acquire()
+        try:
+            if not node._stopped:
+                node.enter()
+                self._fn(*self._args)
+        except _Stop:
+            pass
+        except Exception as e:
+            node.stats['node_errors'] += 1
+            node.last_error = repr(e)
+        finally:
+            del node._cores[self._thread]
+            node.sim._handoff.release()
+
+    def stop(self):
+        if not self._thread.is_alive():
+            return
+        self._wake.release()
+        self.node.sim._handoff.acquire()
+        self._thread.join()
+
+
+# _thread lock for virtual cores. Only one thread of the simulation runs at a
+# time, so a lock is a flag; acquiring a held lock parks the calling core
+# until release() (the timeout is not modelled). The node thread itself must
+# never wait on one, as nothing else could run to release it.
+class _SimLock:
+    def __init__(self, node):
+        self._node = node
+        self._locked = False
+        self._waiters = []
+
+    def acquire(self, waitflag=1, timeout=-1):
+        while self._locked:
+            if not waitflag:
+                return False
+            core = self._node._cores.get(threading.current_thread())
+            if core is None:
+                raise RuntimeError("node thread would block on a held lock")
+            self._waiters.append(core)
+            core.park(None)
+        self._locked = True
+        return True
+
+    def release(self):
+        if not self._locked:
+            raise RuntimeError("release of an unlocked lock")
+        self._locked = False
+        waiters = self._waiters
+        self._waiters = []
+        for core in waiters:
+            core.interrupt()
+
+    def locked(self):
+        return self._locked
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+def _silent(*args, **kwargs):
+    pass
+
+
+# Virtual-time asyncio ---------------------------------------------------------
+#
+# A small stand-in for MicroPython's asyncio, one loop per node. Coroutines
+# yield _Request objects (sleep, wait on a flag, join a task); when no task is
+# runnable the loop idles the node thread on the virtual clock, and a flag set
+# from an IRQ interrupts that idle.
+
+_OP_SLEEP = 0
+_OP_WAIT = 1
+_OP_JOIN = 2
+
+
+class CancelledError(BaseException):
+    pass
+
+
+class _Request:
+    __slots__ = ('op', 'target', 'timeout_us')
+
+    def __init__(self, op, target, timeout_us=None):
+        self.op = op
+        self.target = target
+        self.timeout_us = timeout_us
+
+    def __await__(self):
+        return (yield self)
+
+
+class Task:
+    def __init__(self, loop, coro):
+        self._loop = loop
+        self.coro = coro
+        self.result = None
+        self.error = None
+        self.finished = False
+        self.token = 0
+        self.waiters = []
+
+    def done(self):
+        return self.finished
+
+    def cancel(self):
+        return self._loop.cancel(self)
+
+    def __await__(self):
+        if not self.finished:
+            yield _Request(_OP_JOIN, self)
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+class ThreadSafeFlag:
+    def __init__(self, loop):
+        self._loop = loop
+        self._set = False
+        self._waiters = []
+
+    def set(self):
+        self._set = True
+        self._loop.release(self._waiters)
+
+    def clear(self):
+        self._set = False
+
+    async def wait(self):
+        if not self._set:
+            await _Request(_OP_WAIT, self)
+        self._set = False
+
+
+class Event(ThreadSafeFlag):
+    def is_set(self):
+        return self._set
+
+    async def wait(self):
+        if not self._set:
+            await _Request(_OP_WAIT, self)
+        return True
+
+
+class _Loop:
+    def __init__(self, node):
+        self._node = node
+        self._ready = []
+        self._timers = []
+        self._seq = 0
+
+    def spawn(self, coro):
+        task = Task(self, coro)
+        self._ready.append((task, task.token, None, None))
+        return task
+
+    def _wake(self, task, token, exc=None):
+        if task.finished or task.token != token:
+            return False
+        task.token += 1
+        self._ready.append((task, task.token, None, exc))
+        return True
+
+    def release(self, waiters):
+        # Wake every live waiter of a flag or event.
+        woke = False
+        while waiters:
+            task, token = waiters.pop(0)
+            woke = self._wake(task, token) or woke
+        if woke:
+            self._node.interrupt()
+
+    def cancel(self, task):
+        if task.finished:
+            return False
+        task.token += 1
+        self._ready.append((task, task.token, None, CancelledError()))
+        self._node.interrupt()
+        return True
+
+    def _timer(self, delay_us, task, token, exc=None, cancel=None):
+        self._seq += 1
+        heapq.heappush(self._timers, (self._node.sim.now + delay_us, self._seq, task, token, exc, cancel))
+
+    def _step(self, task, token, value, exc):
+        if task.finished or task.token != token:
+            return
+        try:
+            request = task.coro.throw(exc) if exc is not None else task.coro.send(value)
+        except StopIteration as e:
+            self._finish(task, e.value, None)
+            return
+        except BaseException as e:
+            if isinstance(e, _Stop):
+                raise
+            self._finish(task, None, e)
+            return
+        op = request.op
+        if op == _OP_SLEEP:
+            self._timer(request.timeout_us, task, token)
+            return
+        if op == _OP_WAIT:
+            request.target._waiters.append((task, token))
+        elif op == _OP_JOIN:
+            target = request.target
+            if target.finished:
+                self._ready.append((task, token, None, None))
+                return
+            target.waiters.append((task, token))
+            if request.timeout_us is not None:
+                self._timer(request.timeout_us, task, token, TimeoutError(), target)
+
+    def _finish(self, task, result, error):
+        task.finished = True
+        task.result = result
+        task.error = error
+        if error is not None and not task.waiters and not isinstance(error, CancelledError):
+            self._node.stats['node_errors'] += 1
+            self._node.last_error = repr(error)
+        self.release(task.waiters)
+
+    def run(self, coro):
+        main = self.spawn(coro)
+        node = self._node
+        timers = self._timers
+        while not main.finished:
+            while self._ready:
+                task, token, value, exc = self._ready.pop(0)
+                self._step(task, token, value, exc)
+            if main.finished:
+                break
+            if timers and timers[0][0] <= node.sim.now:
+                _, _, task, token, exc, cancel = heapq.heappop(timers)
+                if self._wake(task, token, exc) and cancel is not None:
+                    self.cancel(cancel)
+                continue
+            node.idle_us(timers[0][0] - node.sim.now if timers else None)
+        if main.error is not None:
+            raise main.error
+        return main.result
+
+
+_scheduled = []
+_host_node = None
+
+
+def run_scheduled():
+    while _scheduled:
+        fn, arg = _scheduled.pop(0)
+        fn(arg)
+
+
+def install_host_modules():
+    # Register the stand-ins in sys.modules so node code can be imported
+    # directly on the host (benchmarks, tools). Here time follows the wall
+    # clock and micropython.schedule callbacks run from run_scheduled() or the
+    # next sleep. Returns the stand-in radio.
+    global _host_node
+    if _host_node is not None:
+        return _host_node.radio
+    _host_node = Simulator([(0.0, 0.0)]).nodes[0]
+    modules = _host_node._stub_modules()
+    del modules['asyncio'], modules['uasyncio'], modules['random'], modules['_thread']
+    modules['micropython'].schedule = lambda fn, arg: _scheduled.append((fn, arg))
+
+    time = types.ModuleType('time')
+    time.__dict__.update(_host_time.__dict__)
+    origin = _host_time.perf_counter_ns()
+
+    def ticks_us():
+        return (_host_time.perf_counter_ns() - origin) // 1000
+
+    def sleep(seconds):
+        run_scheduled()
+        _host_time.sleep(seconds)
+
+    time.ticks_us = ticks_us
+    time.ticks_cpu = ticks_us
+    time.ticks_ms = lambda: ticks_us() // 1000
+    time.ticks_add = lambda ticks, delta: ticks + delta
+    time.ticks_diff = lambda ticks1, ticks2: ticks1 - ticks2
+    time.sleep = sleep
+    time.sleep_ms = lambda ms: sleep(ms / 1000)
+    time.sleep_us = lambda us: sleep(us / 1000000)
+    modules['time'] = modules['utime'] = time
+
+    if _HERE not in sys.path:
+        sys.path.insert(0, _HERE)
+    sys.modules.update(modules)
+    return _host_node.radio
+
+
+def relay_loop(node):
+    main = node.modules['main']
+    ledger = main.MessageLedger()
+    while True:
+        ledger = node.loop.run(main.read_and_respond(ledger))
+
+
+def continuous_relay_loop(node):
+    main = node.modules['main']
+    node.loop.run(main.relay_continuous(main.MessageLedger()))
+
+
+def runtime_relay_loop(node):
+    main = node.modules['main']
+    options = dict(node.sim.node_options)
+    # A policy is given as a factory taking the node's own relayPolicy module
+    if callable(options.get('policy')):
+        options['policy'] = options['policy'](node.modules['relayPolicy'])
+    # Likewise a duty cycle controller, from the node's dutyCycle module
+    if callable(options.get('duty_cycle')):
+        options['duty_cycle'] = options['duty_cycle'](node.modules['dutyCycle'])
+    # Retransmissions and ACKs draw their new IDs from the simulator, which
+    # counts retransmissions towards the original message
+    if options.get('reliable'):
+        options['id_source'] = node.sim.id_source(node)
+    if node.sim.trace is not None and node is node.sim.traced_node():
+        node.trace = options['trace'] = node.modules['scanTrace'].TraceWriter(node.sim.trace)
+    mesh = node.modules['meshNode'].MeshNode(main.bluetooth.BLE(), main._TELESCOPE_UUID, main.MessageLedger(),
+                                             **options)
+    node.mesh = mesh
+    if options.get('reassemble'):
+        mesh.on_payload = lambda sender, message_id, name, payload: node.sim.reassembled(node, message_id, payload)
+    if node.sim.unicast_interval_us:
+        node.loop.spawn(unicast_traffic(node, mesh))
+    node.loop.run(mesh.run())
+
+
+async def unicast_traffic(node, mesh):
+    # Each relay also sends messages to randomly chosen other relays
+    sim = node.sim
+    asyncio = node.modules['main'].asyncio
+    others = [n for n in sim.nodes if n.role == 'relay' and n is not node]
+    interval = sim.unicast_interval_us // 1000
+    while others:
+        await asyncio.sleep_ms(sim.rng.randint(interval // 2, interval * 3 // 2))
+        if sim.now >= sim.originate_until:
+            return
+        dest = sim.rng.choice(others)
+        message_id = sim.next_message(node, dest)
+        if message_id is None:
+            return
+        name = int.from_bytes(dest.mac[-2:], 'big')
+        if not sim.payload_bytes:
+            if not mesh.send(name, message_id):
+                sim.refused(message_id)
+            continue
+        # The fragments take consecutive IDs, all counted as one message
+        payload = bytes(sim.rng.getrandbits(8) for _ in range(sim.payload_bytes))
+        count = node.modules['advertisementPacket'].fragment_count(len(payload), mesh.max_adv_len)
+        for _ in range(count - 1):
+            sim.alias_message(message_id)
+        sim.messages[message_id]['payload'] = payload
+        if not mesh.send_payload(name, message_id, payload):
+            sim.refused(message_id)
+
+
+# Relay policy factories for the runtime relay, by name
+POLICIES = {
+    'flood': lambda policies: policies.FloodPolicy(),
+    'counter': lambda policies: policies.CounterPolicy(),
+    'gossip': lambda policies: policies.GossipPolicy(),
+    'distance': lambda policies: policies.DistancePolicy(),
+}
+
+
+_RELAY_LOOPS = {
+    'cycle': relay_loop,
+    'continuous': continuous_relay_loop,
+    'runtime': runtime_relay_loop,
+}
+
+
+def originator_loop(node):
+    sim = node.sim
+    temp = node.modules['temp']
+    bluetooth = temp.bluetooth
+    while sim.now < sim.originate_until:
+        started = sim.now
+        message_id = sim.next_message(node)
+        if message_id is None:
+            return
+        temp.broadcast(name=temp.deviceName, hopCount=sim.hops, distance=7.94,
+                       sender=0x5678, messageID=message_id, ble=bluetooth.BLE())
+        remaining = sim.message_interval_us - (sim.now - started)
+        node.sleep_us(max(remaining, 0))
+
+
+def message_keys(adv_data):
+    # Message IDs carried by a mesh advertisement (legacy, compact header or
+    # aggregate); empty for anything else.
+    i = 0
+    n = len(adv_data)
+    while i + 1 < n:
+        length = adv_data[i]
+        if length == 0:
+            break
+        adv_type = adv_data[i + 1]
+        if adv_type == _ADV_TYPE_ID and length == 3:
+            return ((adv_data[i + 2] << 8) | adv_data[i + 3],)
+        if adv_type == _ADV_TYPE_MANUFACTURER and length > 3:
+            version = adv_data[i + 4]
+            if version in (_MESH_VERSION, _MESH_ACK_VERSION, _MESH_FRAGMENT_VERSION) and length >= 13:
+                return ((adv_data[i + 8] << 8) | adv_data[i + 9],)
+            if version == _MESH_AGGREGATE_VERSION:
+                base = i + 6
+                return tuple((adv_data[base + k * 9 + 3] << 8) | adv_data[base + k * 9 + 4]
+                             for k in range(adv_data[i + 5]))
+        i += length + 1
+    return ()
+
+
+def layout(topology, count, spacing, rng):
+    if topology == 'line':
+        return [(i * spacing, 0.0) for i in range(count)]
+    if topology == 'grid':
+        side = int(math.ceil(math.sqrt(count)))
+        return [((i % side) * spacing, (i // side) * spacing) for i in range(count)]
+    if topology == 'random':
+        side = spacing * math.sqrt(count)
+        return [(rng.uniform(0, side), rng.uniform(0, side)) for _ in range(count)]
+    raise ValueError('unknown topology %r' % topology)
+
+
+class Simulator:
+    def __init__(self, positions, radio_range=15.0, loss=0.0, originators=1, hops=5,
+                 message_interval=2.0, seed=None, collisions=True, tx_power=-59,
+                 path_loss_exponent=2.0, rssi_noise=2.0, quiet=True,
+                 relay=relay_loop, originate=originator_loop, extended=False,
+                 node_options=None, unicast_interval=None, payload_bytes=0, trace=None):
+        self.now = 0
+        # Binary stream recording the scan results of the first relay, as a
+        # scan trace (runtime relay loop only)
+        self.trace = trace
+        # Relays send unicast messages this often (runtime relay loop only)
+        self.unicast_interval_us = int(unicast_interval * 1000000) if unicast_interval else 0
+        # Size of the payload in each unicast message; 0 sends plain messages
+        self.payload_bytes = payload_bytes
+        self.extended = extended
+        # Extra keyword arguments for meshNode.MeshNode in the runtime relay loop
+        self.node_options = node_options or {}
+        self.rng = random.Random(seed)
+        self.radio_range = radio_range
+        self.loss = loss
+        self.hops = hops
+        self.message_interval_us = int(message_interval * 1000000)
+        self.collisions = collisions
+        self.tx_power = tx_power
+        self.path_loss_exponent = path_loss_exponent
+        self.rssi_noise = rssi_noise
+        self.originate_until = 0
+        self.messages = {}
+        self.counters = {'adv_events': 0, 'airtime_us': 0, 'rx_lost': 0, 'rx_collided': 0,
+                         'rx_not_listening': 0, 'rx_delivered': 0}
+        self._queue = []
+        self._seq = 0
+        self._next_id = 1
+        self._handoff = threading.Semaphore(0)
+        # sys.modules entries replaced by Node.enter(), as they were
+        self._host_modules = {}
+        self._rx = {}
+        self.nodes = []
+        for i, position in enumerate(positions):
+            role = 'originator' if i < originators else 'relay'
+            self.nodes.append(Node(self, i, position, role))
+        self._quiet = quiet
+        self._relay = relay
+        self._originate = originate
+        self._link()
+
+    def _link(self):
+        for node in self.nodes:
+            neighbors = []
+            for other in self.nodes:
+                if other is node:
+                    continue
+                d = math.dist(node.position, other.position)
+                if d <= self.radio_range:
+                    neighbors.append((other, d))
+            node.neighbors = tuple(neighbors)
+
+    # Event queue -------------------------------------------------------------
+
+    def at(self, delay_us, fn, *args):
+        self._seq += 1
+        heapq.heappush(self._queue, (self.now + int(delay_us), self._seq, fn, args))
+
+    def _run_until(self, until_us):
+        queue = self._queue
+        events = 0
+        while queue and queue[0][0] <= until_us:
+            when, _, fn, args = heapq.heappop(queue)
+            self.now = when
+            fn(*args)
+            events += 1
+        self.now = until_us
+        return events
+
+    # Radio medium ------------------------------------------------------------
+
+    def transmit(self, node, adv_data):
+        airtime = (len(adv_data) + _PDU_OVERHEAD) * _US_PER_BYTE
+        if len(adv_data) > _LEGACY_ADV_MAX:
+            total = _ADV_CHANNELS * (_EXT_IND_LEN + _PDU_OVERHEAD) * _US_PER_BYTE + airtime
+        else:
+            total = _ADV_CHANNELS * airtime
+        self.counters['adv_events'] += 1
+        self.counters['airtime_us'] += total
+        keys = message_keys(adv_data)
+        for key in keys:
+            message = self.messages.get(key)
+            if message is not None:
+                # Aggregates share the airtime between their messages
+                message['airtime_us'] += total / len(keys)
+                message['adv_events'] += 1
+                message['relays'].add(node.index)
+        for other, d in node.neighbors:
+            if self.rng.random() < self.loss:
+                self.counters['rx_lost'] += 1
+                continue
+            rssi = self.tx_power - 10 * self.path_loss_exponent * math.log10(max(d, 0.1))
+            rssi = int(round(rssi + self.rng.gauss(0, self.rssi_noise)))
+            rx = [self.now, self.now + airtime, False]
+            if self.collisions:
+                current = self._rx.get(other.index)
+                if current is not None and current[1] > self.now:
+                    current[2] = True
+                    rx[2] = True
+                self._rx[other.index] = rx
+            self.at(airtime, self._deliver, node, other, adv_data, rssi, rx, keys)
+
+    def _deliver(self, sender, receiver, adv_data, rssi, rx, keys):
+        if rx[2]:
+            self.counters['rx_collided'] += 1
+            return
+        if not receiver.radio.receive(sender.mac, adv_data, rssi):
+            self.counters['rx_not_listening'] += 1
+            return
+        self.counters['rx_delivered'] += 1
+        for key in keys:
+            message = self.messages.get(key)
+            if message is not None and receiver.index not in message['heard'] and receiver is not message['origin']:
+                message['heard'][receiver.index] = self.now - message['start']
+
+    def next_message(self, node, dest=None):
+        if self._next_id > 0xFFFF:
+            return None
+        message_id = self._next_id
+        self._next_id += 1
+        self.messages[message_id] = {'origin': node, 'start': self.now, 'heard': {},
+                                     'airtime_us': 0, 'adv_events': 0, 'relays': set(), 'dest': dest}
+        return message_id
+
+    # A new ID for an existing message, e.g. for a retransmission; 0 once the
+    # 16-bit ID space is used up.
+    def alias_message(self, message_id):
+        if self._next_id > 0xFFFF:
+            return 0
+        alias = self._next_id
+        self._next_id += 1
+        self.messages[alias] = self.messages[message_id]
+        return alias
+
+    # An ID that belongs to no message, e.g. for an ACK; 0 once the 16-bit ID
+    # space is used up.
+    def reserve_id(self):
+        if self._next_id > 0xFFFF:
+            return 0
+        self._next_id += 1
+        return self._next_id - 1
+
+    # MeshNode id_source for node: a retry of one of node's own messages is
+    # counted towards it, while an ACK (named after the message it
+    # acknowledges, which came from elsewhere) is nobody's traffic.
+    def id_source(self, node):
+        def source(old_id):
+            message = self.messages.get(old_id)
+            if message is not None and message['origin'] is node:
+                return self.alias_message(old_id)
+            return self.reserve_id()
+        return source
+
+    # A send the node refused (a full table), so it never went out
+    def refused(self, message_id):
+        self.messages[message_id]['refused'] = True
+
+    def restore_modules(self):
+        for name, module in self._host_modules.items():
+            if module is None:
+                sys.modules.pop(name, None)
+            else:
+                sys.modules[name] = module
+        self._host_modules = {}
+        for node in self.nodes:
+            node._entered = False
+
+    # The node whose scan results go to the trace
+    def traced_node(self):
+        for node in self.nodes:
+            if node.role == 'relay':
+                return node
+        return None
+
+    # A node reassembled a payload; it counts if it is the one sent to it.
+    def reassembled(self, node, message_id, payload):
+        message = self.messages.get(message_id)
+        if message is not None and message['dest'] is node and message.get('payload') == bytes(payload):
+            message.setdefault('reassembled', self.now - message['start'])
+
+    # Runs --------------------------------------------------------------------
+
+    def _reachable(self, origin):
+        seen = {origin.index}
+        frontier = [origin]
+        while frontier:
+            node = frontier.pop()
+            for other, _ in node.neighbors:
+                if other.index not in seen:
+                    seen.add(other.index)
+                    frontier.append(other)
+        seen.discard(origin.index)
+        return seen
+
+    def run(self, duration=30.0, drain=None):
+        if drain is None:
+            drain = max(self.hops, 1) * 2.0
+        wall = _host_time.perf_counter()
+        for node in self.nodes:
+            if node.role == 'originator':
+                node.load(('temp',), self._quiet)
+            else:
+                node.load(('main',), self._quiet)
+        self.originate_until = int(duration * 1000000)
+        for node in self.nodes:
+            loop = self._originate if node.role == 'originator' else self._relay
+            node.start(loop, self.rng.randint(0, 1000000))
+        try:
+            events = self._run_until(int((duration + drain) * 1000000))
+        finally:
+            for node in self.nodes:
+                node.stop()
+                if node.trace is not None:
+                    node.trace.flush()
+                    # The abandoned MeshNode.run() would flush it again when
+                    # collected, after the stream is closed
+                    node.mesh.scanner.trace = None
+            self.restore_modules()
+        return self.report(duration, drain, events, _host_time.perf_counter() - wall)
+
+    # Counters from every node's metrics module, summed by name
+    def _node_metrics(self):
+        totals = {}
+        for node in self.nodes:
+            module = node.modules.get('metrics')
+            if module is None or module.metrics is None:
+                continue
+            for name, value in zip(module.COUNTER_NAMES, module.metrics.counts):
+                if not name.startswith('boot_'):
+                    totals[name] = totals.get(name, 0) + value
+        return totals
+
+    # Time each relay took from its start to begin scanning and to relay its
+    # first message, in ms
+    def _boot_times(self):
+        times = {'scan': [], 'relay': []}
+        for node in self.nodes:
+            module = node.modules.get('metrics')
+            if node.role != 'relay' or node.started_ms is None or module is None or module.metrics is None:
+                continue
+            counts = module.metrics.counts
+            for key, counter in (('scan', module.BOOT_SCAN_MS), ('relay', module.BOOT_RELAY_MS)):
+                if counts[counter]:
+                    times[key].append(max(counts[counter] - node.started_ms, 0))
+        return {key: _summary(values, 1) for key, values in times.items()}
+
+    # Mean share of the time the relays' radios spent listening
+    def _scan_duty(self):
+        relays = [node for node in self.nodes if node.role == 'relay']
+        if not relays or not self.now:
+            return 0.0
+        for node in relays:
+            node.radio.account_listening()
+        return round(sum(node.radio.listen_us for node in relays) / len(relays) / self.now, 3)
+
+    # Acknowledgement counters of every reliable node, summed
+    def _ack_stats(self):
+        totals = {}
+        for node in self.nodes:
+            if node.mesh is None or node.mesh.acks is None:
+                continue
+            for name, value in node.mesh.acks.stats().items():
+                if name != 'capacity':
+                    totals[name] = totals.get(name, 0) + value
+        return totals
+
+    def report(self, duration, drain, events, wall_s):
+        reach = {}
+        expected = 0
+        delivered = 0
+        latencies = []
+        floods = []
+        airtime = []
+        adv_events = []
+        relays = []
+        unicast = {'messages': 0, 'refused': 0, 'delivered': 0, 'latencies': [], 'relays': 0, 'airtime_us': 0,
+                   'payloads': 0, 'reassembled': []}
+        seen = set()
+        for message in self.messages.values():
+            # Retransmissions share the message under several IDs
+            if id(message) in seen:
+                continue
+            seen.add(id(message))
+            origin = message['origin']
+            dest = message['dest']
+            if dest is not None:
+                if message.get('refused'):
+                    unicast['refused'] += 1
+                    continue
+                unicast['messages'] += 1
+                if dest.index in message['heard']:
+                    unicast['delivered'] += 1
+                    unicast['latencies'].append(message['heard'][dest.index])
+                unicast['relays'] += len(message['relays'] - {origin.index})
+                unicast['airtime_us'] += message['airtime_us']
+                if 'payload' in message:
+                    unicast['payloads'] += 1
+                    if 'reassembled' in message:
+                        unicast['reassembled'].append(message['reassembled'])
+                continue
+            if origin.index not in reach:
+                reach[origin.index] = self._reachable(origin)
+            targets = reach[origin.index]
+            heard = [t for i, t in message['heard'].items() if i in targets]
+            expected += len(targets)
+            delivered += len(heard)
+            latencies.extend(heard)
+            if targets and len(heard) == len(targets):
+                floods.append(max(heard))
+            airtime.append(message['airtime_us'])
+            adv_events.append(message['adv_events'])
+            relays.append(len(message['relays'] - {origin.index}))
+        count = len(airtime)
+        sent = unicast['messages']
+        return {
+            'nodes': len(self.nodes),
+            'duration_s': duration,
+            'drain_s': drain,
+            'messages': count,
+            'delivery_ratio': delivered / expected if expected else 0.0,
+            'latency_ms': _summary(latencies, 1000),
+            'flood_latency_ms': _summary(floods, 1000),
+            'complete_floods': len(floods),
+            'airtime_per_message_ms': sum(airtime) / count / 1000 if count else 0.0,
+            'adv_events_per_message': sum(adv_events) / count if count else 0.0,
+            'relays_per_message': sum(relays) / count if count else 0.0,
+            'unicast': {
+                'messages': sent,
+                'refused': unicast['refused'],
+                'delivery_ratio': unicast['delivered'] / sent if sent else 0.0,
+                'latency_ms': _summary(unicast['latencies'], 1000),
+                'relays_per_message': unicast['relays'] / sent if sent else 0.0,
+                'airtime_per_message_ms': unicast['airtime_us'] / sent / 1000 if sent else 0.0,
+                'payload_delivery_ratio': (len(unicast['reassembled']) / unicast['payloads']
+                                           if unicast['payloads'] else 0.0),
+                'payload_latency_ms': _summary(unicast['reassembled'], 1000),
+            },
+            'acks': self._ack_stats(),
+            'radio': dict(self.counters),
+            'scan_duty': self._scan_duty(),
+            'boot_ms': self._boot_times(),
+            'registrations': sum(n.stats['registrations'] for n in self.nodes),
+            'irq_errors': sum(n.stats['irq_errors'] for n in self.nodes),
+            'node_errors': sum(n.stats['node_errors'] for n in self.nodes),
+            'node_metrics': self._node_metrics(),
+            'events': events,
+            'wall_s': round(wall_s, 3),
+        }
+
+
+def _summary(values, scale):
+    if not values:
+        return {'count': 0}
+    values = sorted(values)
+    n = len(values)
+    return {
+        'count': n,
+        'mean': sum(values) / n / scale,
+        'p50': values[n // 2] / scale,
+        'p95': values[min(n - 1, int(n * 0.95))] / scale,
+        'max': values[-1] / scale,
+    }
+
+
+def _print_report(report):
+    print('nodes %d, %d messages over %.1f s (+%.1f s drain)' % (
+        report['nodes'], report['messages'], report['duration_s'], report['drain_s']))
+    print('delivery ratio      %.3f' % report['delivery_ratio'])
+    for label, key in (('latency', 'latency_ms'), ('flood latency', 'flood_latency_ms')):
+        s = report[key]
+        if s['count']:
+            print('%-19s p50 %.1f ms  p95 %.1f ms  max %.1f ms  (n=%d)' % (
+                label, s['p50'], s['p95'], s['max'], s['count']))
+        else:
+            print('%-19s n/a' % label)
+    print('airtime/message     %.3f ms (%.1f adv events)' % (
+        report['airtime_per_message_ms'], report['adv_events_per_message']))
+    print('relays/message      %.2f nodes' % report['relays_per_message'])
+    unicast = report['unicast']
+    if unicast['messages'] or unicast['refused']:
+        s = unicast['latency_ms']
+        print('unicast             %d messages (%d refused), delivery %.3f, p50 %.1f ms, %.2f relays, %.3f ms airtime per message' % (
+            unicast['messages'], unicast['refused'], unicast['delivery_ratio'], s.get('p50', 0.0),
+            unicast['relays_per_message'], unicast['airtime_per_message_ms']))
+        s = unicast['payload_latency_ms']
+        if s['count'] or unicast['payload_delivery_ratio']:
+            print('payloads            reassembled %.3f, p50 %.1f ms' % (
+                unicast['payload_delivery_ratio'], s.get('p50', 0.0)))
+    if report['acks']:
+        print('acks                %s' % report['acks'])
+    print('radio               %s' % report['radio'])
+    print('scan duty           %.3f' % report['scan_duty'])
+    for label, key in (('boot to scan', 'scan'), ('boot to relay', 'relay')):
+        s = report['boot_ms'][key]
+        if s['count']:
+            print('%-19s p50 %.1f ms  p95 %.1f ms  max %.1f ms  (n=%d)' % (
+                label, s['p50'], s['p95'], s['max'], s['count']))
+    print('node metrics        %s' % report['node_metrics'])
+    print('registrations %d, irq errors %d, node errors %d' % (
+        report['registrations'], report['irq_errors'], report['node_errors']))
+    print('%d events in %.2f s wall' % (report['events'], report['wall_s']))
+
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description='Simulate a BLE flood mesh of virtual nodes.')
+    parser.add_argument('--nodes', type=int, default=25)
+    parser.add_argument('--topology', choices=('grid', 'line', 'random'), default='grid')
+    parser.add_argument('--spacing', type=float, default=10.0, help='node spacing in metres')
+    parser.add_argument('--range', dest='radio_range', type=float, default=15.0, help='radio range in metres')
+    parser.add_argument('--loss', type=float, default=0.0, help='per-packet loss probability')
+    parser.add_argument('--originators', type=int, default=1)
+    parser.add_argument('--hops', type=int, default=5)
+    parser.add_argument('--interval', type=float, default=2.0, help='seconds between originated messages')
+    parser.add_argument('--duration', type=float, default=30.0)
+    parser.add_argument('--drain', type=float, default=None)
+    parser.add_argument('--no-collisions', action='store_true')
+    parser.add_argument('--relay', choices=tuple(_RELAY_LOOPS), default='runtime',
+                        help='main.read_and_respond, main.relay_continuous or the meshNode.MeshNode runtime')
+    parser.add_argument('--aggregate', action='store_true', help='pack pending relays into one advertisement')
+    parser.add_argument('--scheduler', action='store_true', help='rotate pending relays through one advertising window')
+    parser.add_argument('--extended', action='store_true', help='radios support BLE 5 extended advertising')
+    parser.add_argument('--policy', choices=tuple(POLICIES), default='flood', help='relay policy for the runtime relay')
+    parser.add_argument('--routing', action='store_true', help='gradient routing for addressed messages')
+    parser.add_argument('--dual-core', action='store_true', help='decode scan results on a second (virtual) core')
+    parser.add_argument('--payload', type=int, default=0,
+                        help='bytes of fragmented payload in each unicast message')
+    parser.add_argument('--reliable', action='store_true', help='acknowledge and retransmit unicast messages')
+    parser.add_argument('--unicast', type=float, default=None,
+                        help='seconds between unicast messages sent by each relay (runtime relay)')
+    parser.add_argument('--adaptive', action='store_true',
+                        help='adapt scan and advertising parameters to the traffic (runtime relay)')
+    parser.add_argument('--trace', default=None,
+                        help='record the scan results of the first relay to this file (runtime relay)')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', action='store_true')
+    args = parser.parse_args(argv)
+
+    rng = random.Random(args.seed)
+    positions = layout(args.topology, args.nodes, args.spacing, rng)
+    options = {'policy': POLICIES[args.policy]}
+    if args.aggregate:
+        options['aggregate'] = True
+    if args.extended:
+        options['extended'] = True
+    if args.routing:
+        options['routing'] = True
+    if args.scheduler:
+        options['scheduler'] = True
+    if args.reliable:
+        options['reliable'] = True
+    if args.dual_core:
+        options['dual_core'] = True
+    if args.payload:
+        options['reassemble'] = True
+    if args.adaptive:
+        options['duty_cycle'] = lambda module: module.DutyCycleController()
+    sim = Simulator(positions, radio_range=args.radio_range, loss=args.loss,
+                    originators=args.originators, hops=args.hops,
+                    message_interval=args.interval, seed=args.seed,
+                    collisions=not args.no_collisions,
+                    relay=_RELAY_LOOPS[args.relay], extended=args.extended,
+                    node_options=options, unicast_interval=args.unicast,
+                    payload_bytes=args.payload)
+    if args.trace:
+        with open(args.trace, 'wb') as sim.trace:
+            report = sim.run(args.duration, args.drain)
+    else:
+        report = sim.run(args.duration, args.drain)
+    if args.json:
+        print(json.dumps(report))
+    else:
+        _print_report(report)
+    return report
+
+
+if __name__ == '__main__':
+    main()
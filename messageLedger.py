@@ -0,0 +1,307 @@
+# Duplicate-suppression ledger for relayed mesh messages.
+#
+# Entries are keyed on (sender, messageID) and kept in fixed-size arrays: a ring
+# of keys and timestamps in insertion order, plus an open-addressing hash index
+# into that ring. Lookup and insert are O(1); memory never grows after
+# construction. When the ring is full the oldest entry is evicted, and entries
+# older than ttl_ms are expired lazily on every call.
+#
+# save() writes the ring to a stream as a fixed-size image, header followed by
+# the raw sender, ID and timestamp arrays (native byte order, little-endian on
+# the RP2040), and restore() reads it back in one bulk read per array, so a
+# node that resets keeps suppressing the messages it has already relayed.
+# Header, little-endian:
+#   0-1   b'ML'
+#   2     image version
+#   3     reserved
+#   4-5   capacity
+#   6-7   entries
+#   8-9   ring head
+#   10-11 reserved
+#   12-15 ticks_ms when saved (i32)
+#   16-19 wall clock seconds when saved, 0 if unknown (u32)
+#   20-23 CRC-32 of the arrays
+# LedgerStore keeps such an image on flash.
+
+import os
+import struct
+import time
+import ubinascii
+from array import array
+from micropython import const
+
+_EMPTY = const(-1)
+_IMAGE_VERSION = const(1)
+_IMAGE_MAGIC = b'ML'
+_IMAGE_HEADER = '<2sBxHHHxxiII'
+_IMAGE_HEADER_LEN = const(24)
+# The RTC counts from 2021 after a reset until something sets it
+_RTC_SET_YEAR = const(2024)
+
+
+def _crc(senders, ids, stamps):
+    crc = ubinascii.crc32(senders)
+    crc = ubinascii.crc32(ids, crc)
+    return ubinascii.crc32(stamps, crc) & 0xFFFFFFFF
+
+
+class MessageLedger:
+    def __init__(self, capacity=256, ttl_ms=60000):
+        if not 0 < capacity < 16384:
+            raise ValueError("capacity must be between 1 and 16383")
+        size = 1
+        while size < capacity * 2:
+            size <<= 1
+        self.capacity = capacity
+        self.ttl_ms = ttl_ms
+        self._mask = size - 1
+        self._index = array('h', [_EMPTY] * size)
+        self._senders = array('H', bytes(2 * capacity))
+        self._ids = array('H', bytes(2 * capacity))
+        self._stamps = array('i', bytes(4 * capacity))
+        self._head = 0
+        self._count = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        # Entries ever added, so a store can tell when it has changed
+        self.inserts = 0
+
+    def __len__(self):
+        return self._count
+
+    def _hash(self, sender, message_id):
+        return ((sender * 0x9E5) ^ (message_id * 0x3B1) ^ (message_id >> 7)) & self._mask
+
+    def _find(self, sender, message_id):
+        index = self._index
+        mask = self._mask
+        i = self._hash(sender, message_id)
+        while True:
+            slot = index[i]
+            if slot == _EMPTY:
+                return _EMPTY
+            if self._ids[slot] == message_id and self._senders[slot] == sender:
+                return i
+            i = (i + 1) & mask
+
+    def _remove(self, slot):
+        # Backward-shift deletion keeps linear probe chains intact without
+        # tombstones.
+        index = self._index
+        mask = self._mask
+        i = self._hash(self._senders[slot], self._ids[slot])
+        while index[i] != slot:
+            i = (i + 1) & mask
+        j = i
+        while True:
+            j = (j + 1) & mask
+            moved = index[j]
+            if moved == _EMPTY:
+                break
+            k = self._hash(self._senders[moved], self._ids[moved])
+            if (i <= j and i < k <= j) or (i > j and (k > i or k <= j)):
+                continue
+            index[i] = moved
+            i = j
+        index[i] = _EMPTY
+        self._count -= 1
+
+    def _oldest(self):
+        return (self._head - self._count) % self.capacity
+
+    def expire(self, now=None):
+        if now is None:
+            now = time.ticks_ms()
+        stamps = self._stamps
+        ttl = self.ttl_ms
+        while self._count:
+            slot = self._oldest()
+            if time.ticks_diff(now, stamps[slot]) < ttl:
+                break
+            self._remove(slot)
+            self.expirations += 1
+
+    def seen(self, sender, message_id, now=None):
+        self.expire(now)
+        return self._find(sender, message_id) != _EMPTY
+
+    def add(self, sender, message_id, now=None):
+        if now is None:
+            now = time.ticks_ms()
+        self.expire(now)
+        if self._find(sender, message_id) == _EMPTY:
+            self._insert(sender, message_id, now)
+
+    # Record the message and return True if it is new, False for a duplicate.
+    def check_and_add(self, sender, message_id, now=None):
+        if now is None:
+            now = time.ticks_ms()
+        self.expire(now)
+        if self._find(sender, message_id) != _EMPTY:
+            self.hits += 1
+            return False
+        self.misses += 1
+        self._insert(sender, message_id, now)
+        return True
+
+    def _insert(self, sender, message_id, now):
+        if self._count == self.capacity:
+            self._remove(self._oldest())
+            self.evictions += 1
+        slot = self._head
+        self._senders[slot] = sender
+        self._ids[slot] = message_id
+        self._stamps[slot] = now
+        self._link(slot)
+        self._head = (slot + 1) % self.capacity
+        self._count += 1
+        self.inserts += 1
+
+    def _link(self, slot):
+        index = self._index
+        mask = self._mask
+        i = self._hash(self._senders[slot], self._ids[slot])
+        while index[i] != _EMPTY:
+            i = (i + 1) & mask
+        index[i] = slot
+
+
+    # Write the ledger image to stream. wall_s is the time in seconds on a
+    # clock that survives a reset (the RTC once it has been set), or 0.
+    def save(self, stream, wall_s=0, now=None):
+        if now is None:
+            now = time.ticks_ms()
+        stream.write(struct.pack(_IMAGE_HEADER, _IMAGE_MAGIC, _IMAGE_VERSION, self.capacity, self._count,
+                                 self._head, now, wall_s, _crc(self._senders, self._ids, self._stamps)))
+        stream.write(self._senders)
+        stream.write(self._ids)
+        stream.write(self._stamps)
+
+    # Replace the contents with an image read from stream and return the
+    # number of entries restored. Entries that had been in the ledger for
+    # ttl_ms by now are left out. Their age counts from when the image was
+    # saved, plus the time since then on the wall clock if both that and
+    # wall_s are known. An image that does not match this ledger's capacity,
+    # or fails its CRC, restores nothing and leaves the ledger as it was: the
+    # arrays are read into new ones, which replace the old only once checked.
+    def restore(self, stream, wall_s=0, now=None):
+        header = stream.read(_IMAGE_HEADER_LEN)
+        if len(header) < _IMAGE_HEADER_LEN:
+            return 0
+        magic, version, capacity, count, head, saved, saved_wall, crc = struct.unpack(_IMAGE_HEADER, header)
+        if magic != _IMAGE_MAGIC or version != _IMAGE_VERSION or capacity != self.capacity or count > capacity or head >= capacity:
+            return 0
+        senders = array('H', bytes(2 * capacity))
+        ids = array('H', bytes(2 * capacity))
+        stamps = array('i', bytes(4 * capacity))
+        n = stream.readinto(senders) + stream.readinto(ids) + stream.readinto(stamps)
+        if n != 8 * capacity or _crc(senders, ids, stamps) != crc:
+            return 0
+        self.clear()
+        self._senders = senders
+        self._ids = ids
+        self._stamps = stamps
+        if now is None:
+            now = time.ticks_ms()
+        down = (wall_s - saved_wall) * 1000 if wall_s and saved_wall and wall_s >= saved_wall else 0
+        ttl = self.ttl_ms
+        oldest = (head - count) % capacity
+        # The ring is in insertion order, so the live entries are the newest
+        while count and time.ticks_diff(saved, stamps[oldest]) + down >= ttl:
+            oldest = (oldest + 1) % capacity
+            count -= 1
+        self._head = head
+        self._count = count
+        for k in range(count):
+            slot = (oldest + k) % capacity
+            stamps[slot] = time.ticks_add(now, -(time.ticks_diff(saved, stamps[slot]) + down))
+            self._link(slot)
+        return count
+
+    def clear(self):
+        for i in range(len(self._index)):
+            self._index[i] = _EMPTY
+        self._head = 0
+        self._count = 0
+
+    def stats(self):
+        return {
+            'size': self._count,
+            'capacity': self.capacity,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+        }
+
+
+# Seconds on the RTC, or 0 while it has not been set since the last reset
+def _wall_s():
+    if not hasattr(time, 'localtime') or time.localtime()[0] < _RTC_SET_YEAR:
+        return 0
+    return int(time.time())
+
+
+# Keeps the image of a ledger in a file on flash. save() replaces the file as
+# a whole through a temporary one and a rename, so a reset mid-write leaves the
+# previous image; maybe_save(), called periodically, saves only when the
+# ledger has changed and interval_ms has passed since the last save, which
+# bounds the flash writes (and wear) to one small file every interval_ms.
+class LedgerStore:
+    def __init__(self, ledger, path='ledger.bin', interval_ms=30000):
+        self.ledger = ledger
+        self.path = path
+        self.interval_ms = interval_ms
+        self._saved_inserts = ledger.inserts
+        self._saved_at = time.ticks_ms()
+        self.restored = 0
+        self.saves = 0
+        self.errors = 0
+
+    # Restore the ledger from the file, if there is one. Returns the number of
+    # entries restored.
+    def load(self):
+        try:
+            with open(self.path, 'rb') as f:
+                self.restored = self.ledger.restore(f, _wall_s())
+        except OSError:
+            self.restored = 0
+        self._saved_inserts = self.ledger.inserts
+        return self.restored
+
+    def save(self):
+        tmp = self.path + '.tmp'
+        try:
+            with open(tmp, 'wb') as f:
+                self.ledger.save(f, _wall_s())
+            try:
+                os.rename(tmp, self.path)
+            except OSError:
+                # Filesystems that will not rename over an existing file
+                os.remove(self.path)
+                os.rename(tmp, self.path)
+        except OSError:
+            self.errors += 1
+            return False
+        self._saved_inserts = self.ledger.inserts
+        self._saved_at = time.ticks_ms()
+        self.saves += 1
+        return True
+
+    def maybe_save(self, now=None):
+        if self.ledger.inserts == self._saved_inserts:
+            return False
+        if now is None:
+            now = time.ticks_ms()
+        if time.ticks_diff(now, self._saved_at) < self.interval_ms:
+            return False
+        return self.save()
+
+    def stats(self):
+        return {
+            'restored': self.restored,
+            'saves': self.saves,
+            'errors': self.errors,
+        }
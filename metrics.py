@@ -0,0 +1,138 @@
+# Node metrics: counters and log2 histograms in preallocated arrays.
+#
+# The hot paths bump entries of `metrics.counts` directly and call observe()
+# for timings, so recording never allocates. snapshot() packs everything into
+# one reusable buffer, which the node publishes on the distance characteristic
+# and dump() prints on the serial console as a hex line:
+#   METRICS <hex>
+# Run this file on the host to decode those lines from a serial log or pipe:
+#   python metrics.py < /dev/ttyACM0
+#
+# Snapshot layout, little-endian:
+#   0-1   b'MX'
+#   2     layout version
+#   3     number of counters C
+#   4     number of histograms H
+#   5     buckets per histogram B
+#   6-9   uptime in ms (u32)
+#   10-   C counters, then H x B histogram buckets (u32 each)
+# Bucket i of a histogram counts values v with 2**(i-1) <= v < 2**i (bucket 0
+# is v < 1); the last bucket also takes everything larger.
+
+import struct
+import time
+from array import array
+try:
+    from micropython import const
+except ImportError:
+    # Host side, for decode_snapshot
+    def const(value):
+        return value
+
+SNAPSHOT_VERSION = const(1)
+_HEADER = const(10)
+
+# Counters
+SCANNED = const(0)
+FILTERED = const(1)
+DUPLICATES = const(2)
+DECODE_ERRORS = const(3)
+ACCEPTED = const(4)
+QUEUE_DROPS = const(5)
+FORWARDED = const(6)
+ADVERTISED = const(7)
+ADV_MS = const(8)
+# Boot milestones, as ms since reset (ticks_ms); 0 until reached. See mark().
+BOOT_SCAN_MS = const(9)
+BOOT_RELAY_MS = const(10)
+COUNTER_NAMES = ('scanned', 'filtered', 'duplicates', 'decode_errors', 'accepted',
+                 'queue_drops', 'forwarded', 'advertised', 'adv_ms', 'boot_scan_ms', 'boot_relay_ms')
+
+# Histograms
+IRQ_US = const(0)
+FORWARD_LATENCY_MS = const(1)
+ADV_DWELL_MS = const(2)
+HISTOGRAM_NAMES = ('irq_us', 'forward_latency_ms', 'adv_dwell_ms')
+
+BUCKETS = const(16)
+
+
+class Metrics:
+    def __init__(self):
+        self.counts = array('I', bytes(4 * len(COUNTER_NAMES)))
+        self.histograms = array('I', bytes(4 * len(HISTOGRAM_NAMES) * BUCKETS))
+        self.snapshot_len = _HEADER + 4 * (len(self.counts) + len(self.histograms))
+        self._buf = bytearray(self.snapshot_len)
+        self._start = time.ticks_ms()
+
+    def observe(self, histogram, value):
+        bucket = 0
+        while value >= 1 and bucket < BUCKETS - 1:
+            value >>= 1
+            bucket += 1
+        self.histograms[histogram * BUCKETS + bucket] += 1
+
+    # Record when a boot milestone counter is first reached: scanning started,
+    # first relay. Returns True that first time.
+    def mark(self, counter):
+        if self.counts[counter]:
+            return False
+        self.counts[counter] = max(time.ticks_ms(), 1)
+        return True
+
+    # Print the boot milestones on the console.
+    def boot_report(self):
+        print('BOOT scan %d ms, first relay %d ms' % (self.counts[BOOT_SCAN_MS], self.counts[BOOT_RELAY_MS]))
+
+    def reset(self):
+        for i in range(len(self.counts)):
+            self.counts[i] = 0
+        for i in range(len(self.histograms)):
+            self.histograms[i] = 0
+        self._start = time.ticks_ms()
+
+    # Pack the current values into the shared snapshot buffer and return it.
+    def snapshot(self):
+        buf = self._buf
+        struct.pack_into('<2sBBBBI', buf, 0, b'MX', SNAPSHOT_VERSION, len(COUNTER_NAMES),
+                         len(HISTOGRAM_NAMES), BUCKETS,
+                         time.ticks_diff(time.ticks_ms(), self._start) & 0xFFFFFFFF)
+        offset = _HEADER
+        for values in (self.counts, self.histograms):
+            for v in values:
+                struct.pack_into('<I', buf, offset, v)
+                offset += 4
+        return buf
+
+    # Print the snapshot as one hex line on the console (USB serial).
+    def dump(self):
+        print('METRICS', self.snapshot().hex())
+
+
+# Shared by every module on the node; None on a host without the stand-ins,
+# where only decode_snapshot is of use
+metrics = Metrics() if hasattr(time, 'ticks_ms') else None
+
+
+# Snapshot bytes back to a dict of counters and histograms (bucket lists).
+def decode_snapshot(data):
+    magic, version, counters, histograms, buckets, uptime = struct.unpack_from('<2sBBBBI', data, 0)
+    if magic != b'MX' or version != SNAPSHOT_VERSION:
+        raise ValueError("not a metrics snapshot")
+    values = struct.unpack_from('<%dI' % (counters + histograms * buckets), data, _HEADER)
+    result = {'uptime_ms': uptime}
+    for i in range(counters):
+        result[COUNTER_NAMES[i] if i < len(COUNTER_NAMES) else 'counter%d' % i] = values[i]
+    for h in range(histograms):
+        name = HISTOGRAM_NAMES[h] if h < len(HISTOGRAM_NAMES) else 'histogram%d' % h
+        start = counters + h * buckets
+        result[name] = list(values[start:start + buckets])
+    return result
+
+
+if __name__ == '__main__':
+    import json
+    import sys
+    for line in sys.stdin:
+        if line.startswith('METRICS '):
+            print(json.dumps(decode_snapshot(bytes.fromhex(line[8:].strip()))))
@@ -0,0 +1,299 @@
+# Per-neighbour RSSI history with filtered distance estimates.
+#
+# Each neighbour heard on the scan path gets a preallocated Neighbor record
+# holding a ring of its last `window` RSSI samples, the same samples kept in
+# sorted order for a running median, and a one-dimensional Kalman estimate.
+# Both filters are updated incrementally per sample. Records are recycled in
+# least-recently-heard order once the table is full, so memory is fixed at
+# construction whatever the number of neighbours. Records are found by MAC
+# through an open-addressed index of record numbers, and each keeps its MAC
+# in a buffer of its own, so a sample allocates nothing.
+#
+# Distance uses the log-distance path-loss model:
+#   d = 10 ** ((tx_power - rssi) / (10 * n))
+# where tx_power is the RSSI at 1 m and n the path-loss exponent.
+
+import time
+from array import array
+from micropython import const
+
+_TX_POWER = const(-59)
+_WINDOW = const(8)
+_MAC_LEN = const(6)
+_EMPTY = const(-1)
+_GENERATIONS = const(0x4000)
+
+FILTER_KALMAN = const(0)
+FILTER_MEDIAN = const(1)
+
+
+def rssi_to_distance(rssi, tx_power=_TX_POWER, path_loss_exponent=2.0):
+    return 10 ** ((tx_power - rssi) / (10 * path_loss_exponent))
+
+
+# Small-int hash of a MAC, the same for bytes, bytearray and memoryview
+def _hash(mac):
+    h = ((mac[0] ^ mac[3]) << 16) | ((mac[1] ^ mac[4]) << 8) | (mac[2] ^ mac[5])
+    return h ^ (h >> 8) ^ (h >> 16)
+
+
+def _same(a, b):
+    for i in range(_MAC_LEN):
+        if a[i] != b[i]:
+            return False
+    return True
+
+
+# key names the record while it holds one neighbour: it changes whenever the
+# record is recycled, and is -1 while it is free.
+class Neighbor:
+    __slots__ = ('mac', 'index', 'key', 'bucket', 'rssi', 'variance', 'samples', 'sorted', 'count', 'head', 'last_seen', 'prev', 'next')
+
+    def __init__(self, window, index):
+        self.mac = bytearray(_MAC_LEN)
+        self.index = index
+        self.key = _EMPTY
+        self.bucket = _EMPTY
+        self.samples = array('b', bytes(window))
+        self.sorted = array('b', bytes(window))
+        self.prev = None
+        self.next = None
+        self.reset()
+
+    def reset(self):
+        self.rssi = 0.0
+        self.variance = 0.0
+        self.count = 0
+        self.head = 0
+        self.last_seen = 0
+
+    # Running median over the filled part of the window
+    def median(self):
+        n = min(self.count, len(self.samples))
+        if not n:
+            return None
+        s = self.sorted
+        if n & 1:
+            return s[n // 2]
+        return (s[n // 2 - 1] + s[n // 2]) / 2
+
+
+class NeighborTable:
+    # q and r are the Kalman process and measurement noise variances in dB^2
+    def __init__(self, capacity=64, window=_WINDOW, tx_power=_TX_POWER, path_loss_exponent=2.0, mode=FILTER_KALMAN, q=0.5, r=4.0):
+        if capacity <= 0 or not 0 < window <= 255:
+            raise ValueError("capacity must be positive and window between 1 and 255")
+        self.capacity = capacity
+        self.window = window
+        self.tx_power = tx_power
+        self.path_loss_exponent = path_loss_exponent
+        self.mode = mode
+        self.q = q
+        self.r = r
+        self._records = [Neighbor(window, i) for i in range(capacity)]
+        # Record numbers by MAC hash, linear probing, at most half full
+        size = 2
+        while size < 2 * capacity:
+            size <<= 1
+        self._buckets = array('h', [_EMPTY] * size)
+        self._mask = size - 1
+        self._count = 0
+        self._generation = 0
+        # Free records, then a doubly linked LRU list: _head most recent
+        self._free = list(self._records)
+        self._head = None
+        self._tail = None
+        self.evictions = 0
+        self.samples = 0
+
+    def __len__(self):
+        return self._count
+
+    def _find(self, mac):
+        buckets = self._buckets
+        mask = self._mask
+        i = _hash(mac) & mask
+        while True:
+            k = buckets[i]
+            if k < 0:
+                return None
+            n = self._records[k]
+            if _same(n.mac, mac):
+                return n
+            i = (i + 1) & mask
+
+    def _insert(self, n):
+        buckets = self._buckets
+        mask = self._mask
+        i = _hash(n.mac) & mask
+        while buckets[i] >= 0:
+            i = (i + 1) & mask
+        buckets[i] = n.index
+        n.bucket = i
+        self._count += 1
+
+    # Take n out of the index, moving later entries of its probe run back
+    # into the gap so that lookups never stop short of them
+    def _remove(self, n):
+        buckets = self._buckets
+        mask = self._mask
+        i = n.bucket
+        buckets[i] = _EMPTY
+        j = i
+        while True:
+            j = (j + 1) & mask
+            k = buckets[j]
+            if k < 0:
+                break
+            m = self._records[k]
+            home = _hash(m.mac) & mask
+            # m stays put if its home lies cyclically in (i, j]
+            if (home - i - 1) & mask < (j - i) & mask:
+                continue
+            buckets[i] = k
+            m.bucket = i
+            buckets[j] = _EMPTY
+            i = j
+        n.bucket = _EMPTY
+        n.key = _EMPTY
+        self._count -= 1
+
+    def _unlink(self, n):
+        if n.prev is None:
+            self._head = n.next
+        else:
+            n.prev.next = n.next
+        if n.next is None:
+            self._tail = n.prev
+        else:
+            n.next.prev = n.prev
+        n.prev = n.next = None
+
+    def _push_front(self, n):
+        n.next = self._head
+        if self._head is not None:
+            self._head.prev = n
+        self._head = n
+        if self._tail is None:
+            self._tail = n
+
+    def _acquire(self, mac):
+        if self._free:
+            n = self._free.pop()
+        else:
+            n = self._tail
+            self._unlink(n)
+            self._remove(n)
+            self.evictions += 1
+        n.reset()
+        for i in range(_MAC_LEN):
+            n.mac[i] = mac[i]
+        self._generation = (self._generation + 1) % _GENERATIONS
+        n.key = self._generation * self.capacity + n.index
+        self._insert(n)
+        return n
+
+    # Record one RSSI sample from mac (any 6-byte buffer) and return its
+    # Neighbor record.
+    def update(self, mac, rssi, now=None):
+        n = self._find(mac)
+        if n is None:
+            n = self._acquire(mac)
+        else:
+            self._unlink(n)
+        self._push_front(n)
+        n.last_seen = time.ticks_ms() if now is None else now
+        self.samples += 1
+
+        # Rolling window and its sorted copy: drop the outgoing sample, insert
+        # the new one in place
+        window = self.window
+        samples = n.samples
+        s = n.sorted
+        filled = min(n.count, window)
+        if filled == window:
+            old = samples[n.head]
+            i = 0
+            while s[i] != old:
+                i += 1
+            while i < filled - 1:
+                s[i] = s[i + 1]
+                i += 1
+            filled -= 1
+        i = filled
+        while i > 0 and s[i - 1] > rssi:
+            s[i] = s[i - 1]
+            i -= 1
+        s[i] = rssi
+        samples[n.head] = rssi
+        n.head = (n.head + 1) % window
+
+        # Scalar Kalman filter on RSSI
+        if n.count == 0:
+            n.rssi = rssi
+            n.variance = self.r
+        else:
+            p = n.variance + self.q
+            k = p / (p + self.r)
+            n.rssi += k * (rssi - n.rssi)
+            n.variance = (1 - k) * p
+        n.count += 1
+        return n
+
+    def get(self, mac):
+        return self._find(mac)
+
+    # The record a Neighbor.key was taken from, or None once it has been
+    # recycled or dropped
+    def by_key(self, key):
+        n = self._records[key % self.capacity]
+        return n if n.key == key else None
+
+    def _rssi(self, n):
+        if n is None:
+            return None
+        return n.median() if self.mode == FILTER_MEDIAN else n.rssi
+
+    def _distance(self, n):
+        rssi = self._rssi(n)
+        if rssi is None:
+            return None
+        return rssi_to_distance(rssi, self.tx_power, self.path_loss_exponent)
+
+    # Filtered RSSI for mac, or None if it has not been heard
+    def rssi(self, mac):
+        return self._rssi(self._find(mac))
+
+    # Estimated distance to mac in metres, or None if it has not been heard
+    def distance(self, mac):
+        return self._distance(self._find(mac))
+
+    # Estimated distance to the neighbour of a Neighbor.key, or None if its
+    # record has been recycled or dropped since
+    def key_distance(self, key):
+        return self._distance(self.by_key(key))
+
+    # Drop neighbours not heard for max_age_ms
+    def expire(self, max_age_ms, now=None):
+        if now is None:
+            now = time.ticks_ms()
+        while self._tail is not None and time.ticks_diff(now, self._tail.last_seen) >= max_age_ms:
+            n = self._tail
+            self._unlink(n)
+            self._remove(n)
+            self._free.append(n)
+
+    def clear(self):
+        while self._tail is not None:
+            n = self._tail
+            self._unlink(n)
+            self._remove(n)
+            self._free.append(n)
+
+    def stats(self):
+        return {
+            'size': self._count,
+            'capacity': self.capacity,
+            'samples': self.samples,
+            'evictions': self.evictions,
+        }
@@ -1,9 +1,19 @@
 import bluetooth
 import struct
 import time
-from micropython import const
-from machine import Pin
+import asyncio
+from micropython import const, schedule
+from array import array
 import ubinascii
+try:
+    import _thread
+except ImportError:
+    # Port built without threads: threaded scanning is unavailable
+    _thread = None
+from advertisementPacket import decode_adv, decode_record, FIELD_COUNT, FIELD_MFG, FIELD_HOP, FIELD_SENDER, FIELD_NAME, FIELD_ID, FIELD_TTL, FIELD_ACK, FIELD_FRAGMENT, FIELD_DATA, FIELD_RECORDS, MESH_RECORD_LEN, WALK_LEN, fragment_len
+from messageLedger import MessageLedger
+from bleSession import attach
+from metrics import metrics, SCANNED, FILTERED, DUPLICATES, DECODE_ERRORS, ACCEPTED, QUEUE_DROPS, IRQ_US, BOOT_SCAN_MS
 
 _IRQ_SCAN_RESULT = const(5)
 _IRQ_SCAN_DONE = const(6)
@@ -23,19 +33,203 @@ _ADV_TYPE_DIST = const(0x16)
 _ADV_TYPE_SENDER = const(0x17)
 _ADV_TYPE_ID = const(0x18)
 
+# Scans listen 9 ms out of every 10 ms unless set otherwise; a one-off scan
+# lasts 500 ms, a continuous one until stopped
+_SCAN_INTERVAL_US = const(10000)
+_SCAN_WINDOW_US = const(9000)
+_SCAN_MS = const(500)
+
+_ADV_MAX_LEN = const(31)
+_ADDR_LEN = const(6)
+
+# Bounded FIFO filled from the scan IRQ and drained by the forwarding loop.
+# Slots are preallocated; when full, new entries are dropped and counted. An
+# optional asyncio.ThreadSafeFlag is set on every put to wake the consumer.
+class IngressQueue:
+    def __init__(self, size=32, flag=None):
+        self._flag = flag
+        self._slots = [None] * size
+        self._size = size
+        self._head = 0
+        self._count = 0
+        self.dropped = 0
+
+    def __len__(self):
+        return self._count
+
+    def put(self, item):
+        if self._count == self._size:
+            self.dropped += 1
+            metrics.counts[QUEUE_DROPS] += 1
+            return False
+        self._slots[(self._head + self._count) % self._size] = item
+        self._count += 1
+        if self._flag is not None:
+            self._flag.set()
+        return True
+
+    def get(self):
+        if not self._count:
+            return None
+        item = self._slots[self._head]
+        self._slots[self._head] = None
+        self._head = (self._head + 1) % self._size
+        self._count -= 1
+        return item
+
+
+# IngressQueue shared between the two cores: put and get hold a _thread lock.
+class LockedQueue(IngressQueue):
+    def __init__(self, size=32, flag=None):
+        super().__init__(size, flag)
+        self._lock = _thread.allocate_lock()
+
+    def put(self, item):
+        with self._lock:
+            return IngressQueue.put(self, item)
+
+    def get(self):
+        with self._lock:
+            return IngressQueue.get(self)
+
+
+# Stands in for the shared-state lock when everything runs on one core.
+class _NullLock:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+NULL_LOCK = _NullLock()
+
+
+# Preallocated ring of raw scan results, written by the IRQ handler and read
+# by a scheduled drain. There is one producer and one consumer, and each only
+# advances its own index, so no locking is needed. One slot is kept free to
+# tell full from empty.
+class ScanRing:
+    def __init__(self, size=16, max_len=_ADV_MAX_LEN):
+        self._size = size
+        self._max_len = max_len
+        self._views = [memoryview(bytearray(max_len)) for _ in range(size)]
+        self._addrs = [bytearray(_ADDR_LEN) for _ in range(size)]
+        self._lengths = array('H', bytes(2 * size))
+        self._rssi = array('b', bytes(size))
+        self._read = 0
+        self._write = 0
+        self.dropped = 0
+
+    def __len__(self):
+        return (self._write - self._read) % self._size
+
+    def push(self, addr, rssi, adv_data):
+        w = self._write
+        nxt = (w + 1) % self._size
+        if nxt == self._read:
+            self.dropped += 1
+            return False
+        n = len(adv_data)
+        if n > self._max_len:
+            n = self._max_len
+            adv_data = adv_data[:n]
+        self._views[w][:n] = adv_data
+        self._addrs[w][:] = addr
+        self._lengths[w] = n
+        self._rssi[w] = rssi
+        self._write = nxt
+        return True
+
+    # Index of the oldest filled slot, or -1 when empty.
+    def peek(self):
+        return self._read if self._read != self._write else -1
+
+    def data(self, slot):
+        return self._views[slot][:self._lengths[slot]]
+
+    def addr(self, slot):
+        return self._addrs[slot]
+
+    def rssi(self, slot):
+        return self._rssi[slot]
+
+    def release(self):
+        self._read = (self._read + 1) % self._size
+
+
+# Preallocated copies of the fragments accepted for relaying, handed out in
+# turn. A slot is reused once size more fragments have come in, so size must
+# cover every entry that can still hold one: the ingress queue, the relays
+# waiting out their delay and the one going out. Slots are whole buffers; the
+# fragment header says how much of one is used.
+class FragmentRing:
+    def __init__(self, size, max_len):
+        self._size = size
+        self._max_len = max_len
+        self._slots = [bytearray(max_len) for _ in range(size)]
+        self._next = 0
+        self.dropped = 0
+
+    # Copy the n-byte fragment at offset in buf into the next slot and return
+    # the slot, or None if it is longer than a slot.
+    def keep(self, buf, offset, n):
+        if n > self._max_len:
+            self.dropped += 1
+            return None
+        slot = self._slots[self._next]
+        self._next = (self._next + 1) % self._size
+        for j in range(n):
+            slot[j] = buf[offset + j]
+        return slot
+
+
 class BLENode:
-    def __init__(self, ble, target_manufacturer_id=None, ledger=[]):
+    def __init__(self, ble, target_manufacturer_id=None, ledger=None):
         if target_manufacturer_id is not None and not isinstance(target_manufacturer_id, bluetooth.UUID):
             raise ValueError("target_manufacturer_id must be a bluetooth.UUID object or None")
         
         self._ble = ble
-        self._ble.active(True)
-        self._ble.irq(self._irq)
+        attach(ble, (_IRQ_SCAN_RESULT, _IRQ_SCAN_DONE), self._irq)
         self._reset()
-        self._led = Pin('LED', Pin.OUT)
         self.advertisement_data = []
         self.target_manufacturer_id = target_manufacturer_id
-        self.message_ledger = ledger  # New: Add message ledger
+        # Duplicate suppression keyed on (sender, messageID)
+        self.message_ledger = ledger if ledger is not None else MessageLedger()
+        # 16-bit manufacturer value compared against the raw AD bytes
+        self._target_mfg = int.from_bytes(bytes(target_manufacturer_id)[:2], 'little') if target_manufacturer_id is not None else None
+        self._decoded = [None] * FIELD_COUNT
+        self._walked = array('i', bytes(4 * WALK_LEN))
+        self._queue = None
+        self._ring = None
+        self._drain_pending = False
+        self._drain_cb = self._drain  # bound once, not allocated in the IRQ
+        self._counts = metrics.counts
+        self.on_duplicate = None
+        # Optional neighborTable.NeighborTable fed with the RSSI of every mesh packet
+        self.neighbors = None
+        self._neighbor = None
+        # Optional routeTable.RouteTable learning hop distances to senders
+        self.routes = None
+        # Optional reassemblyPool.ReassemblyPool for fragmented payloads, to
+        # name only unless payload_name is None; on_payload(sender, messageID,
+        # name, payload) gets each completed one (payload is only valid
+        # during the call)
+        self.reassembly = None
+        self.payload_name = None
+        self.on_payload = None
+        # Optional FragmentRing the fragments passed to the sink are copied
+        # into; without one each gets a bytes copy of its own
+        self.fragments = None
+        # Held while the second core decodes, in threaded mode. Code on the
+        # first core must hold it to touch the ledger, neighbours or routes.
+        self.lock = NULL_LOCK
+        self._core_wake = None
+        # Optional scanTrace.TraceWriter recording every raw scan result
+        self.trace = None
+        # See set_scan_params()
+        self.scan_interval_us = _SCAN_INTERVAL_US
+        self.scan_window_us = _SCAN_WINDOW_US
 
     def _reset(self):
         self._name = None
@@ -45,25 +239,39 @@ class BLENode:
 
     def _irq(self, event, data):
         if event == _IRQ_SCAN_RESULT:
+            start = time.ticks_us()
+            self._counts[SCANNED] += 1
             addr_type, addr, adv_type, rssi, adv_data = data
+            if self.trace is not None:
+                self.trace.record(addr_type, addr, adv_type, rssi, adv_data)
+            if self._ring is not None:
+                # Deferred mode: only copy the raw result, _drain (or the
+                # second core) does the rest
+                if self._ring.push(addr, rssi, adv_data):
+                    if self._core_wake is not None:
+                        # Only this IRQ releases it, so the check cannot go stale
+                        if self._core_wake.locked():
+                            self._core_wake.release()
+                    elif not self._drain_pending:
+                        self._drain_pending = True
+                        try:
+                            schedule(self._drain_cb, None)
+                        except RuntimeError:
+                            # Schedule queue full; the next result retries
+                            self._drain_pending = False
+                metrics.observe(IRQ_US, time.ticks_diff(time.ticks_us(), start))
+                return
             try:
-                decoded_data = self._decode_adv_data(adv_data)
-                if decoded_data:
-                    mfg_id, hop_count, _, _, _, message_id = decoded_data
-                    # Check if it's the target device, hop count > 0, and message not in ledger
-                    if (mfg_id == self.target_manufacturer_id and 
-                        hop_count > 0 and 
-                        message_id not in self.message_ledger):
-                        self.advertisement_data.append((ubinascii.hexlify(addr).decode(),) + decoded_data)
-                        # Add message to ledger
-                        self.message_ledger.append(message_id)
-                        # Keep ledger size limited
-                        if len(self.message_ledger) > 10:
-                            self.message_ledger.pop(0)
-                        self._ble.gap_scan(None)
-                        event = _IRQ_SCAN_DONE
+                if self._queue is not None:
+                    # Continuous mode: keep scanning, hand off to the forwarder
+                    self._accept(addr, rssi, adv_data, self._queue.put)
+                elif self._accept(addr, rssi, adv_data, self.advertisement_data.append):
+                    self._ble.gap_scan(None)
+                    event = _IRQ_SCAN_DONE
             except Exception as e:
+                self._counts[DECODE_ERRORS] += 1
                 print(f"Error decoding advertisement data: {e}")
+            metrics.observe(IRQ_US, time.ticks_diff(time.ticks_us(), start))
         if event == _IRQ_SCAN_DONE:
             #print("Scan complete")
             if self._scan_callback:
@@ -72,43 +280,183 @@ class BLENode:
                 else:
                     self._scan_callback(None)
             self._scan_callback = None
+            if self._queue is not None:
+                # The stack ended the scan (e.g. a role change); resume it
+                self._ble.gap_scan(0, self.scan_interval_us, self.scan_window_us)
 
-    def _decode_adv_data(self, adv_data):
-        i = 0
-        result = {}
-        while i + 1 < len(adv_data):
-            length = adv_data[i]
-            type = adv_data[i + 1]
-            value = bytes(adv_data[i + 2:i + length + 1])
-            
+    # Decode and filter one scan result. Every new message in it (aggregates
+    # carry several) is recorded in the ledger and passed to sink as the tuple
+    # (mac, mfg, hops, distance, sender, name, messageID, ttl, rssi, ticks_ms
+    # when accepted, acknowledged message ID or None, fragment header and data
+    # or None, neighbour key or None); repeats
+    # are reported to on_duplicate(sender, messageID, rssi) if set. Returns
+    # the number of messages accepted. The neighbour key is the Neighbor.key
+    # of the sender's record in neighbors, if set.
+    def _accept(self, addr, rssi, adv_data, sink):
+        decoded = self._decoded
+        if not decode_adv(adv_data, decoded, self._target_mfg, self._walked):
+            self._counts[FILTERED] += 1
+            return 0
+        if self.neighbors is not None:
+            self._neighbor = self.neighbors.update(addr, rssi).key
+        accepted = self._accept_record(addr, rssi, adv_data, sink)
+        records = decoded[FIELD_RECORDS]
+        if records > 1:
+            offset = decoded[FIELD_DATA]
+            for _ in range(1, records):
+                offset += MESH_RECORD_LEN
+                decode_record(adv_data, offset, decoded)
+                accepted += self._accept_record(addr, rssi, adv_data, sink)
+        return accepted
+
+    def _accept_record(self, addr, rssi, adv_data, sink):
+        decoded = self._decoded
+        hop_count = decoded[FIELD_HOP]
+        if hop_count is None or hop_count <= 0:
+            return 0
+        sender = decoded[FIELD_SENDER] or 0
+        message_id = decoded[FIELD_ID] or 0
+        # Duplicates count too: a later copy may have come a shorter way
+        ttl = decoded[FIELD_TTL]
+        if self.routes is not None and ttl:
+            self.routes.learn(sender, ttl - hop_count + 1)
+        # Check message not in ledger (adds it)
+        if not self.message_ledger.check_and_add(sender, message_id):
+            self._counts[DUPLICATES] += 1
+            if self.on_duplicate is not None:
+                self.on_duplicate(sender, message_id, rssi)
+            return 0
+        mfg_id = self.target_manufacturer_id
+        if mfg_id is None and decoded[FIELD_MFG] is not None:
+            mfg_id = bluetooth.UUID(decoded[FIELD_MFG])
+        fragment = decoded[FIELD_FRAGMENT]
+        if fragment is not None:
+            if self.reassembly is not None and (self.payload_name is None or decoded[FIELD_NAME] == self.payload_name):
+                self._reassemble(adv_data, fragment)
+            # Relays forward the fragment as received
+            n = fragment_len(adv_data, fragment)
+            if self.fragments is None:
+                fragment = bytes(adv_data[fragment:fragment + n])
+            else:
+                fragment = self.fragments.keep(adv_data, fragment, n)
+                if fragment is None:
+                    return 0
+        self._counts[ACCEPTED] += 1
+        sink((ubinascii.hexlify(addr).decode(), mfg_id, decoded[1], decoded[2], decoded[3], decoded[4], decoded[5], decoded[FIELD_TTL], rssi, time.ticks_ms(), decoded[FIELD_ACK], fragment, self._neighbor))
+        return 1
+
+    def _reassemble(self, adv_data, offset):
+        decoded = self._decoded
+        pool = self.reassembly
+        slot = pool.add(decoded[FIELD_SENDER], decoded[FIELD_ID], adv_data, offset)
+        if slot < 0:
+            return
+        try:
+            if self.on_payload is not None:
+                self.on_payload(pool.sender(slot), pool.message_id(slot), decoded[FIELD_NAME], pool.payload(slot))
+        finally:
+            pool.release(slot)
+
+    # Scheduled from the IRQ: decode everything the ring has collected.
+    def _drain(self, _):
+        self._drain_pending = False
+        ring = self._ring
+        if ring is None:
+            return
+        while True:
+            slot = ring.peek()
+            if slot < 0:
+                break
             try:
-                if type == _ADV_TYPE_MANUFACTURER:
-                    result['mfg'] = bluetooth.UUID(int.from_bytes(value[:2], 'little'))
-                elif type == _ADV_TYPE_NAME:
-                    result['name'] = int.from_bytes(value, 'big')
-                elif type == _ADV_TYPE_INT:
-                    result['hop'] = int.from_bytes(value, 'big') if value else None
-                elif type == _ADV_TYPE_DIST:
-                    result['distance'] = struct.unpack('f', value)[0] if len(value) == 4 else None
-                elif type == _ADV_TYPE_SENDER:
-                    result['sender'] = int.from_bytes(value, 'big') if value else None
-                elif type == _ADV_TYPE_ID:
-                    result['message_id'] = int.from_bytes(value, 'big') if value else None
+                self._accept(ring.addr(slot), ring.rssi(slot), ring.data(slot), self._queue.put)
             except Exception as e:
-                print(f"Error decoding field type {type}: {e}")
-            
-            i += length + 1
-        
-        if result:
-            return (result.get('mfg'), result.get('hop'), result.get('distance'), 
-                    result.get('sender'), result.get('name'), result.get('message_id'))
-        return None
+                self._counts[DECODE_ERRORS] += 1
+                print(f"Error decoding advertisement data: {e}")
+            ring.release()
+
+    # Second-core loop of threaded mode: block until the IRQ signals new
+    # results, then decode them under the shared lock. Ends when the scan is
+    # stopped.
+    def _ingest(self, ring, queue, wake):
+        lock = self.lock
+        counts = self._counts
+        while self._ring is ring:
+            wake.acquire()
+            while True:
+                slot = ring.peek()
+                if slot < 0:
+                    break
+                with lock:
+                    try:
+                        self._accept(ring.addr(slot), ring.rssi(slot), ring.data(slot), queue.put)
+                    except Exception as e:
+                        counts[DECODE_ERRORS] += 1
+                        print(f"Error decoding advertisement data: {e}")
+                ring.release()
+
+    def _decode_adv_data(self, adv_data):
+        decoded = [None] * FIELD_COUNT
+        if not decode_adv(adv_data, decoded):
+            return None
+        if decoded[FIELD_MFG] is not None:
+            decoded[FIELD_MFG] = bluetooth.UUID(decoded[FIELD_MFG])
+        return tuple(decoded[:FIELD_TTL])
 
     def scan(self, callback=None):
         self._reset()
         self._scan_callback = callback
         self.advertisement_data = []
-        self._ble.gap_scan(500, 10000, 9000)  # Scan duration: 10 seconds
+        self._ble.gap_scan(_SCAN_MS, self.scan_interval_us, self.scan_window_us)
+        metrics.mark(BOOT_SCAN_MS)
+
+    # Scan indefinitely and push every accepted packet onto a bounded queue
+    # instead of stopping at the first match. Returns the queue to drain.
+    # With deferred=True the IRQ only copies raw results into a ScanRing and
+    # decoding runs later via micropython.schedule. With threaded=True it runs
+    # on the second core instead (_thread), so a busy main loop no longer
+    # holds it up; the queue is then a LockedQueue and self.lock guards the
+    # shared state. max_len bounds the copied advertisement (raise it for
+    # extended advertising).
+    def scan_continuous(self, queue=None, deferred=True, max_len=_ADV_MAX_LEN, threaded=False):
+        self._reset()
+        if threaded:
+            if _thread is None:
+                raise OSError("threaded scanning needs _thread")
+            if self.lock is NULL_LOCK:
+                self.lock = _thread.allocate_lock()
+            self._queue = queue if queue is not None else LockedQueue()
+        else:
+            self._queue = queue if queue is not None else IngressQueue()
+        self._ring = ScanRing(max_len=max_len) if deferred or threaded else None
+        if threaded:
+            wake = _thread.allocate_lock()
+            wake.acquire()
+            self._core_wake = wake
+            _thread.start_new_thread(self._ingest, (self._ring, self._queue, wake))
+        self._ble.gap_scan(0, self.scan_interval_us, self.scan_window_us)
+        metrics.mark(BOOT_SCAN_MS)
+        return self._queue
+
+    # Listen for window_us out of every interval_us from the next scan on. A
+    # continuous scan is stopped, and restarted with them by the IRQ handler
+    # when the stack reports it done.
+    def set_scan_params(self, interval_us, window_us):
+        if interval_us == self.scan_interval_us and window_us == self.scan_window_us:
+            return
+        self.scan_interval_us = interval_us
+        self.scan_window_us = window_us
+        if self._queue is not None:
+            self._ble.gap_scan(None)
+
+    def stop_scan(self):
+        self._queue = None
+        self._ring = None
+        wake = self._core_wake
+        self._core_wake = None
+        if wake is not None and wake.locked():
+            # Let the second core see the scan has stopped and exit
+            wake.release()
+        self._ble.gap_scan(None)
 
 class Advertiser:
     def __init__(self, data):
@@ -183,6 +531,16 @@ def runScan(ble, central):
     
     return central.advertisement_data, central.message_ledger
 
+# Awaitable counterpart of runScan: one scan cycle without busy-waiting.
+async def scan_async(central, timeout_ms=100000):
+    done = asyncio.ThreadSafeFlag()
+    central.scan(callback=lambda result: done.set())
+    try:
+        await asyncio.wait_for_ms(done.wait(), timeout_ms)
+    except asyncio.TimeoutError:
+        print("Scan timed out")
+    return central.advertisement_data, central.message_ledger
+
 if __name__ == "__main__":
     ble = bluetooth.BLE()
     TARGET_MANUFACTURER_ID = bluetooth.UUID(0x0102)  # This is equivalent to 258
@@ -0,0 +1,148 @@
+# Reassembly of fragmented payloads in a fixed pool of buffers.
+#
+# Each slot holds one payload being reassembled, keyed by its sender and first
+# message ID (the fragment's ID minus its index), with a bitmap of the
+# fragments received so far. Fragment data is copied straight from the scan
+# buffer into the slot, so adding a fragment allocates nothing. A payload that
+# is still incomplete timeout_ms after its first fragment is evicted; when
+# every slot is taken by a live payload, fragments of new ones are dropped.
+
+import time
+from array import array
+from micropython import const
+from advertisementPacket import FRAGMENT_HEADER_LEN, fragment_stride
+
+_BITMAP_LEN = const(32)  # one bit for each of up to 256 fragments
+_INCOMPLETE = const(-1)
+
+
+class ReassemblyPool:
+    def __init__(self, slots=4, max_payload=512, timeout_ms=10000):
+        if not 0 < slots < 256:
+            raise ValueError("slots must be between 1 and 255")
+        self.slots = slots
+        self.max_payload = max_payload
+        self.timeout_ms = timeout_ms
+        self._buf = bytearray(slots * max_payload)
+        self._view = memoryview(self._buf)
+        self._bitmaps = bytearray(slots * _BITMAP_LEN)
+        self._used = bytearray(slots)
+        self._senders = array('H', bytes(2 * slots))
+        self._bases = array('H', bytes(2 * slots))
+        self._counts = bytearray(slots)
+        self._have = bytearray(slots)
+        self._totals = array('H', bytes(2 * slots))
+        self._stamps = array('i', bytes(4 * slots))
+        self.started = 0
+        self.completed = 0
+        self.expired = 0
+        self.dropped = 0
+
+    def _find(self, sender, base):
+        for slot in range(self.slots):
+            if self._used[slot] and self._senders[slot] == sender and self._bases[slot] == base:
+                return slot
+        return _INCOMPLETE
+
+    def _claim(self, sender, base, count, total, now):
+        slot = self._free_slot(now)
+        if slot < 0:
+            return _INCOMPLETE
+        self._used[slot] = 1
+        self._senders[slot] = sender
+        self._bases[slot] = base
+        self._counts[slot] = count
+        self._have[slot] = 0
+        self._totals[slot] = total
+        self._stamps[slot] = now
+        bitmaps = self._bitmaps
+        for i in range(slot * _BITMAP_LEN, (slot + 1) * _BITMAP_LEN):
+            bitmaps[i] = 0
+        self.started += 1
+        return slot
+
+    def _free_slot(self, now):
+        for slot in range(self.slots):
+            if not self._used[slot]:
+                return slot
+        self.expire(now)
+        for slot in range(self.slots):
+            if not self._used[slot]:
+                return slot
+        return _INCOMPLETE
+
+    # Add the fragment whose header starts at offset in buf, from message
+    # message_id of sender. Returns the slot once the payload is complete
+    # (read it with payload(), then release()), or -1.
+    def add(self, sender, message_id, buf, offset, now=None):
+        index = buf[offset]
+        count = buf[offset + 1]
+        total = (buf[offset + 2] << 8) | buf[offset + 3]
+        if total > self.max_payload or index >= count:
+            self.dropped += 1
+            return _INCOMPLETE
+        if now is None:
+            now = time.ticks_ms()
+        base = (message_id - index) & 0xFFFF
+        slot = self._find(sender, base)
+        if slot < 0:
+            slot = self._claim(sender, base, count, total, now)
+            if slot < 0:
+                self.dropped += 1
+                return _INCOMPLETE
+        elif self._counts[slot] != count or self._totals[slot] != total:
+            # Same key, different payload: the ID has wrapped around
+            self.dropped += 1
+            return _INCOMPLETE
+        bit = slot * _BITMAP_LEN + (index >> 3)
+        mask = 1 << (index & 7)
+        if self._bitmaps[bit] & mask:
+            return _INCOMPLETE
+        self._bitmaps[bit] |= mask
+        stride = fragment_stride(count, total)
+        start = index * stride
+        n = min(stride, total - start)
+        pool = self._buf
+        dst = slot * self.max_payload + start
+        src = offset + FRAGMENT_HEADER_LEN
+        for j in range(n):
+            pool[dst + j] = buf[src + j]
+        self._have[slot] += 1
+        if self._have[slot] < count:
+            return _INCOMPLETE
+        self.completed += 1
+        return slot
+
+    # The reassembled payload of a completed slot, valid until release().
+    def payload(self, slot):
+        start = slot * self.max_payload
+        return self._view[start:start + self._totals[slot]]
+
+    def sender(self, slot):
+        return self._senders[slot]
+
+    # First message ID of the payload
+    def message_id(self, slot):
+        return self._bases[slot]
+
+    def release(self, slot):
+        self._used[slot] = 0
+
+    # Evict payloads that have been incomplete for timeout_ms.
+    def expire(self, now=None):
+        if now is None:
+            now = time.ticks_ms()
+        for slot in range(self.slots):
+            if self._used[slot] and time.ticks_diff(now, self._stamps[slot]) >= self.timeout_ms:
+                self._used[slot] = 0
+                self.expired += 1
+
+    def stats(self):
+        return {
+            'in_progress': sum(self._used),
+            'slots': self.slots,
+            'started': self.started,
+            'completed': self.completed,
+            'expired': self.expired,
+            'dropped': self.dropped,
+        }
@@ -0,0 +1,60 @@
+# Compares the relay policies in meshSim on fixed-seed scenarios: delivery
+# ratio, how many nodes retransmit each message and the airtime it costs.
+#
+#   python relayBench.py [--json] [--duration 30]
+
+import json
+import random
+import meshSim
+
+# name: (nodes, spacing m, radio range m, loss)
+SCENARIOS = {
+    'grid25': (25, 10.0, 15.0, 0.0),
+    'dense49': (49, 5.0, 15.0, 0.0),
+    'lossy25': (25, 10.0, 15.0, 0.2),
+}
+
+
+def run(scenario, policy, duration=30.0, interval=0.5, seed=1):
+    nodes, spacing, radio_range, loss = SCENARIOS[scenario]
+    positions = meshSim.layout('grid', nodes, spacing, random.Random(seed))
+    sim = meshSim.Simulator(positions, radio_range=radio_range, loss=loss,
+                            message_interval=interval, seed=seed,
+                            relay=meshSim.runtime_relay_loop,
+                            node_options={'policy': meshSim.POLICIES[policy]})
+    report = sim.run(duration)
+    return {
+        'scenario': scenario,
+        'policy': policy,
+        'delivery_ratio': round(report['delivery_ratio'], 3),
+        'relays_per_message': round(report['relays_per_message'], 2),
+        'airtime_per_message_ms': round(report['airtime_per_message_ms'], 2),
+        'flood_p50_ms': round(report['flood_latency_ms'].get('p50', 0.0), 1),
+        'rx_collided': report['radio']['rx_collided'],
+    }
+
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description='Compare relay policies in meshSim.')
+    parser.add_argument('--duration', type=float, default=30.0)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', action='store_true')
+    args = parser.parse_args(argv)
+
+    results = []
+    for scenario in SCENARIOS:
+        for policy in meshSim.POLICIES:
+            result = run(scenario, policy, args.duration, seed=args.seed)
+            results.append(result)
+            if not args.json:
+                print('%-8s %-9s delivery %.3f  relays/msg %5.2f  airtime/msg %6.2f ms  flood p50 %6.1f ms  collided %d' % (
+                    scenario, policy, result['delivery_ratio'], result['relays_per_message'],
+                    result['airtime_per_message_ms'], result['flood_p50_ms'], result['rx_collided']))
+    if args.json:
+        print(json.dumps(results))
+    return results
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+# Relay policies for broadcast-storm suppression.
+#
+# A policy decides, for each newly heard message, whether and when the node
+# rebroadcasts it. delay_ms(rssi) returns the relay delay in milliseconds, or
+# -1 to drop the message outright. While a relay is pending the node counts
+# duplicates of the same message; once `threshold` of them have been heard the
+# relay is cancelled (threshold 0 never cancels).
+
+import random
+from micropython import const
+
+_RSSI_NEAR = const(-45)
+_RSSI_FAR = const(-90)
+
+
+def _jitter(max_ms):
+    return random.getrandbits(16) * max_ms >> 16 if max_ms > 0 else 0
+
+
+# Relay everything immediately: the original blind flooding.
+class FloodPolicy:
+    threshold = 0
+
+    def delay_ms(self, rssi):
+        return 0
+
+
+# Trickle-style counter suppression: wait a random assessment delay and stay
+# quiet if enough neighbours have already relayed the message.
+class CounterPolicy:
+    def __init__(self, threshold=2, max_delay_ms=150):
+        self.threshold = threshold
+        self.max_delay_ms = max_delay_ms
+
+    def delay_ms(self, rssi):
+        return _jitter(self.max_delay_ms)
+
+
+# Probabilistic gossip: relay with a fixed probability.
+class GossipPolicy:
+    def __init__(self, probability=0.65, threshold=0):
+        self.threshold = threshold
+        self._cutoff = int(probability * 65536)
+
+    def delay_ms(self, rssi):
+        return 0 if random.getrandbits(16) < self._cutoff else -1
+
+
+# Distance-based delay: the weaker the signal (the farther the sender), the
+# sooner a node relays, so the nodes at the edge of the sender's range cover
+# the most new ground and the nearby ones are suppressed by their duplicates.
+class DistancePolicy:
+    def __init__(self, threshold=1, min_delay_ms=0, max_delay_ms=200, jitter_ms=20, rssi_near=_RSSI_NEAR, rssi_far=_RSSI_FAR):
+        self.threshold = threshold
+        self.min_delay_ms = min_delay_ms
+        self.max_delay_ms = max_delay_ms
+        self.jitter_ms = jitter_ms
+        self.rssi_near = rssi_near
+        self.rssi_far = rssi_far
+
+    def delay_ms(self, rssi):
+        if rssi is None or rssi <= self.rssi_far:
+            span = 0
+        elif rssi >= self.rssi_near:
+            span = self.max_delay_ms - self.min_delay_ms
+        else:
+            span = (self.max_delay_ms - self.min_delay_ms) * (rssi - self.rssi_far) // (self.rssi_near - self.rssi_far)
+        return self.min_delay_ms + span + _jitter(self.jitter_ms)
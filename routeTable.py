@@ -0,0 +1,89 @@
+# Hop-count gradients towards mesh addresses, learned from observed traffic.
+#
+# A compact-header record carries the hops remaining and the TTL it was sent
+# with, so a node hearing a message knows how many hops away its sender is:
+# ttl - hop + 1. Keeping the smallest such distance per sender gives each node
+# its position on a gradient towards every address it has heard from, which is
+# what directed relaying needs. Entries live in fixed arrays indexed by a dict
+# of small ints; a full table replaces its stalest entry.
+
+import time
+from array import array
+from micropython import const
+
+_NO_ROUTE = const(-1)
+
+
+class RouteTable:
+    def __init__(self, capacity=64, max_age_ms=120000):
+        if not 0 < capacity < 65536:
+            raise ValueError("capacity must be between 1 and 65535")
+        self.capacity = capacity
+        self.max_age_ms = max_age_ms
+        self._slots = {}
+        self._dests = array('H', bytes(2 * capacity))
+        self._hops = array('B', bytes(capacity))
+        self._stamps = array('i', bytes(4 * capacity))
+        self.learned = 0
+        self.replaced = 0
+
+    def __len__(self):
+        return len(self._slots)
+
+    def _stale(self, slot, now):
+        return time.ticks_diff(now, self._stamps[slot]) >= self.max_age_ms
+
+    # Record that dest was heard hops away. Equal or shorter paths refresh the
+    # entry; longer ones only replace it once it has gone stale.
+    def learn(self, dest, hops, now=None):
+        if hops <= 0 or hops > 255:
+            return
+        if now is None:
+            now = time.ticks_ms()
+        slot = self._slots.get(dest)
+        if slot is None:
+            if len(self._slots) < self.capacity:
+                slot = len(self._slots)
+            else:
+                slot = self._stalest()
+                del self._slots[self._dests[slot]]
+                self.replaced += 1
+            self._slots[dest] = slot
+            self._dests[slot] = dest
+            self.learned += 1
+        elif hops > self._hops[slot] and not self._stale(slot, now):
+            return
+        self._hops[slot] = hops
+        self._stamps[slot] = now
+
+    def _stalest(self):
+        stamps = self._stamps
+        now = time.ticks_ms()
+        oldest = 0
+        age = -1
+        for slot in range(self.capacity):
+            a = time.ticks_diff(now, stamps[slot])
+            if a > age:
+                oldest = slot
+                age = a
+        return oldest
+
+    # Hops to dest, or -1 when no fresh route is known
+    def hops(self, dest, now=None):
+        slot = self._slots.get(dest)
+        if slot is None:
+            return _NO_ROUTE
+        if self._stale(slot, time.ticks_ms() if now is None else now):
+            return _NO_ROUTE
+        return self._hops[slot]
+
+    def clear(self):
+        self._slots.clear()
+
+    def stats(self):
+        return {
+            'size': len(self._slots),
+            'capacity': self.capacity,
+            'learned': self.learned,
+            'replaced': self.replaced,
+        }
@@ -0,0 +1,266 @@
+# Recording and replay of raw scan results.
+#
+# A TraceWriter set as BLENode.trace appends every _IRQ_SCAN_RESULT the node
+# gets to a stream, such as a file on flash, exactly as the stack delivered
+# it. Records are packed into one of two preallocated buffers. When the one
+# being filled runs out of room the two swap, and the full one is written out
+# from a scheduled callback, so the IRQ never waits on the filesystem. If the
+# schedule queue is full, the next record schedules it again. Results that
+# arrive while both buffers are full are dropped and counted. flush() writes
+# out whatever is buffered.
+#
+# Trace layout: an 8-byte header, b'SCTR', the format version and 3 reserved
+# bytes, then one record per scan result, little-endian:
+#   0-3   microseconds since the previous record (u32)
+#   4     addr_type
+#   5     adv_type
+#   6     rssi (i8)
+#   7     length N of adv_data
+#   8-13  addr
+#   14-   adv_data (N bytes)
+# A record cut short at the end (power lost mid-write) is ignored on reading.
+#
+# Run this file on the host to replay a trace into one simulated node running
+# MeshNode, with the meshSim stand-ins, and report decode throughput, dedup
+# decisions and forward counts. By default the replay runs as fast as the host
+# can go; --realtime keeps the recorded timing and --speed X scales it.
+#   python scanTrace.py trace.bin [--realtime | --speed X] [--json]
+
+import struct
+import time
+try:
+    from micropython import const, schedule
+except ImportError:
+    # Host side, for read_trace and replay
+    def const(value):
+        return value
+    schedule = None
+
+TRACE_VERSION = const(1)
+_MAGIC = b'SCTR'
+_HEADER_LEN = const(8)
+_RECORD_HEADER = const(14)
+_MAX_DATA = const(255)
+
+_IRQ_SCAN_RESULT = const(5)
+
+
+class TraceWriter:
+    def __init__(self, stream, buffer_size=2048):
+        if buffer_size < _RECORD_HEADER + _MAX_DATA:
+            raise ValueError("buffer_size must hold a full record")
+        self._stream = stream
+        self._bufs = (bytearray(buffer_size), bytearray(buffer_size))
+        self._views = (memoryview(self._bufs[0]), memoryview(self._bufs[1]))
+        self._fill = [0, 0]
+        self._active = 0
+        # The other buffer is full and waiting to be written out
+        self._pending = False
+        # A callback to write it out is queued
+        self._scheduled = False
+        self._flush_cb = self._scheduled_write  # bound once, not allocated in the IRQ
+        self._last = time.ticks_us()
+        self.records = 0
+        self.dropped = 0
+        header = bytearray(_HEADER_LEN)
+        header[0:4] = _MAGIC
+        header[4] = TRACE_VERSION
+        stream.write(header)
+
+    # Append one scan result; called from the scan IRQ. Returns False if it
+    # was dropped.
+    def record(self, addr_type, addr, adv_type, rssi, adv_data):
+        now = time.ticks_us()
+        n = len(adv_data)
+        if n > _MAX_DATA:
+            n = _MAX_DATA
+            adv_data = adv_data[:n]
+        size = _RECORD_HEADER + n
+        if self._pending and not self._scheduled:
+            self._schedule()
+        active = self._active
+        offset = self._fill[active]
+        if offset + size > len(self._bufs[active]):
+            if self._pending:
+                self.dropped += 1
+                return False
+            self._pending = True
+            active ^= 1
+            self._active = active
+            offset = 0
+            self._schedule()
+        buf = self._bufs[active]
+        struct.pack_into('<IBBbB', buf, offset, time.ticks_diff(now, self._last), addr_type, adv_type, rssi, n)
+        buf[offset + 8:offset + _RECORD_HEADER] = addr
+        buf[offset + _RECORD_HEADER:offset + size] = adv_data
+        self._fill[active] = offset + size
+        self._last = now
+        self.records += 1
+        return True
+
+    def _schedule(self):
+        try:
+            schedule(self._flush_cb, None)
+            self._scheduled = True
+        except RuntimeError:
+            # Schedule queue full; the next record tries again
+            pass
+
+    def _scheduled_write(self, _):
+        self._scheduled = False
+        self._write_pending()
+
+    def _write_pending(self):
+        if not self._pending:
+            return
+        full = self._active ^ 1
+        self._stream.write(self._views[full][:self._fill[full]])
+        self._fill[full] = 0
+        self._pending = False
+
+    # Write out everything recorded so far.
+    def flush(self):
+        self._write_pending()
+        if self._fill[self._active]:
+            # Swap first, so results arriving meanwhile go to the other buffer
+            self._pending = True
+            self._active ^= 1
+            self._write_pending()
+        if hasattr(self._stream, 'flush'):
+            self._stream.flush()
+
+    def stats(self):
+        return {
+            'records': self.records,
+            'dropped': self.dropped,
+            'buffered': self._fill[0] + self._fill[1],
+        }
+
+
+# The records of a trace, as (delta_us, addr_type, addr, adv_type, rssi,
+# adv_data) tuples.
+def read_trace(stream):
+    header = stream.read(_HEADER_LEN)
+    if len(header) < _HEADER_LEN or header[0:4] != _MAGIC or header[4] != TRACE_VERSION:
+        raise ValueError("not a scan trace")
+    while True:
+        head = stream.read(_RECORD_HEADER)
+        if len(head) < _RECORD_HEADER:
+            return
+        delta, addr_type, adv_type, rssi, n = struct.unpack_from('<IBBbB', head, 0)
+        data = stream.read(n)
+        if len(data) < n:
+            return
+        yield delta, addr_type, bytes(head[8:_RECORD_HEADER]), adv_type, rssi, data
+
+
+# Replay the trace at path into a simulated node running meshNode.MeshNode with
+# node_options, speed times faster than recorded (0: as fast as possible), and
+# report what the node made of it. The node runs on the virtual clock, so
+# relay delays and dwell times cost no wall time; drain is how long, in
+# seconds, it keeps relaying after the last record.
+def replay(path, speed=0.0, drain=2.0, extended=False, **node_options):
+    import meshSim
+    if extended:
+        node_options['extended'] = True
+    sim = meshSim.Simulator([(0.0, 0.0)], originators=0, relay=meshSim.runtime_relay_loop,
+                            extended=extended, node_options=node_options)
+    node = sim.nodes[0]
+    node.load(('main',))
+    state = {'records': 0, 'done': False}
+    with open(path, 'rb') as f:
+        records = read_trace(f)
+
+        def feed(record):
+            if speed:
+                ahead = state['start'] + sim.now / 1000000 / speed - time.perf_counter()
+                if ahead > 0:
+                    time.sleep(ahead)
+            addr_type, addr, adv_type, rssi, data = record[1:]
+            node.radio._dispatch(_IRQ_SCAN_RESULT, (addr_type, memoryview(addr), adv_type, rssi, memoryview(data)))
+            state['records'] += 1
+            following = next(records, None)
+            if following is None:
+                state['done'] = True
+            else:
+                sim.at(following[0], feed, following)
+
+        first = next(records, None)
+        node.start(meshSim.runtime_relay_loop, 0)
+        start = state['start'] = time.perf_counter()
+        if first is not None:
+            # Give the node a moment to start scanning
+            sim.at(1000, feed, first)
+            while not state['done']:
+                sim._run_until(sim.now + 1000000)
+        span_us = sim.now
+        wall = time.perf_counter() - start
+        try:
+            sim._run_until(sim.now + int(drain * 1000000))
+        finally:
+            node.stop()
+            sim.restore_modules()
+    module = node.modules['metrics']
+    counters = dict(zip(module.COUNTER_NAMES, module.metrics.counts))
+    mesh = node.mesh
+    return {
+        'records': state['records'],
+        'trace_s': span_us / 1000000,
+        'wall_s': round(wall, 3),
+        'records_per_s': round(state['records'] / wall) if wall > 0 else 0,
+        'speedup': round(span_us / 1000000 / wall, 1) if wall > 0 else 0.0,
+        'decode': {name: counters[name] for name in ('scanned', 'filtered', 'decode_errors', 'queue_drops')},
+        'dedup': {'accepted': counters['accepted'], 'duplicates': counters['duplicates']},
+        'forward': {
+            'forwarded': mesh.forwarded if mesh is not None else 0,
+            'suppressed': mesh.suppressed if mesh is not None else 0,
+            'dropped': mesh.dropped if mesh is not None else 0,
+            'pruned': mesh.pruned if mesh is not None else 0,
+            'received': mesh.received if mesh is not None else 0,
+            'advertised': counters['advertised'],
+        },
+        'irq_errors': node.stats['irq_errors'],
+        'node_errors': node.stats['node_errors'],
+        'last_error': node.last_error,
+    }
+
+
+def main(argv=None):
+    import argparse
+    import json
+    import meshSim
+    parser = argparse.ArgumentParser(description='Replay a recorded scan trace into a simulated MeshNode.')
+    parser.add_argument('trace')
+    parser.add_argument('--realtime', action='store_true', help='keep the recorded timing')
+    parser.add_argument('--speed', type=float, default=0.0, help='replay this many times faster than recorded')
+    parser.add_argument('--drain', type=float, default=2.0, help='seconds of relaying after the last record')
+    parser.add_argument('--aggregate', action='store_true')
+    parser.add_argument('--scheduler', action='store_true')
+    parser.add_argument('--extended', action='store_true')
+    parser.add_argument('--policy', choices=tuple(meshSim.POLICIES), default='flood')
+    parser.add_argument('--routing', action='store_true')
+    parser.add_argument('--dual-core', action='store_true')
+    parser.add_argument('--json', action='store_true')
+    args = parser.parse_args(argv)
+
+    options = {'policy': meshSim.POLICIES[args.policy]}
+    for name in ('aggregate', 'scheduler', 'routing', 'dual_core'):
+        if getattr(args, name):
+            options[name] = True
+    report = replay(args.trace, 1.0 if args.realtime else args.speed, args.drain, args.extended, **options)
+    if args.json:
+        print(json.dumps(report))
+        return report
+    print('%d records, %.2f s of trace in %.2f s wall (x%.1f), %d records/s' % (
+        report['records'], report['trace_s'], report['wall_s'], report['speedup'], report['records_per_s']))
+    print('decode              %s' % report['decode'])
+    print('dedup               %s' % report['dedup'])
+    print('forward             %s' % report['forward'])
+    print('irq errors %d, node errors %d' % (report['irq_errors'], report['node_errors']))
+    if report['last_error']:
+        print('last error          %s' % report['last_error'])
+    return report
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+# Tests for ackTracker.AckTracker timeouts on the host, with the meshSim
+# stand-ins.
+
+import os
+import sys
+import unittest
+
+_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if _ROOT not in sys.path:
+    sys.path.insert(0, _ROOT)
+
+import meshSim
+meshSim.install_host_modules()
+
+from ackTracker import AckTracker
+
+_DEST = 0x1234
+
+
+class TimeoutTest(unittest.TestCase):
+    def test_first_timeout_scales_with_hops(self):
+        acks = AckTracker(timeout_ms=500)
+        acks.track(_DEST, 1, hops=1, now=0)
+        acks.track(_DEST + 1, 2, hops=4, now=0)
+        self.assertEqual(acks.timeout(1), 500)
+        self.assertEqual(acks.timeout(4), 2000)
+        # Jitter adds up to half the timeout
+        self.assertTrue(500 <= acks._due[0] <= 750)
+        self.assertTrue(2000 <= acks._due[1] <= 3000)
+
+    def test_measures_first_attempts_only(self):
+        acks = AckTracker(timeout_ms=500)
+        acks.track(_DEST, 1, hops=2, now=0)
+        self.assertTrue(acks.ack(1, _DEST, now=400))
+        self.assertEqual((acks.rtt_ms, acks.rtt_dev_ms), (200, 100))
+        self.assertEqual(acks.timeout(2), 2 * (200 + 4 * 100))
+        acks.track(_DEST, 2, hops=2, now=1000)
+        self.assertTrue(acks.retry(0, now=3000))
+        acks.add_id(0, 3)
+        # The ACK of a retried message says nothing of the round trip
+        self.assertTrue(acks.ack(2, _DEST, now=9000))
+        self.assertEqual(acks.rtt_ms, 200)
+
+    def test_retries_back_off_later_sends(self):
+        acks = AckTracker(timeout_ms=500)
+        acks.track(_DEST, 1, now=0)
+        self.assertTrue(acks.retry(0, now=1000))
+        self.assertEqual(acks.retries, 1)
+        self.assertEqual(acks.timeout(), 1000)
+        acks.add_id(0, 2)
+        self.assertTrue(acks.ack(2, _DEST, now=1500))
+        acks.track(_DEST, 3, now=2000)
+        self.assertTrue(acks.ack(3, _DEST, now=2300))
+        self.assertEqual(acks.timeout(), 300 + 4 * 150)
+
+    def test_waiting_without_resend(self):
+        acks = AckTracker(timeout_ms=500, max_tries=2)
+        acks.track(_DEST, 1, now=0)
+        self.assertTrue(acks.retry(0, now=1000, resend=False))
+        self.assertEqual((acks.retries, acks.timeout()), (0, 500))
+        # A late ACK of the only attempt still settles it
+        self.assertTrue(acks.ack(1, _DEST, now=1200))
+        acks.track(_DEST, 2, now=2000)
+        self.assertTrue(acks.retry(0, now=3000, resend=False))
+        self.assertFalse(acks.retry(0, now=4000, resend=False))
+        self.assertEqual((len(acks), acks.failed), (0, 1))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,278 @@
+# Regression tests for advertisementPacket.decode_adv on the host, with the
+# meshSim stand-ins for the MicroPython modules:
+#   python -m unittest discover tests      (or python -m pytest tests)
+#
+# decode_adv is checked against frozen copies of the decoders it replaced:
+#   - the one-pass record walk it used before the walk moved to
+#     viperWalk.walk_ad, over legacy, compact, aggregate, ACK and fragment
+#     packets, every truncation of them, single-byte corruptions and random
+#     bytes, with and without a manufacturer filter, through both the viper
+#     walk and walk_ad_py
+#   - the original readScan._decode_adv_data, field by field, over
+#     well-formed legacy packets (it did not bound records by the packet
+#     length, so it only agrees with decode_adv on those)
+
+import os
+import random
+import struct
+import sys
+import unittest
+
+_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if _ROOT not in sys.path:
+    sys.path.insert(0, _ROOT)
+
+import meshSim
+meshSim.install_host_modules()
+
+import bluetooth
+import advertisementPacket
+from advertisementPacket import (advertising_payload, decode_adv, CompactTemplate, AggregateTemplate,
+                                 FragmentTemplate, fragment_count, make_fragment, ACK_DATA_LEN,
+                                 FIELD_COUNT, FIELD_MFG, FIELD_HOP, FIELD_DIST, FIELD_SENDER, FIELD_NAME,
+                                 FIELD_ID, FIELD_TTL, FIELD_DATA, FIELD_RECORDS, FIELD_ACK, FIELD_FRAGMENT,
+                                 WALK_LEN)
+from array import array
+
+_MESH = 0x0102
+_OTHER = 0x0304
+
+_ADV_TYPE_NAME = 0x09
+_ADV_TYPE_INT = 0x0A
+_ADV_TYPE_DIST = 0x16
+_ADV_TYPE_SENDER = 0x17
+_ADV_TYPE_ID = 0x18
+_ADV_TYPE_MANUFACTURER = 0xFF
+
+
+# decode_adv as it was before the walk moved to walk_ad. The compact header
+# decoding it hands over to is shared with the current one.
+def reference_decode_adv(adv_data, result, target_mfg=None):
+    mv = memoryview(adv_data)
+    n = len(mv)
+    mfg = hop = dist = sender = name = message_id = -1
+    i = 0
+    while i + 1 < n:
+        length = mv[i]
+        if length == 0 or i + length >= n:
+            break
+        adv_type = mv[i + 1]
+        if adv_type == _ADV_TYPE_MANUFACTURER:
+            if length < 3:
+                return False
+            mfg = mv[i + 2] | (mv[i + 3] << 8)
+            if target_mfg is not None and mfg != target_mfg:
+                return False
+            if length > 3 and advertisementPacket._decode_compact(mv, i, mfg, result):
+                return True
+        elif adv_type == _ADV_TYPE_INT:
+            hop = i
+        elif adv_type == _ADV_TYPE_DIST:
+            dist = i
+        elif adv_type == _ADV_TYPE_SENDER:
+            sender = i
+        elif adv_type == _ADV_TYPE_NAME:
+            name = i
+        elif adv_type == _ADV_TYPE_ID:
+            message_id = i
+        i += length + 1
+    if mfg < 0:
+        if target_mfg is not None:
+            return False
+        if hop < 0 and dist < 0 and sender < 0 and name < 0 and message_id < 0:
+            return False
+    read_be = advertisementPacket._read_be
+    result[FIELD_MFG] = mfg if mfg >= 0 else None
+    result[FIELD_HOP] = read_be(mv, hop) if hop >= 0 and mv[hop] > 1 else None
+    result[FIELD_DIST] = struct.unpack_from("f", mv, dist + 2)[0] if dist >= 0 and mv[dist] == 5 else None
+    result[FIELD_SENDER] = read_be(mv, sender) if sender >= 0 and mv[sender] > 1 else None
+    result[FIELD_NAME] = read_be(mv, name) if name >= 0 else None
+    result[FIELD_ID] = read_be(mv, message_id) if message_id >= 0 and mv[message_id] > 1 else None
+    result[FIELD_TTL] = None
+    result[FIELD_DATA] = None
+    result[FIELD_RECORDS] = 1
+    result[FIELD_ACK] = None
+    result[FIELD_FRAGMENT] = None
+    return True
+
+
+# The original readScan._decode_adv_data, with the manufacturer as its 16-bit
+# value rather than a bluetooth.UUID.
+def baseline_decode_adv_data(adv_data):
+    i = 0
+    result = {}
+    while i + 1 < len(adv_data):
+        length = adv_data[i]
+        type = adv_data[i + 1]
+        value = bytes(adv_data[i + 2:i + length + 1])
+        if type == _ADV_TYPE_MANUFACTURER:
+            result['mfg'] = int.from_bytes(value[:2], 'little')
+        elif type == _ADV_TYPE_NAME:
+            result['name'] = int.from_bytes(value, 'big')
+        elif type == _ADV_TYPE_INT:
+            result['hop'] = int.from_bytes(value, 'big') if value else None
+        elif type == _ADV_TYPE_DIST:
+            result['distance'] = struct.unpack('f', value)[0] if len(value) == 4 else None
+        elif type == _ADV_TYPE_SENDER:
+            result['sender'] = int.from_bytes(value, 'big') if value else None
+        elif type == _ADV_TYPE_ID:
+            result['message_id'] = int.from_bytes(value, 'big') if value else None
+        i += length + 1
+    if result:
+        return (result.get('mfg'), result.get('hop'), result.get('distance'),
+                result.get('sender'), result.get('name'), result.get('message_id'))
+    return None
+
+
+def _record(adv_type, data):
+    return bytes((len(data) + 1, adv_type)) + bytes(data)
+
+
+def mesh_packets():
+    mesh = bluetooth.UUID(_MESH)
+    other = bluetooth.UUID(_OTHER)
+    packets = [
+        bytes(advertising_payload(name=0x1234, manufacturer_data=mesh, services=[bluetooth.UUID(0x0001)],
+                                  hopCount=3, distance=7.94, sender=0x5678, messageID=42)),
+        bytes(advertising_payload(name=0x1234, manufacturer_data=other, hopCount=1, sender=0x5678, messageID=7)),
+        bytes(advertising_payload(name=0xFFFF, hopCount=2, messageID=0x1FF)),
+        bytes(CompactTemplate(mesh, name=0x1234).patch(3, 0x5678, 42, distance=7.94, ttl=5)),
+        bytes(CompactTemplate(mesh, name=0x1234).patch(3, 0x5678, 43, distance=None)),
+        bytes(CompactTemplate(mesh, name=0x1234, data_len=ACK_DATA_LEN).patch(3, 0x5678, 43, ack=42)),
+        bytes(CompactTemplate(mesh, name=0x1234, data_len=5).patch(3, 0x5678, 45, ttl=3)),
+        bytes(FragmentTemplate(mesh).patch(4, 0x5678, 44, name=0x1234,
+                                           fragment=make_fragment(bytes(range(40)), 1, fragment_count(40)))),
+        # Foreign manufacturer record before the mesh one
+        _record(_ADV_TYPE_MANUFACTURER, (0x04, 0x03, 9, 9)) + bytes(CompactTemplate(mesh, name=1).patch(2, 3, 4)),
+        # Mesh manufacturer record that is no compact header, then one that is
+        _record(_ADV_TYPE_MANUFACTURER, (0x02, 0x01, 9)) + bytes(CompactTemplate(mesh, name=1).patch(2, 3, 4)),
+        # A legacy packet followed by a malformed second manufacturer record
+        bytes(advertising_payload(name=1, manufacturer_data=mesh, hopCount=2, sender=3, messageID=4))
+        + _record(_ADV_TYPE_MANUFACTURER, (0x02,)),
+        # Unknown compact header version
+        _record(_ADV_TYPE_MANUFACTURER, (0x02, 0x01, 9, 0x35, 0, 1, 0, 2, 0, 3, 0xFF, 0xFF)),
+        # Hop record with no data, name too wide for the walk, empty record
+        bytes((2, 0x0A, 3, 1, 0x0A, 6, 0x09, 1, 2, 3, 4, 5, 3, 0x18, 0, 9, 0)),
+        bytes((3, 0xFF, 0x02, 0x01, 2, 0xFF, 0x02, 3, 0x17, 0x56, 0x78)),
+        # Three and four byte fields, and a distance of the wrong length
+        _record(_ADV_TYPE_SENDER, (1, 2, 3)) + _record(_ADV_TYPE_ID, (1, 2, 3, 4))
+        + _record(_ADV_TYPE_INT, (9,)) + _record(_ADV_TYPE_DIST, (1, 2, 3)),
+        # Record running past the end of the packet
+        _record(_ADV_TYPE_INT, (2,)) + bytes((9, _ADV_TYPE_SENDER, 1)),
+    ]
+    aggregate = AggregateTemplate(mesh)
+    for k in range(aggregate.capacity):
+        aggregate.add(2, 0x5678, 100 + k, 0x1234, 1.5, 4)
+    packets.append(bytes(aggregate.payload()))
+    return packets
+
+
+def corpus(seed=23):
+    rng = random.Random(seed)
+    packets = []
+    for packet in mesh_packets():
+        for n in range(len(packet) + 1):
+            packets.append(packet[:n])
+        for _ in range(20):
+            corrupt = bytearray(packet)
+            corrupt[rng.randrange(len(corrupt))] = rng.getrandbits(8)
+            packets.append(bytes(corrupt))
+    for _ in range(2000):
+        packets.append(bytes(rng.getrandbits(8) for _ in range(rng.randint(0, 31))))
+    return packets
+
+
+def legacy_packets(seed=23):
+    rng = random.Random(seed)
+    packets = []
+    for _ in range(500):
+        mfg = rng.choice((None, _MESH, _OTHER))
+        packets.append(bytes(advertising_payload(
+            name=rng.getrandbits(16),
+            services=[bluetooth.UUID(0x0001)] if rng.random() < 0.3 else None,
+            manufacturer_data=bluetooth.UUID(mfg) if mfg is not None else None,
+            hopCount=rng.randint(0, 15),
+            distance=rng.choice((None, rng.uniform(0.0, 100.0))),
+            sender=rng.getrandbits(16),
+            messageID=rng.getrandbits(16))))
+    return packets
+
+
+class _PythonWalk:
+    def __enter__(self):
+        self._walk = advertisementPacket.walk_ad
+        advertisementPacket.walk_ad = advertisementPacket.walk_ad_py
+
+    def __exit__(self, *exc):
+        advertisementPacket.walk_ad = self._walk
+        return False
+
+
+class DecodeAdvTest(unittest.TestCase):
+    def _check_against_reference(self):
+        expected = [None] * FIELD_COUNT
+        result = [None] * FIELD_COUNT
+        walked = array('i', bytes(4 * WALK_LEN))
+        checked = 0
+        for packet in corpus():
+            for target in (None, _MESH, _OTHER):
+                expected[:] = [None] * FIELD_COUNT
+                result[:] = [None] * FIELD_COUNT
+                ok = reference_decode_adv(packet, expected, target)
+                self.assertEqual(decode_adv(packet, result, target, walked), ok, (packet.hex(), target))
+                if ok:
+                    # repr() so that NaN distances compare equal
+                    self.assertEqual(repr(result), repr(expected), (packet.hex(), target))
+                checked += 1
+        self.assertGreater(checked, 5000)
+
+    def test_matches_reference_walk(self):
+        self._check_against_reference()
+
+    def test_python_walk_matches_reference_walk(self):
+        with _PythonWalk():
+            self._check_against_reference()
+
+    def test_legacy_fields_match_baseline_decoder(self):
+        result = [None] * FIELD_COUNT
+        for packet in legacy_packets():
+            expected = baseline_decode_adv_data(packet)
+            self.assertTrue(decode_adv(packet, result), packet.hex())
+            self.assertEqual((result[FIELD_MFG], result[FIELD_HOP], result[FIELD_DIST], result[FIELD_SENDER],
+                              result[FIELD_NAME], result[FIELD_ID]), expected, packet.hex())
+
+    def test_compact_fields(self):
+        result = [None] * FIELD_COUNT
+        packet = bytes(CompactTemplate(bluetooth.UUID(_MESH), name=0x1234).patch(3, 0x5678, 42, distance=7.94, ttl=5))
+        self.assertTrue(decode_adv(packet, result, _MESH))
+        self.assertEqual(result[FIELD_HOP:FIELD_ID + 1], [3, 7.94, 0x5678, 0x1234, 42])
+        self.assertEqual(result[FIELD_TTL], 5)
+        self.assertIsNone(result[FIELD_ACK])
+        self.assertFalse(decode_adv(packet, result, _OTHER))
+
+    def test_hops_and_ttl_saturate(self):
+        result = [None] * FIELD_COUNT
+        packet = bytes(CompactTemplate(bluetooth.UUID(_MESH), name=0x1234).patch(20, 0x5678, 42, ttl=17))
+        self.assertTrue(decode_adv(packet, result, _MESH))
+        self.assertEqual((result[FIELD_HOP], result[FIELD_TTL]), (15, 15))
+
+    def test_unknown_distance(self):
+        result = [None] * FIELD_COUNT
+        template = CompactTemplate(bluetooth.UUID(_MESH), name=0x1234)
+        template.patch(3, 0x5678, 42, distance=7.94)
+        packet = bytes(template.patch(3, 0x5678, 43, distance=None))
+        self.assertTrue(decode_adv(packet, result, _MESH))
+        self.assertIsNone(result[FIELD_DIST])
+
+    def test_ack_carries_acknowledged_id(self):
+        result = [None] * FIELD_COUNT
+        mesh = bluetooth.UUID(_MESH)
+        packet = bytes(CompactTemplate(mesh, name=0x1234, data_len=ACK_DATA_LEN).patch(3, 0x5678, 43, ack=42))
+        self.assertTrue(decode_adv(packet, result, _MESH))
+        self.assertEqual((result[FIELD_ID], result[FIELD_ACK]), (43, 42))
+        # Without room for the acknowledged ID it is not an ACK
+        self.assertFalse(decode_adv(packet[:-1], result, _MESH))
+
+
+if __name__ == '__main__':
+    unittest.main()
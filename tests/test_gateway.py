@@ -0,0 +1,214 @@
+# Tests for the NumPy gateway on the host: decode_batch against
+# advertisementPacket.decode_adv over the decoder corpus of test_decoder, and
+# reading scan traces as scanTrace.TraceWriter writes them.
+
+import io
+import math
+import os
+import sys
+import time
+import unittest
+
+_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if _ROOT not in sys.path:
+    sys.path.insert(0, _ROOT)
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+import meshSim
+meshSim.install_host_modules()
+
+import advertisementPacket
+from advertisementPacket import (decode_adv, decode_record, FIELD_COUNT, FIELD_MFG, FIELD_HOP, FIELD_DIST,
+                                 FIELD_SENDER, FIELD_NAME, FIELD_ID, FIELD_TTL, FIELD_DATA, FIELD_RECORDS,
+                                 FIELD_ACK, MESH_RECORD_LEN)
+import scanTrace
+from test_decoder import corpus, legacy_packets, mesh_packets, _MESH, _OTHER
+
+if numpy is not None:
+    import gateway
+
+_MAC = bytes((0x28, 0xCD, 0xC1, 0, 0, 7))
+
+
+def _trace(packets):
+    # Each packet 1 us after the one before, so ts_us numbers them from 1
+    return gateway.trace_header() + b''.join(gateway.pack_record(1, _MAC, -50, p) for p in packets)
+
+
+def _int(value):
+    if value is None:
+        return -1
+    return value if value < 1 << 63 else -2
+
+
+def _expected(packet, target):
+    # decode_adv's records for packet, as gateway rows
+    result = [None] * FIELD_COUNT
+    if not decode_adv(packet, result, target):
+        return []
+    rows = []
+    for k in range(result[FIELD_RECORDS]):
+        if k:
+            decode_record(memoryview(packet), result[FIELD_DATA] + k * MESH_RECORD_LEN, result)
+        rows.append((_int(result[FIELD_MFG]), _int(result[FIELD_HOP]), _int(result[FIELD_TTL]),
+                     result[FIELD_DIST], _int(result[FIELD_SENDER]), _int(result[FIELD_NAME]),
+                     _int(result[FIELD_ID]), _int(result[FIELD_ACK])))
+    return rows
+
+
+def _row(record):
+    distance = float(record['distance'])
+    return (int(record['mfg']), int(record['hop']), int(record['ttl']),
+            None if math.isnan(distance) else distance, int(record['sender']), int(record['name']),
+            int(record['message_id']), int(record['ack']))
+
+
+@unittest.skipIf(numpy is None, 'needs NumPy')
+class DecodeBatchTest(unittest.TestCase):
+    def _check(self, packets):
+        checked = 0
+        for target in (None, _MESH, _OTHER):
+            batches = list(gateway.read_trace(io.BytesIO(_trace(packets))))
+            records = numpy.concatenate([gateway.decode_batch(frames, data, target) for frames, data in batches])
+            rows = {}
+            for record in records:
+                rows.setdefault(int(record['ts_us']), []).append(_row(record))
+            for n, packet in enumerate(packets, 1):
+                expected = _expected(packet, target)
+                got = rows.get(n, [])
+                # repr() so that NaN distances compare equal
+                self.assertEqual(repr(got), repr(expected), (packet.hex(), target))
+                checked += 1
+        return checked
+
+    def test_matches_decode_adv(self):
+        self.assertGreater(self._check(corpus()), 5000)
+
+    def test_matches_decode_adv_on_legacy_packets(self):
+        self._check(legacy_packets())
+
+    def test_headers_one_byte_short(self):
+        # Every mesh header with its manufacturer record shortened, so each
+        # version's length check is on the boundary
+        packets = []
+        for packet in mesh_packets():
+            if len(packet) > 1 and packet[1] == 0xFF:
+                for cut in range(1, 4):
+                    short = bytearray(packet[:packet[0] + 1 - cut])
+                    short[0] -= cut
+                    packets.append(bytes(short))
+        self._check(packets)
+
+    def test_wide_legacy_values(self):
+        packets = [bytes((9, 0x17)) + bytes((0x7F,)) + bytes(7),
+                   bytes((9, 0x17)) + bytes((0x80,)) + bytes(7),
+                   bytes((12, 0x18)) + bytes(3) + bytes((0x12,)) + bytes(7),
+                   bytes((12, 0x0A)) + bytes((1,)) + bytes(10)]
+        self._check(packets)
+        records = gateway.decode_batch(*next(gateway.read_trace(io.BytesIO(_trace(packets)))))
+        self.assertEqual(list(records['sender'][:2]), [0x7F << 56, gateway._TOO_WIDE])
+        self.assertEqual(records['message_id'][2], 0x12 << 56)
+        self.assertEqual(records['hop'][3], gateway._TOO_WIDE)
+
+    def test_python_walk_agrees(self):
+        walk = advertisementPacket.walk_ad
+        advertisementPacket.walk_ad = advertisementPacket.walk_ad_py
+        try:
+            self._check(corpus()[::7])
+        finally:
+            advertisementPacket.walk_ad = walk
+
+
+class _Trickle(io.RawIOBase):
+    # A non-blocking stream: each chunk of data only arrives a little while
+    # after the one before, and reads until then find nothing
+    def __init__(self, data, chunk, gap=0.002):
+        self._data = data
+        self._chunk = chunk
+        self._gap = gap
+        self._ready = time.monotonic() + gap
+        self.empty_reads = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        if not self._data:
+            return 0
+        if time.monotonic() < self._ready:
+            self.empty_reads += 1
+            return None
+        self._ready = time.monotonic() + self._gap
+        n = min(len(b), self._chunk, len(self._data))
+        b[:n] = self._data[:n]
+        self._data = self._data[n:]
+        return n
+
+
+@unittest.skipIf(numpy is None, 'needs NumPy')
+class ReadTraceTest(unittest.TestCase):
+    def setUp(self):
+        self._schedule = scanTrace.schedule
+
+    def tearDown(self):
+        scanTrace.schedule = self._schedule
+
+    def _packets(self):
+        return [p for p in corpus()[:400] if p]
+
+    def _recorded(self, packets):
+        # Written by the node's own TraceWriter, scheduled writes run at once
+        scanTrace.schedule = lambda fn, arg: fn(arg)
+        stream = io.BytesIO()
+        writer = scanTrace.TraceWriter(stream, buffer_size=512)
+        for packet in packets:
+            writer.record(0, _MAC, 0, -50, packet)
+        writer.flush()
+        return stream.getvalue()
+
+    def _read(self, source, batch=1 << 16):
+        frames = []
+        datas = []
+        for f, data in gateway.read_trace(source, batch):
+            frames.append(f)
+            datas.append(data)
+        return frames, datas
+
+    def test_reads_trace_writer_output(self):
+        packets = self._packets()
+        trace = self._recorded(packets)
+        frames, datas = self._read(io.BytesIO(trace), batch=16)
+        self.assertGreater(len(frames), 1)
+        got = [bytes(data[f['offset']:f['offset'] + f['len']]) for batch, data in zip(frames, datas) for f in batch]
+        self.assertEqual(got, packets)
+        expected = [r for r in scanTrace.read_trace(io.BytesIO(trace))]
+        ts = numpy.concatenate([f['ts_us'] for f in frames])
+        self.assertEqual(list(ts), list(numpy.cumsum([r[0] for r in expected])))
+        self.assertTrue(all(f['mac'] == int.from_bytes(_MAC, 'big') for batch in frames for f in batch))
+
+    def test_record_cut_short_is_ignored(self):
+        packets = self._packets()[:20]
+        trace = self._recorded(packets)
+        frames, _ = self._read(io.BytesIO(trace[:-1]))
+        self.assertEqual(sum(len(f) for f in frames), 19)
+
+    def test_rejects_other_formats(self):
+        with self.assertRaises(ValueError):
+            self._read(io.BytesIO(bytes(43 * 3)))
+
+    def test_waits_on_non_blocking_source(self):
+        packets = self._packets()
+        trace = self._recorded(packets)
+        source = _Trickle(trace, 1000)
+        frames, _ = self._read(source)
+        self.assertEqual(sum(len(f) for f in frames), len(packets))
+        # About one wait per chunk, not a spin on the empty reads
+        self.assertLessEqual(source.empty_reads, 2 * (len(trace) // 1000 + 2))
+
+
+if __name__ == '__main__':
+    unittest.main()
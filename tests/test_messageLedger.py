@@ -0,0 +1,58 @@
+# Tests for saving and restoring messageLedger.MessageLedger images on the
+# host, with the meshSim stand-ins.
+
+import io
+import os
+import sys
+import unittest
+
+_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if _ROOT not in sys.path:
+    sys.path.insert(0, _ROOT)
+
+import meshSim
+meshSim.install_host_modules()
+
+from messageLedger import MessageLedger
+
+_NOW = 100000
+
+
+class RestoreTest(unittest.TestCase):
+    def _ledger(self, first, count):
+        ledger = MessageLedger(capacity=16)
+        for i in range(first, first + count):
+            ledger.add(1, i, now=_NOW)
+        return ledger
+
+    def _image(self, ledger):
+        stream = io.BytesIO()
+        ledger.save(stream, now=_NOW)
+        return stream.getvalue()
+
+    def test_round_trip(self):
+        image = self._image(self._ledger(0, 10))
+        ledger = MessageLedger(capacity=16)
+        self.assertEqual(ledger.restore(io.BytesIO(image), now=_NOW), 10)
+        self.assertTrue(all(ledger.seen(1, i, now=_NOW) for i in range(10)))
+        self.assertFalse(ledger.seen(1, 10, now=_NOW))
+
+    def test_corrupt_image_keeps_entries(self):
+        image = bytearray(self._image(self._ledger(0, 10)))
+        image[-1] ^= 1
+        ledger = self._ledger(100, 5)
+        self.assertEqual(ledger.restore(io.BytesIO(bytes(image)), now=_NOW), 0)
+        self.assertEqual(len(ledger), 5)
+        self.assertTrue(all(ledger.seen(1, i, now=_NOW) for i in range(100, 105)))
+        self.assertFalse(ledger.seen(1, 0, now=_NOW))
+
+    def test_short_image_keeps_entries(self):
+        image = self._image(self._ledger(0, 10))
+        ledger = self._ledger(100, 5)
+        self.assertEqual(ledger.restore(io.BytesIO(image[:-4]), now=_NOW), 0)
+        self.assertEqual(len(ledger), 5)
+        self.assertTrue(ledger.seen(1, 104, now=_NOW))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,97 @@
+# Tests for scanTrace.TraceWriter on the host, with the meshSim stand-ins.
+
+import io
+import os
+import sys
+import unittest
+
+_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if _ROOT not in sys.path:
+    sys.path.insert(0, _ROOT)
+
+import meshSim
+meshSim.install_host_modules()
+
+import scanTrace
+
+_ADDR = bytes(6)
+_DATA = bytes(range(20))
+
+
+class _Queue:
+    # micropython.schedule that refuses the first `full` calls
+    def __init__(self, full=0):
+        self.full = full
+        self.queued = []
+
+    def __call__(self, fn, arg):
+        if self.full:
+            self.full -= 1
+            raise RuntimeError('schedule queue full')
+        self.queued.append((fn, arg))
+
+    def run(self):
+        queued, self.queued = self.queued, []
+        for fn, arg in queued:
+            fn(arg)
+
+
+class TraceWriterTest(unittest.TestCase):
+    def setUp(self):
+        self._schedule = scanTrace.schedule
+
+    def tearDown(self):
+        scanTrace.schedule = self._schedule
+
+    def _writer(self, queue):
+        scanTrace.schedule = queue
+        stream = io.BytesIO()
+        # Room for 8 records of 34 bytes per buffer
+        return stream, scanTrace.TraceWriter(stream, buffer_size=280)
+
+    def _records(self, stream):
+        return list(scanTrace.read_trace(io.BytesIO(stream.getvalue())))
+
+    def test_round_trip(self):
+        queue = _Queue()
+        stream, writer = self._writer(queue)
+        for i in range(30):
+            self.assertTrue(writer.record(0, _ADDR, 0, -40 - i, _DATA))
+            queue.run()
+        writer.flush()
+        records = self._records(stream)
+        self.assertEqual(len(records), 30)
+        self.assertEqual([r[4] for r in records], [-40 - i for i in range(30)])
+        self.assertEqual(records[0][5], _DATA)
+
+    def test_full_schedule_queue_is_retried(self):
+        # The swap's schedule fails; the next record schedules the write
+        queue = _Queue(full=1)
+        stream, writer = self._writer(queue)
+        for i in range(9):
+            writer.record(0, _ADDR, 0, -40, _DATA)
+        self.assertEqual(queue.queued, [])
+        writer.record(0, _ADDR, 0, -40, _DATA)
+        self.assertEqual(len(queue.queued), 1)
+        queue.run()
+        for i in range(20):
+            self.assertTrue(writer.record(0, _ADDR, 0, -40, _DATA))
+            queue.run()
+        self.assertEqual(writer.dropped, 0)
+        writer.flush()
+        self.assertEqual(len(self._records(stream)), 30)
+
+    def test_drops_while_both_buffers_are_full(self):
+        queue = _Queue()
+        stream, writer = self._writer(queue)
+        for i in range(20):
+            writer.record(0, _ADDR, 0, -40, _DATA)
+        self.assertEqual(writer.dropped, 4)
+        queue.run()
+        self.assertTrue(writer.record(0, _ADDR, 0, -40, _DATA))
+        writer.flush()
+        self.assertEqual(len(self._records(stream)), 17)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,99 @@
+# AD record walk of advertisementPacket.decode_adv, compiled with the viper
+# emitter. It is the same walk as advertisementPacket.walk_ad_py, which is
+# used instead where this module does not compile (a port built without the
+# native emitters); the constants below must match the ones there.
+#
+# walk_ad(buf, start, n, target, out) walks the AD records of buf[:n] from
+# start and leaves in out, an array('i'), the manufacturer ID, the hop,
+# sender, message ID and name values and the offset of the distance record.
+# A value is -1 when its record is absent, -2 when it is empty, and
+# -3 - offset when it is too wide for 24 bits (the caller reads it from the
+# record at offset). The walk stops at a manufacturer record that may hold a
+# compact mesh header, with its offset in out, so the caller can decode it
+# and resume after it if it is not one.
+
+import micropython
+from micropython import const
+
+_ABSENT = const(-1)
+_EMPTY = const(-2)
+_WIDE = const(-3)
+
+# out
+_W_MFG = const(0)
+_W_HOP = const(1)
+_W_SENDER = const(2)
+_W_ID = const(3)
+_W_NAME = const(4)
+_W_DIST = const(5)
+_W_AT = const(6)
+_W_COUNT = const(7)
+
+# Return values
+_WALK_REJECT = const(0)
+_WALK_END = const(1)
+_WALK_MFG = const(2)
+
+_ADV_TYPE_NAME = const(0x09)
+_ADV_TYPE_INT = const(0x0A)
+_ADV_TYPE_DIST = const(0x16)
+_ADV_TYPE_SENDER = const(0x17)
+_ADV_TYPE_ID = const(0x18)
+_ADV_TYPE_MANUFACTURER = const(0xFF)
+
+# Viper's pointer types, as plain names for the annotations under CPython
+try:
+    ptr8
+except NameError:
+    ptr8 = ptr32 = None
+
+
+@micropython.viper
+def walk_ad(buf: ptr8, start: int, n: int, target: int, out: ptr32) -> int:
+    if start == 0:
+        k = 0
+        while k < _W_COUNT:
+            out[k] = _ABSENT
+            k += 1
+    i = start
+    while i + 1 < n:
+        length = int(buf[i])
+        if length == 0 or i + length >= n:
+            break
+        adv_type = int(buf[i + 1])
+        if adv_type == _ADV_TYPE_MANUFACTURER:
+            if length < 3:
+                return _WALK_REJECT
+            mfg = int(buf[i + 2]) | (int(buf[i + 3]) << 8)
+            out[_W_MFG] = mfg
+            if target >= 0 and mfg != target:
+                return _WALK_REJECT
+            if length > 3:
+                out[_W_AT] = i
+                return _WALK_MFG
+        elif adv_type == _ADV_TYPE_DIST:
+            out[_W_DIST] = i
+        else:
+            slot = -1
+            if adv_type == _ADV_TYPE_INT:
+                slot = _W_HOP
+            elif adv_type == _ADV_TYPE_SENDER:
+                slot = _W_SENDER
+            elif adv_type == _ADV_TYPE_ID:
+                slot = _W_ID
+            elif adv_type == _ADV_TYPE_NAME:
+                slot = _W_NAME
+            if slot >= 0:
+                if length > 4:
+                    out[slot] = _WIDE - i
+                elif length == 1 and slot != _W_NAME:
+                    out[slot] = _EMPTY
+                else:
+                    value = 0
+                    j = i + 2
+                    while j <= i + length:
+                        value = (value << 8) | int(buf[j])
+                        j += 1
+                    out[slot] = value
+        i += length + 1
+    return _WALK_END